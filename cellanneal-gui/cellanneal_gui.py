@@ -1,14 +1,15 @@
 import tkinter as tk
 from PIL import Image, ImageTk
-from pandas import DataFrame, read_excel, read_csv
 from tkinter.filedialog import askopenfile, askdirectory
-from tkinter import messagebox
+from tkinter import messagebox, ttk
 from pathlib import Path
-from cellanneal import cellanneal_pipe
+from cellanneal import cellanneal_pipe, read_expression_data, DeconvolutionAborted
 import openpyxl  # for xlsx import
 import xlrd  # for xls import
 import sys
-from os import path
+from os import path, cpu_count
+from multiprocessing import freeze_support, get_context
+from queue import Empty
 import time
 
 
@@ -21,16 +22,103 @@ def resource_path(relative_path):
     return path.join(base_path, relative_path)
 
 
+def format_duration(seconds):
+    """Formats a duration in seconds for display, e.g. as 1 min 20 s."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{} s".format(seconds)
+    if seconds < 3600:
+        return "{} min {} s".format(seconds // 60, seconds % 60)
+    return "{} h {} min".format(seconds // 3600, seconds % 3600 // 60)
+
+
+def run_cellanneal_worker(settings, messages, abort):
+    """Runs data import and the cellanneal pipeline in a worker process, so
+    that the window stays responsive. settings is a dict of the paths and
+    parameters of the run. Status updates, per-sample progress and the
+    outcome of the run are put into the messages queue; the run stops when
+    the abort event is set."""
+
+    def progress(n_done, n_total, sample):
+        messages.put(("progress", n_done, n_total, sample))
+
+    try:
+        print("\n+++ Welcome to cellanneal! +++")
+        print("{}\n".format(time.ctime()))
+
+        # import bulk and celltype data
+        # bulk data
+        print("\n+++ Importing mixture data ... +++ \n")
+        messages.put(("status", "Importing mixture data ..."))
+        try:
+            # gene names are changed to uppercase, duplicate genes summed
+            # and missing values set to 0 (see read_expression_data)
+            bulk_df = read_expression_data(Path(settings["bulk_data_path"]))
+        except Exception:
+            messages.put(
+                (
+                    "error",
+                    "Import error",
+                    """Your mixture data file could not be imported. Please check the documentation for format requirements and look at the example mixture data files.""",
+                )
+            )
+            print("+++ Aborted. +++")
+            return
+
+        # celltype data
+        print("\n+++ Importing signature data ... +++ \n")
+        messages.put(("status", "Importing signature data ..."))
+        try:
+            # gene names are changed to uppercase, duplicate genes summed
+            # and missing values set to 0 (see read_expression_data)
+            celltype_df = read_expression_data(Path(settings["celltype_data_path"]))
+        except Exception:
+            messages.put(
+                (
+                    "error",
+                    "Import error",
+                    """Your signature data file could not be imported. Please check the documentation for format requirements and look at the example signature data files.""",
+                )
+            )
+            print("+++ Aborted. +++")
+            return
+
+        if abort.is_set():
+            raise DeconvolutionAborted("Deconvolution aborted.")
+        messages.put(("status", "Constructing gene sets and deconvolving ..."))
+        cellanneal_pipe(
+            Path(settings["celltype_data_path"]),  # path object!
+            celltype_df,
+            Path(settings["bulk_data_path"]),  # path object!
+            bulk_df,
+            settings["disp_min"],
+            settings["bulk_min"],
+            settings["bulk_max"],
+            settings["maxiter"],
+            Path(settings["output_path"]),  # path object!
+            n_jobs=settings["n_jobs"],
+            progress=progress,
+            abort=abort,
+        )
+    except DeconvolutionAborted:
+        print("\n+++ Aborted. +++")
+        messages.put(("aborted",))
+    except Exception as e:
+        messages.put(
+            ("error", "Error", "cellanneal stopped with an error: {}".format(e))
+        )
+    else:
+        messages.put(("finished",))
+
+
 class cellgui:
     def __init__(self, root):
         self.root = root
         root.title("cellanneal")
 
         # place holders for required data
-        self.bulk_df = DataFrame()
         self.bulk_data_path = tk.StringVar()
         self.bulk_df_is_set = 0  # check later whether data has been selected
-        self.celltype_df = DataFrame()
         self.celltype_data_path = tk.StringVar()
         self.celltype_df_is_set = 0
 
@@ -51,6 +139,16 @@ class cellgui:
         self.maxiter = 1000  # maximum annealing iterations
         self._maxiter_default = 1000
 
+        self.n_jobs = 1  # number of parallel processes
+        self._n_jobs_default = 1
+
+        # a run is executed by a worker process which reports back through a
+        # queue and is stopped by setting the abort event
+        self.worker = None
+        self.messages = None
+        self.abort_event = None
+        self.deconv_start = None
+
         # basic layout considerations
         self.canvas = tk.Canvas(root, width=700, height=500)
         self.canvas.grid(columnspan=6, rowspan=15)
@@ -103,6 +201,8 @@ class cellgui:
         self.ca_button = ImageTk.PhotoImage(self.ca_button)
         self.ca_label = tk.Label(image=self.ca_button)
         self.ca_label.image = self.ca_button
+        self.abort_image = Image.open(resource_path("abort_button.png"))
+        self.abort_image = ImageTk.PhotoImage(self.abort_image)
 
         # spacers for tidier look
         spacer1 = tk.Label(root, text="")
@@ -197,6 +297,9 @@ class cellgui:
         self.maxiter_param_label = tk.Label(root, text="maximum number of iterations")
         self.maxiter_param_label.grid(row=p_i + 3, column=1, sticky=tk.W)
 
+        self.n_jobs_param_label = tk.Label(root, text="number of parallel processes")
+        self.n_jobs_param_label.grid(row=p_i + 4, column=1, sticky=tk.W)
+
         # corresponding set of values
         self.bulk_min_value_label = tk.Label(root, text="{}".format(self.bulk_min))
         self.bulk_min_value_label.grid(row=p_i, column=2, sticky=tk.W)
@@ -210,6 +313,9 @@ class cellgui:
         self.maxiter_value_label = tk.Label(root, text="{}".format(self.maxiter))
         self.maxiter_value_label.grid(row=p_i + 3, column=2, sticky=tk.W)
 
+        self.n_jobs_value_label = tk.Label(root, text="{}".format(self.n_jobs))
+        self.n_jobs_value_label.grid(row=p_i + 4, column=2, sticky=tk.W)
+
         # button for editing parameters which spawns new window
         self.parameter_change_button = tk.Button(
             root,
@@ -261,9 +367,38 @@ class cellgui:
             width=20,
         )
         self.cellanneal_button.grid(
-            row=d_i, column=1, columnspan=5, sticky=tk.W + tk.E, padx=10, pady=50
+            row=d_i, column=1, columnspan=3, sticky=tk.W + tk.E, padx=10, pady=(50, 10)
         )
 
+        # make button for aborting a running deconvolution
+        self.abort_button = tk.Button(
+            root,
+            text="abort",
+            image=self.abort_image,
+            highlightbackground="#f47a60",
+            highlightthickness=0.1,
+            command=lambda: self.abort(),
+            state=tk.DISABLED,
+        )
+        self.abort_button.grid(
+            row=d_i, column=4, columnspan=2, sticky=tk.W + tk.E, padx=10, pady=(50, 10)
+        )
+
+        # progress of a running deconvolution
+        self.progress_bar = ttk.Progressbar(
+            root, orient=tk.HORIZONTAL, mode="determinate", maximum=1
+        )
+        self.progress_bar.grid(
+            row=d_i + 1, column=1, columnspan=5, sticky=tk.W + tk.E, padx=10
+        )
+        self.status_label = tk.Label(root, text="", wraplength=500)
+        self.status_label.grid(
+            row=d_i + 2, column=1, columnspan=5, sticky=tk.W, padx=10, pady=(5, 20)
+        )
+
+        # a running deconvolution is aborted when the window is closed
+        root.protocol("WM_DELETE_WINDOW", self.close)
+
     # methods
     def show_instructions(self):
         readme_window = tk.Toplevel(root)
@@ -335,7 +470,7 @@ class cellgui:
             readme_window,
             wraplength=wl,
             justify=tk.LEFT,
-            text="""Click on "run cellanneal" and watch the progress in the accompanying console. The main window freezes while deconvolution is in progress. Result tables and figures are stored to the user-specified output folder.""",
+            text="""Click on "run cellanneal" and watch the progress bar below it; detailed progress is printed in the accompanying console. A running deconvolution can be stopped with the "abort" button. Result tables and figures are stored to the user-specified output folder.""",
         )
         self.readme_text12.grid(row=12, column=0, padx=10)
 
@@ -459,6 +594,24 @@ class cellgui:
         )
         self.maxiter_set_button.grid(row=12, column=2, sticky=tk.W)
 
+        # for parameter n_jobs
+        # title label and current value
+        self.n_jobs_label = tk.Label(
+            par_window, text="number of parallel processes", font="-weight bold"
+        )
+        self.n_jobs_label.grid(row=13, column=1, columnspan=2, sticky=tk.W + tk.E)
+
+        # entry field
+        self.n_jobs_entry = tk.Entry(par_window, width=8)
+        self.n_jobs_entry.grid(row=15, column=1, sticky=tk.E)
+        self.n_jobs_entry.insert(tk.END, self.n_jobs)
+
+        # set button
+        self.n_jobs_set_button = tk.Button(
+            par_window, text="set", command=lambda: self.set_n_jobs(), width=8
+        )
+        self.n_jobs_set_button.grid(row=15, column=2, sticky=tk.W)
+
         # buton for wuitting and return to main window
         self.return_button = tk.Button(
             par_window,
@@ -575,6 +728,34 @@ class cellgui:
                 """Please provdide a positive integer. Examples: "50", "587", "1000".""",
             )
 
+    def set_n_jobs(self):
+        # get input and check validity
+        input = self.n_jobs_entry.get()
+        # can it be interpreted as int?
+        try:
+            new_val = int(input)
+        except ValueError:
+            messagebox.showerror(
+                "Input error",
+                """Please provdide a positive integer of at most {}. Examples: "1", "4".""".format(
+                    cpu_count()
+                ),
+            )
+            return 0
+        # check if value is between 1 and the number of CPUs
+        if 1 <= new_val <= cpu_count():
+            # update n_jobs
+            self.n_jobs = new_val
+            # update display of current n_jobs
+            self.n_jobs_value_label["text"] = "{}".format(self.n_jobs)
+        else:
+            messagebox.showerror(
+                "Input error",
+                """Please provdide a positive integer of at most {}. Examples: "1", "4".""".format(
+                    cpu_count()
+                ),
+            )
+
     def reset_default_params(self):
         self.bulk_min = self._bulk_min_default
         self.bulk_min_value_label["text"] = "{}".format(self.bulk_min)
@@ -588,6 +769,9 @@ class cellgui:
         self.maxiter = self._maxiter_default
         self.maxiter_value_label["text"] = "{}".format(self.maxiter)
 
+        self.n_jobs = self._n_jobs_default
+        self.n_jobs_value_label["text"] = "{}".format(self.n_jobs)
+
     def cellanneal(self):
         # check if input and output is set
         if self.bulk_df_is_set == 0:
@@ -607,83 +791,118 @@ class cellgui:
             )
             return 0
 
-        print("\n+++ Welcome to cellanneal! +++")
-        print("{}\n".format(time.ctime()))
-
-        # import bulk and celltype data
-        # bulk data
-        print("\n+++ Importing mixture data ... +++ \n")
-        try:
-            bfile = self.bulk_data_path.get()
-            # depending on extension, use different import function
-            if bfile.split(".")[-1] in ["csv", "txt"]:
-                self.bulk_df = read_csv(bfile, index_col=0, sep=None)
-            elif bfile.split(".")[-1] in ["xlsx"]:
-                self.bulk_df = read_excel(bfile, index_col=0, engine="openpyxl")
-            elif bfile.split(".")[-1] in ["xls"]:
-                self.bulk_df = read_excel(bfile, index_col=0, engine="xlrd")
-            else:
-                raise ImportError
-            # here, in order to make further course case insensitive,
-            # change all gene names to uppercase only
-            self.bulk_df.index = self.bulk_df.index.str.upper()
-            # also, if there are duplicate genes, the are summed here
-            self.bulk_df = self.bulk_df.groupby(self.bulk_df.index).sum()
-            # finally, if there are nan's after import, set them to 0 to
-            # avoid further issues
-            self.bulk_df = self.bulk_df.fillna(0)
-
-        except:
-            messagebox.showerror(
-                "Import error",
-                """Your mixture data file could not be imported. Please check the documentation for format requirements and look at the example mixture data files.""",
-            )
-            print("+++ Aborted. +++")
+        if self.worker is not None:
             return 0
 
-        # celltype data
-        print("\n+++ Importing signature data ... +++ \n")
-        try:
-            # depending on extension, use different import function
-            cfile = self.celltype_data_path.get()
-            if cfile.split(".")[-1] in ["csv", "txt"]:
-                self.celltype_df = read_csv(cfile, index_col=0, sep=None)
-            elif cfile.split(".")[-1] in ["xlsx"]:
-                self.celltype_df = read_excel(cfile, index_col=0, engine="openpyxl")
-            elif cfile.split(".")[-1] in ["xls"]:
-                self.celltype_df = read_excel(cfile, index_col=0, engine="xlrd")
+        settings = {
+            "bulk_data_path": self.bulk_data_path.get(),
+            "celltype_data_path": self.celltype_data_path.get(),
+            "output_path": self.output_path.get(),
+            "disp_min": self.disp_min,
+            "bulk_min": self.bulk_min,
+            "bulk_max": self.bulk_max,
+            "maxiter": self.maxiter,
+            "n_jobs": self.n_jobs,
+        }
+        # the worker is started afresh (spawned) rather than forked from the
+        # process running the window
+        context = get_context("spawn")
+        self.messages = context.Queue()
+        self.abort_event = context.Event()
+        self.worker = context.Process(
+            target=run_cellanneal_worker,
+            args=(settings, self.messages, self.abort_event),
+        )
+        self.worker.start()
+        self.deconv_start = None
+
+        self.cellanneal_button["state"] = tk.DISABLED
+        self.abort_button["state"] = tk.NORMAL
+        self.progress_bar["value"] = 0
+        self.status_label["text"] = "Starting cellanneal ..."
+        self.root.after(100, self.check_worker)
+
+    def check_worker(self):
+        # handle all messages sent by the worker since the last check
+        outcome = None
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except Empty:
+                break
+            if message[0] == "status":
+                self.status_label["text"] = message[1]
+            elif message[0] == "progress":
+                self.show_progress(*message[1:])
             else:
-                raise ImportError
-            # here, in order to make further course case insensitive,
-            # change all gene names to uppercase only
-            self.celltype_df.index = self.celltype_df.index.str.upper()
-            # also, if there are duplicate genes, the are summed here
-            self.celltype_df = self.celltype_df.groupby(self.celltype_df.index).sum()
-            # finally, if there are nan's after import, set them to 0 to
-            # avoid further issues
-            self.celltype_df = self.celltype_df.fillna(0)
-
-        except:
-            messagebox.showerror(
-                "Import error",
-                """Your signature data file could not be imported. Please check the documentation for format requirements and look at the example signature data files.""",
+                outcome = message
+
+        if outcome is None and self.worker.is_alive():
+            self.root.after(100, self.check_worker)
+            return
+        self.worker.join()
+        if outcome is None:
+            outcome = (
+                "error",
+                "Error",
+                "cellanneal stopped unexpectedly, see the console for details.",
             )
-            print("+++ Aborted. +++")
-            return 0
-
-        cellanneal_pipe(
-            Path(self.celltype_data_path.get()),  # path object!
-            self.celltype_df,
-            Path(self.bulk_data_path.get()),  # path object!
-            self.bulk_df,
-            self.disp_min,
-            self.bulk_min,
-            self.bulk_max,
-            self.maxiter,
-            Path(self.output_path.get()),
-        )  # path object!
-
-
-root = tk.Tk()
-ca_gui = cellgui(root)
-root.mainloop()
+        self.worker = None
+        self.cellanneal_button["state"] = tk.NORMAL
+        self.abort_button["state"] = tk.DISABLED
+
+        if outcome[0] == "finished":
+            self.progress_bar["value"] = 1
+            self.status_label["text"] = "Finished. Results are stored in {}.".format(
+                self.output_path.get()
+            )
+        elif outcome[0] == "aborted":
+            self.status_label["text"] = "Aborted."
+        else:
+            self.status_label["text"] = outcome[2]
+            messagebox.showerror(outcome[1], outcome[2])
+
+    def show_progress(self, n_done, n_total, sample):
+        if n_done == 0:
+            # deconvolution starts
+            self.deconv_start = time.time()
+            self.progress_bar["value"] = 0
+            self.status_label["text"] = "Deconvolving {} samples ...".format(n_total)
+            return
+        # the estimated remaining time assumes that the remaining samples take
+        # as long as the finished ones did on average
+        elapsed = time.time() - self.deconv_start
+        remaining = elapsed / n_done * (n_total - n_done)
+        self.progress_bar["value"] = n_done / n_total
+        if n_done < n_total:
+            self.status_label[
+                "text"
+            ] = "Deconvolved sample {} of {} ({}), about {} remaining.".format(
+                n_done, n_total, sample, format_duration(remaining)
+            )
+        else:
+            self.status_label["text"] = "Writing results and figures ..."
+
+    def abort(self):
+        if self.worker is not None:
+            self.abort_event.set()
+            self.abort_button["state"] = tk.DISABLED
+            self.status_label["text"] = "Aborting ..."
+
+    def close(self):
+        # stop a running deconvolution before the window is closed
+        if self.worker is not None:
+            self.abort_event.set()
+            self.worker.join(timeout=10)
+            if self.worker.is_alive():
+                self.worker.terminate()
+        self.root.destroy()
+
+
+# worker processes of parallel runs import this module, the window must only
+# be opened by the main process
+if __name__ == "__main__":
+    freeze_support()
+    root = tk.Tk()
+    ca_gui = cellgui(root)
+    root.mainloop()
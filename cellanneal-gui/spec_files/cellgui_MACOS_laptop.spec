@@ -20,6 +20,7 @@ a = Analysis(['cellanneal_gui.py'],
 
 a.datas += [('logo_orange.png', '/Users/lbuchauer/owncube/cellanneal/cellanneal-gui/logo_orange.png', 'img'),
             ('cellanneal_button.png', '/Users/lbuchauer/owncube/cellanneal/cellanneal-gui/cellanneal_button.png', 'img'),
+            ('abort_button.png', '/Users/lbuchauer/owncube/cellanneal/cellanneal-gui/abort_button.png', 'img'),
             ('logo.icns', '/Users/lbuchauer/owncube/cellanneal/cellanneal-gui/logo.icns', 'img')]
 
 
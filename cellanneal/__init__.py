@@ -5,5 +5,27 @@ __author__ = "Lisa Buchauer <lisa.buchauer@posteo.de>"
 
 # functions which become available for import
 from .general import make_gene_dictionary, return_mixture, deconvolve
-from .plots import plot_pies, plot_mix_heatmap, plot_mix_heatmap_log, plot_scatter
+from .general import register_engine, DeconvolutionAborted
+from .selection import GeneSelection
 from .pipelines import cellanneal_pipe, run_cellanneal
+from .readers import read_expression_data, write_bulk_store
+from .store import BulkStore
+from .signature import build_signature
+from .telemetry import ConsoleSink, QuietSink, JSONLinesSink, MultiSink
+
+# the plotting functions are imported on first use, so that importing
+# cellanneal does not load matplotlib and seaborn
+_PLOT_FUNCTIONS = [
+    "plot_pies",
+    "plot_mix_heatmap",
+    "plot_mix_heatmap_log",
+    "plot_scatter",
+]
+
+
+def __getattr__(name):
+    if name in _PLOT_FUNCTIONS:
+        from . import plots
+
+        return getattr(plots, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
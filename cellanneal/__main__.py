@@ -5,12 +5,15 @@ production of a set of plots."""
 
 import argparse
 from pathlib import Path
-from pandas import read_csv, read_excel
+import numpy as np
 import time
-import openpyxl  # for xlsx import
-import xlrd  # for xls import
 
 from .pipelines import cellanneal_pipe
+from .readers import read_expression_data
+from .store import BulkStore, is_bulk_store
+from .general import ENGINES
+from .telemetry import CONSOLE, JSONLinesSink, MultiSink, QuietSink, Stage, emit
+from .profiling import RunProfile
 
 
 def init_parser(parser):
@@ -20,7 +23,8 @@ def init_parser(parser):
         type=str,
         help=(
             """Path to mixture data file; .csv, .txt, .xlsx or .xls format
-        with sample names as columns and genes as rows."""
+        with sample names as columns and genes as rows, or to a bulk store
+        directory (see write_bulk_store)."""
         ),
     )
 
@@ -76,6 +80,165 @@ def init_parser(parser):
         help=("""Maximum number of iterations for scipy's dual_annealing."""),
     )
 
+    parser.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="anneal",
+        help=(
+            """Deconvolution engine; 'anneal' for dual annealing, 'nnls' for a
+            fast deterministic least squares fit suited for triage of large
+            data sets."""
+        ),
+    )
+
+    parser.add_argument(
+        "--simplex",
+        action="store_true",
+        help=(
+            """Anneal on the simplex of mixtures (stick-breaking coordinates)
+            instead of on unnormalised cell type fractions."""
+        ),
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=(
+            """Number of processes used to deconvolve samples in parallel;
+            -1 uses all available CPUs."""
+        ),
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help=(
+            """Random seed for reproducible results; if not given, a seed is
+            drawn and recorded in the parameters file."""
+        ),
+    )
+
+    parser.add_argument(
+        "--warm_start",
+        choices=["sqrt", "log"],
+        default=None,
+        help=(
+            """Start annealing from a non-negative least squares estimate of
+            each mixture, fitted on square-root or log scale; allows for a
+            smaller maxiter."""
+        ),
+    )
+
+    parser.add_argument(
+        "--stop_iter",
+        type=int,
+        default=None,
+        help=(
+            """Stop the annealing of a sample early if its best fit did not
+            improve by more than stop_tol within this many iterations."""
+        ),
+    )
+
+    parser.add_argument(
+        "--stop_tol",
+        type=float,
+        default=0.0,
+        help=("""Absolute tolerance (in 1 - Spearman's rho) for early stopping."""),
+    )
+
+    parser.add_argument(
+        "--stop_rate",
+        type=float,
+        default=None,
+        help=(
+            """Also stop early once the relative improvement of the best fit
+            per iteration, averaged over stop_iter iterations, falls below
+            this rate."""
+        ),
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        help=(
+            """Streaming mode for large mixture files: read and deconvolve
+            the samples in chunks of this size and write their results as
+            soon as each chunk is finished. No figures are produced."""
+        ),
+    )
+
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help=(
+            """Read expression values in single precision, which halves the
+            memory needed for the input data."""
+        ),
+    )
+
+    parser.add_argument(
+        "--no_plots",
+        "--no-plots",
+        dest="no_plots",
+        action="store_true",
+        help=(
+            """Do not produce figures; the plotting libraries are then not
+            loaded at all."""
+        ),
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help=(
+            """Folder in which per-sample results are cached; later runs with
+            the same seed only deconvolve new or changed samples. Imported
+            data files are kept there as binary copies which later runs
+            memory-map instead of parsing the files again."""
+        ),
+    )
+
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=1024,
+        help=(
+            """Maximum size of the result cache in MB, least recently used
+            results are removed beyond this."""
+        ),
+    )
+
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help=("""Print errors only instead of the progress of the run."""),
+    )
+
+    parser.add_argument(
+        "--events",
+        type=str,
+        default=None,
+        help=(
+            """Path of a file to which the progress events of the run (stages,
+            wall time, iterations, evaluations, final distance and stop
+            reason of each sample) are written as newline-delimited JSON."""
+        ),
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            """Measure the time spent in the stages of the run and in the
+            phases of each sample's deconvolution and write a report next
+            to the parameters file."""
+        ),
+    )
+
     return parser
 
 
@@ -95,6 +258,22 @@ def main():
             bulk_max
             disp_min
             maxiter
+            engine
+            simplex
+            jobs
+            seed
+            warm_start
+            stop_iter
+            stop_tol
+            stop_rate
+            chunk_size
+            float32
+            no_plots
+            cache_dir
+            cache_size
+            quiet
+            events
+            profile
 
     Output:
 
@@ -116,79 +295,113 @@ def main():
     bulk_max = args.bulk_max
     disp_min = args.disp_min
     maxiter = args.maxiter
+    engine = args.engine
+    simplex = args.simplex
+    n_jobs = args.jobs
+    seed = args.seed
+    warm_start = args.warm_start
+    stop_iter = args.stop_iter
+    stop_tol = args.stop_tol
+    stop_rate = args.stop_rate
+    chunk_size = args.chunk_size
+    dtype = np.float32 if args.float32 else np.float64
+    cache_dir = Path(args.cache_dir) if args.cache_dir else None
+    cache_size = int(args.cache_size * 1024**2)
 
-    print("\n+++ Welcome to cellanneal! +++")
-    print("{}\n".format(time.ctime()))
+    # progress is printed and optionally written to an events file
+    events = QuietSink() if args.quiet else CONSOLE
+    events_file = JSONLinesSink(args.events) if args.events else None
+    if events_file is not None:
+        events = MultiSink(events, events_file)
+    # the import of the data is part of the profile as well
+    run_profile = RunProfile() if args.profile else None
+    import_events = events if run_profile is None else MultiSink(events, run_profile)
 
-    """ 1) Import bulk and cell type data """
-    print("\n+++ Importing mixture data ... +++ \n")
-    try:
-        bfile = bulk_data_path
-        # depending on extension, use different import function
-        if bfile.name.split(".")[-1] in ["csv", "txt"]:
-            bulk_df = read_csv(bfile, index_col=0, sep=None)
-        elif bfile.name.split(".")[-1] in ["xlsx"]:
-            bulk_df = read_excel(bfile, index_col=0, engine="openpyxl")
-        elif bfile.name.split(".")[-1] in ["xls"]:
-            bulk_df = read_excel(bfile, index_col=0, engine="xlrd")
-        else:
-            raise ImportError
-        # here, in order to make further course case insensitive,
-        # change all gene names to uppercase only
-        bulk_df.index = bulk_df.index.str.upper()
-        # also, if there are duplicate genes, the are summed here
-        bulk_df = bulk_df.groupby(bulk_df.index).sum()
-        # finally, if there are nan's after import, set them to 0 to
-        # avoid further issues
-        bulk_df = bulk_df.fillna(0)
-    except ValueError:
-        print(
-            """Your bulk data file could not be imported.
-        Please check the documentation for format requirements
-        and look at the example bulk data files.\n"""
-        )
-        print("+++ Aborted. +++")
-        return 0
+    if not args.quiet:
+        print("\n+++ Welcome to cellanneal! +++")
+        print("{}\n".format(time.ctime()))
 
-    print("\n+++ Importing signature data ... +++ \n")
-    # import single cell based reference
     try:
-        # depending on extension, use different import function
-        cfile = celltype_data_path
-        if cfile.name.split(".")[-1] in ["csv", "txt"]:
-            celltype_df = read_csv(cfile, index_col=0, sep=None)
-        elif cfile.name.split(".")[-1] in ["xlsx"]:
-            celltype_df = read_excel(cfile, index_col=0, engine="openpyxl")
-        elif cfile.name.split(".")[-1] in ["xls"]:
-            celltype_df = read_excel(cfile, index_col=0, engine="xlrd")
+        """1) Import bulk and cell type data"""
+        if chunk_size is not None:
+            # in streaming mode, the pipeline reads the mixture data in chunks
+            bulk_df = None
+        elif is_bulk_store(bulk_data_path):
+            # samples in a store are read when needed
+            bulk_df = BulkStore(bulk_data_path)
         else:
-            raise ImportError
-        # here, in order to make further course case insensitive,
-        # change all gene names to uppercase only
-        celltype_df.index = celltype_df.index.str.upper()
-        # also, if there are duplicate genes, the are summed here
-        celltype_df = celltype_df.groupby(celltype_df.index).sum()
-        # finally, if there are nan's after import, set them to 0 to
-        # avoid further issues
-        celltype_df = celltype_df.fillna(0)
-    except ValueError:
-        print(
-            """Your celltype data file could not be imported.
-        Please check the documentation for format requirements
-        and look at the example celltype data files."""
+            try:
+                # gene names are changed to uppercase, duplicate genes summed
+                # and missing values set to 0 (see read_expression_data)
+                with Stage(import_events, "import_mixture"):
+                    bulk_df = read_expression_data(
+                        bulk_data_path,
+                        dtype=dtype,
+                        cache_dir=cache_dir,
+                        events=import_events,
+                    )
+            except ValueError:
+                emit(
+                    events,
+                    "error",
+                    message="""Your bulk data file could not be imported.
+            Please check the documentation for format requirements
+            and look at the example bulk data files.\n""",
+                )
+                if not args.quiet:
+                    print("+++ Aborted. +++")
+                return 0
+
+        # import single cell based reference
+        try:
+            # gene names are changed to uppercase, duplicate genes summed and
+            # missing values set to 0 (see read_expression_data)
+            with Stage(import_events, "import_signature"):
+                celltype_df = read_expression_data(
+                    celltype_data_path,
+                    dtype=dtype,
+                    cache_dir=cache_dir,
+                    events=import_events,
+                )
+        except ValueError:
+            emit(
+                events,
+                "error",
+                message="""Your celltype data file could not be imported.
+            Please check the documentation for format requirements
+            and look at the example celltype data files.""",
+            )
+            if not args.quiet:
+                print("+++ Aborted. +++")
+            return 0
+
+        # start pipeline
+        cellanneal_pipe(
+            celltype_data_path,
+            celltype_df,
+            bulk_data_path,
+            bulk_df,
+            disp_min,
+            bulk_min,
+            bulk_max,
+            maxiter,
+            output_path,
+            n_jobs=n_jobs,
+            seed=seed,
+            cache_dir=cache_dir,
+            cache_size=cache_size,
+            warm_start=warm_start,
+            stop_iter=stop_iter,
+            stop_tol=stop_tol,
+            stop_rate=stop_rate,
+            engine=engine,
+            simplex=simplex,
+            chunk_size=chunk_size,
+            dtype=dtype,
+            plots=not args.no_plots,
+            events=events,
+            profile=run_profile or False,
         )
-        print("+++ Aborted. +++")
-        return 0
-
-    # start pipeline
-    cellanneal_pipe(
-        celltype_data_path,
-        celltype_df,
-        bulk_data_path,
-        bulk_df,
-        disp_min,
-        bulk_min,
-        bulk_max,
-        maxiter,
-        output_path,
-    )
+    finally:
+        if events_file is not None:
+            events_file.close()
@@ -0,0 +1,639 @@
+"""Benchmarks for the deconvolution procedure.
+
+Besides the benchmarks of warm starts and of the start-up time, the module
+measures speed and accuracy of deconvolve on synthetic mixtures with known
+fractions (see synthetic_mixtures and deconvolution_benchmark), times the
+functions on the hot path of the objective (see microbenchmarks) and
+compares stored results of different versions, e.g. commits, of cellanneal
+(see compare_benchmarks). The command line entry point cellanneal-benchmark
+runs and compares these benchmarks."""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from hashlib import sha256
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame
+
+from . import __version__
+from .dual_annealing import dual_annealing
+from .general import ENGINES, calculate_distance, calculate_distance_batch
+from .general import deconvolve
+from .general import make_gene_dictionary, nnls_mixture, sample_digest
+from .general import sample_seed_sequence
+from .objective import MixtureObjective, rankdata
+from .readers import read_expression_data
+from .selection import gene_positions
+from .telemetry import QuietSink
+
+
+# modules which cellanneal must only import when they are used
+LAZY_MODULES = ["matplotlib", "seaborn", "scipy.stats", "openpyxl", "xlrd"]
+
+
+class CountingObjective(object):
+    """Wraps a `MixtureObjective`, counts objective evaluations and records
+    after how many evaluations a target distance was first reached."""
+
+    def __init__(self, objective, target_distance):
+        self.objective = objective
+        self.target_distance = target_distance
+        self.nfev = 0
+        self.nfev_to_target = None
+        self.best = np.inf
+
+    def _record(self, dist):
+        dist = np.atleast_1d(dist)
+        if self.nfev_to_target is None:
+            reached = np.nonzero(dist <= self.target_distance)[0]
+            if len(reached) > 0:
+                self.nfev_to_target = self.nfev + reached[0] + 1
+        self.nfev += len(dist)
+        self.best = min(self.best, np.min(dist))
+
+    def __call__(self, params):
+        dist = self.objective(params)
+        self._record(dist)
+        return dist
+
+    def coordinate_moves(self, x, indices, values):
+        dist = self.objective.coordinate_moves(x, indices, values)
+        self._record(dist)
+        return dist
+
+
+def warm_start_benchmark(
+    celltype_df,
+    bulk_df,
+    gene_dict,
+    target_rho,
+    maxiter=1000,
+    seed=0,
+    scale="sqrt",
+):
+    """For each sample in bulk_df, counts the objective evaluations which
+    dual annealing needs to reach a Spearman correlation of target_rho,
+    starting from a random point and from the non-negative least squares
+    estimate of nnls_mixture (warm start). Annealing stops as soon as the
+    target is reached. Returns a dataframe with the evaluation counts (NaN
+    if the target was not reached within maxiter), the best correlation and
+    the run time of both variants per sample; the warm start times include
+    the least squares fit."""
+    rows = []
+    for bulk in sorted(bulk_df.columns):
+        bulk_sub = bulk_df[bulk].values[gene_positions(gene_dict, bulk, bulk_df.index)]
+        gene_idx = gene_positions(gene_dict, bulk, celltype_df.index)
+        sc_sub = celltype_df.values[gene_idx]
+        seed_seq = sample_seed_sequence(seed, sample_digest(gene_idx, bulk_sub))
+        row = {}
+        for label in ["random", "warm"]:
+            start = time.perf_counter()
+            x0 = (
+                nnls_mixture(sc_sub, bulk_sub, scale=scale) if label == "warm" else None
+            )
+            counter = CountingObjective(
+                MixtureObjective(sc_sub, bulk_sub), 1 - target_rho
+            )
+            dual_annealing(
+                counter,
+                bounds=[[0, 1] for x in range(sc_sub.shape[1])],
+                maxiter=maxiter,
+                vectorized=True,
+                coordinate_update=counter.coordinate_moves,
+                seed=seed_seq,
+                callback=lambda x, f, context: f <= 1 - target_rho,
+                x0=x0,
+            )
+            row["nfev_" + label] = counter.nfev_to_target
+            row["rho_" + label] = 1 - counter.best
+            row["time_" + label] = time.perf_counter() - start
+        rows.append(row)
+
+    bench_df = DataFrame(rows, index=sorted(bulk_df.columns), dtype=float)
+    return bench_df
+
+
+def warm_start_summary(bench_df):
+    """Summarises the result of warm_start_benchmark: for random and warm
+    starts, the fraction of samples which reached the target (reached),
+    the median number of evaluations of these samples (nfev) and the mean
+    run time per sample (time)."""
+    summary = {}
+    for label in ["random", "warm"]:
+        nfev = bench_df["nfev_" + label]
+        summary["reached_" + label] = float(nfev.notna().mean())
+        summary["nfev_" + label] = float(nfev.median())
+        summary["time_" + label] = float(bench_df["time_" + label].mean())
+    return summary
+
+
+def startup_benchmark(statement="import cellanneal", repeat=5):
+    """Runs statement, e.g. an import, in repeat fresh python interpreters.
+    Returns the shortest time it took in seconds and the list of
+    LAZY_MODULES which it loaded."""
+    code = "\n".join(
+        [
+            "import sys, time",
+            "start = time.perf_counter()",
+            statement,
+            "print(time.perf_counter() - start)",
+            "print(','.join(m for m in {!r} if m in sys.modules))".format(LAZY_MODULES),
+        ]
+    )
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        times.append(float(output[-2]))
+        loaded = [module for module in output[-1].split(",") if module]
+    return min(times), loaded
+
+
+def check_startup(max_time=None, statement="import cellanneal", repeat=5):
+    """Guards against regressions of the start-up time: raises a RuntimeError
+    if statement loads any of LAZY_MODULES or, if max_time is given, takes
+    longer than max_time seconds (see startup_benchmark). Returns the time."""
+    best, loaded = startup_benchmark(statement, repeat=repeat)
+    if loaded:
+        raise RuntimeError(
+            "{} loads {}, which should be imported on first use.".format(
+                statement, ", ".join(loaded)
+            )
+        )
+    if max_time is not None and best > max_time:
+        raise RuntimeError(
+            "{} took {:.2f} s, more than {:.2f} s.".format(statement, best, max_time)
+        )
+    return best
+
+
+def synthetic_mixtures(
+    celltype_df,
+    n_samples=20,
+    n_genes=None,
+    n_celltypes=None,
+    noise=0.1,
+    seed=0,
+):
+    """Generates mixtures of the signature profiles in celltype_df with
+    known fractions.
+
+    Input:
+    celltype_df  -  signature data with genes as rows and cell types as
+                    columns
+    n_samples  -  number of mixtures
+    n_genes  -  number of genes, drawn at random from the signature data;
+                all genes if None
+    n_celltypes  -  number of cell types, drawn at random from the signature
+                    data; all cell types if None
+    noise  -  standard deviation of the log-normal noise by which each
+              gene's mixed expression is multiplied, 0 for exact mixtures
+    seed  -  random seed, the same seed gives the same data
+
+    Output:
+    bulk_df  -  mixture data with the drawn genes as rows and one column per
+                mixture
+    signature_df  -  signature data of the drawn genes and cell types, from
+                     which the mixtures were made
+    fractions_df  -  true fractions with mixtures as rows and cell types as
+                     columns
+
+    Fractions are drawn uniformly from the simplex of mixtures."""
+    rng = np.random.default_rng(seed)
+    n_genes = len(celltype_df.index) if n_genes is None else n_genes
+    n_celltypes = len(celltype_df.columns) if n_celltypes is None else n_celltypes
+    if n_genes > len(celltype_df.index) or n_celltypes > len(celltype_df.columns):
+        raise ValueError("The signature data has fewer genes or cell types.")
+    genes = np.sort(rng.choice(len(celltype_df.index), n_genes, replace=False))
+    celltypes = np.sort(
+        rng.choice(len(celltype_df.columns), n_celltypes, replace=False)
+    )
+    signature_df = celltype_df.iloc[genes, celltypes].astype(np.float64)
+    samples = ["synthetic_{:05d}".format(i) for i in range(n_samples)]
+
+    fractions = rng.dirichlet(np.ones(n_celltypes), size=n_samples)
+    mixed = np.dot(signature_df.values, fractions.T)
+    if noise > 0:
+        mixed *= rng.lognormal(sigma=noise, size=mixed.shape)
+    bulk_df = DataFrame(mixed, index=signature_df.index, columns=samples)
+    fractions_df = DataFrame(
+        fractions, index=samples, columns=signature_df.columns.tolist()
+    )
+    return bulk_df, signature_df, fractions_df
+
+
+def peak_rss():
+    """Peak resident set size in bytes of the current process and of the
+    largest of its finished child processes (e.g. pool workers), None where
+    it cannot be measured."""
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+def fraction_errors(all_mix_df, fractions_df):
+    """Errors of the estimated fractions in all_mix_df (as returned by
+    deconvolve) against the true fractions_df: mean absolute error, root
+    mean squared error and the mean over samples of the Pearson correlation
+    between true and estimated fractions. Failed samples are left out."""
+    estimated = all_mix_df.loc[fractions_df.index, fractions_df.columns].values
+    true = fractions_df.values
+    ok = ~np.isnan(estimated).any(axis=1)
+    estimated, true = estimated[ok], true[ok]
+    diff = estimated - true
+    with np.errstate(invalid="ignore"):
+        r = [np.corrcoef(e, t)[0, 1] for e, t in zip(estimated, true)]
+    return {
+        "mae": float(np.mean(np.abs(diff))),
+        "rmse": float(np.sqrt(np.mean(diff**2))),
+        "pearson_r": float(np.nanmean(r)),
+        "n_failed": int(np.sum(~ok)),
+    }
+
+
+def deconvolution_benchmark(
+    signature_df, bulk_df, fractions_df, maxiter=1000, n_jobs=1, seed=0, **kwargs
+):
+    """Selects gene sets for and deconvolves the mixtures in bulk_df (e.g.
+    from synthetic_mixtures) and measures the run. Further keyword arguments
+    are passed on to deconvolve. Returns a dict with the wall time of gene
+    set selection and deconvolution, the deconvolved samples and objective
+    evaluations per second, the peak RSS of the process (and of its pool
+    workers) and the errors against the true fractions_df (see
+    fraction_errors)."""
+    events = QuietSink()
+    start = time.perf_counter()
+    gene_dict = make_gene_dictionary(signature_df, bulk_df, events=events)
+    gene_set_time = time.perf_counter() - start
+    start = time.perf_counter()
+    all_mix_df, info_df = deconvolve(
+        signature_df,
+        bulk_df,
+        maxiter,
+        gene_dict,
+        n_jobs=n_jobs,
+        seed=seed,
+        return_info=True,
+        events=events,
+        **kwargs
+    )
+    deconvolution_time = time.perf_counter() - start
+    nfev = float(np.nansum(info_df["nfev"].values.astype(float)))
+    rss, rss_workers = peak_rss()
+    result = {
+        "n_samples": len(bulk_df.columns),
+        "gene_set_time": gene_set_time,
+        "deconvolution_time": deconvolution_time,
+        "samples_per_s": len(bulk_df.columns) / deconvolution_time,
+        "nfev": nfev,
+        "nfev_per_s": nfev / deconvolution_time,
+        "peak_rss_mb": rss / 1024**2 if rss is not None else None,
+        "peak_rss_workers_mb": (
+            rss_workers / 1024**2 if rss_workers is not None and n_jobs != 1 else None
+        ),
+    }
+    result.update(fraction_errors(all_mix_df, fractions_df))
+    return result
+
+
+def _time_per_call(func, repeat):
+    # shortest time per call in seconds over repeat rounds of timeit
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def microbenchmarks(signature_df, bulk_vec, repeat=5, block_size=16, seed=0):
+    """Times the functions on the hot path of the objective on the genes of
+    signature_df and the bulk expression bulk_vec: rankdata of a mixed
+    expression vector, calculate_distance of a single mixture,
+    calculate_distance_batch of a block of block_size mixtures and the
+    compiled MixtureObjective on a single mixture, a block and a block of
+    single-coordinate moves. Returns a dict of seconds per call."""
+    rng = np.random.default_rng(seed)
+    sc_data = np.ascontiguousarray(signature_df.values, dtype=np.float64)
+    bulk_vec = np.asarray(bulk_vec, dtype=np.float64)
+    bulk_ranked = rankdata(bulk_vec)
+    n_celltypes = sc_data.shape[1]
+    params = rng.random(n_celltypes)
+    params_block = rng.random((block_size, n_celltypes))
+    mixed = np.dot(sc_data, params)
+    objective = MixtureObjective(sc_data, bulk_vec)
+    indices = rng.integers(n_celltypes, size=block_size)
+    values = rng.random(block_size)
+    return {
+        "rankdata": _time_per_call(lambda: rankdata(mixed), repeat),
+        "calculate_distance": _time_per_call(
+            lambda: calculate_distance(params, bulk_ranked, sc_data), repeat
+        ),
+        "calculate_distance_batch": _time_per_call(
+            lambda: calculate_distance_batch(params_block, bulk_ranked, sc_data),
+            repeat,
+        ),
+        "objective": _time_per_call(lambda: objective(params), repeat),
+        "objective_block": _time_per_call(lambda: objective(params_block), repeat),
+        "objective_coordinate_moves": _time_per_call(
+            lambda: objective.coordinate_moves(params, indices, values), repeat
+        ),
+    }
+
+
+def _git_commit(path):
+    # commit of the git checkout holding path, None outside of a checkout
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=path,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def run_benchmarks(
+    signature_df,
+    n_samples=20,
+    n_genes=None,
+    n_celltypes=None,
+    noise=0.1,
+    seed=0,
+    maxiter=1000,
+    n_jobs=1,
+    repeat=5,
+    micro=True,
+    target_rho=None,
+    **kwargs
+):
+    """Generates synthetic mixtures from signature_df (see
+    synthetic_mixtures), deconvolves them (see deconvolution_benchmark,
+    further keyword arguments are passed on to deconvolve) and, if micro is
+    True, runs the microbenchmarks on the first mixture. Given target_rho,
+    the evaluations needed to reach this Spearman correlation from a random
+    and from a warm start (with the scale of warm_start, 'sqrt' if None)
+    are counted as well (see warm_start_benchmark), summarised under
+    warm_start and per sample under warm_start_samples. Returns a dict of
+    the results together with the settings, a digest of the synthetic data
+    and the version, commit and platform they were obtained with, ready to
+    be stored as JSON and compared with compare_benchmarks."""
+    bulk_df, signature_sub, fractions_df = synthetic_mixtures(
+        signature_df,
+        n_samples=n_samples,
+        n_genes=n_genes,
+        n_celltypes=n_celltypes,
+        noise=noise,
+        seed=seed,
+    )
+    results = {
+        "version": __version__,
+        "commit": _git_commit(Path(__file__).parent),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "settings": dict(
+            n_samples=n_samples,
+            n_genes=len(bulk_df.index),
+            n_celltypes=len(fractions_df.columns),
+            noise=noise,
+            seed=seed,
+            maxiter=maxiter,
+            n_jobs=n_jobs,
+            target_rho=target_rho,
+            **kwargs
+        ),
+        "data_digest": sha256(
+            np.ascontiguousarray(bulk_df.values).tobytes()
+        ).hexdigest(),
+        "deconvolution": deconvolution_benchmark(
+            signature_sub,
+            bulk_df,
+            fractions_df,
+            maxiter=maxiter,
+            n_jobs=n_jobs,
+            seed=seed,
+            **kwargs
+        ),
+    }
+    if micro:
+        results["micro"] = microbenchmarks(
+            signature_sub, bulk_df.iloc[:, 0].values, repeat=repeat, seed=seed
+        )
+    if target_rho is not None:
+        gene_dict = make_gene_dictionary(signature_sub, bulk_df, events=QuietSink())
+        bench_df = warm_start_benchmark(
+            signature_sub,
+            bulk_df,
+            gene_dict,
+            target_rho,
+            maxiter=maxiter,
+            seed=seed,
+            scale=kwargs.get("warm_start") or "sqrt",
+        )
+        results["warm_start"] = warm_start_summary(bench_df)
+        # samples which did not reach the target are stored as null
+        results["warm_start_samples"] = (
+            bench_df.astype(object).where(bench_df.notna(), None).to_dict("index")
+        )
+    return results
+
+
+def compare_benchmarks(results_list, labels=None):
+    """Compares benchmark results (dicts as returned by run_benchmarks, e.g.
+    of different commits). Returns a dataframe with the metrics as rows and
+    one column per result, labelled by the short commit hash unless labels
+    are given, and a column with the relative change of the last result
+    compared to the first."""
+    if labels is None:
+        labels = [
+            (results.get("commit") or "result {}".format(i))[:10]
+            for i, results in enumerate(results_list)
+        ]
+        # results of the same commit are told apart by their position
+        labels = [
+            "{} ({})".format(label, i) if labels.count(label) > 1 else label
+            for i, label in enumerate(labels)
+        ]
+    columns = {}
+    for label, results in zip(labels, results_list):
+        metrics = {}
+        for section in ["deconvolution", "micro", "warm_start"]:
+            for name, value in results.get(section, {}).items():
+                metrics["{}: {}".format(section, name)] = value
+        columns[label] = metrics
+    compare_df = DataFrame(columns, dtype=float)
+    if len(results_list) > 1:
+        first, last = compare_df.iloc[:, 0], compare_df.iloc[:, -1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            compare_df["change"] = (last - first) / first.abs()
+    return compare_df
+
+
+def init_parser(parser):
+    """Initialize parser arguments."""
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run", help="Benchmark deconvolution on synthetic mixtures."
+    )
+    run_parser.add_argument(
+        "celltype_data_path",
+        type=str,
+        help=("""Path to the signature data from which mixtures are made."""),
+    )
+    run_parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help=("""Path of a .json file in which to store the results."""),
+    )
+    run_parser.add_argument(
+        "--n_samples", type=int, default=20, help="""Number of mixtures."""
+    )
+    run_parser.add_argument(
+        "--n_genes",
+        type=int,
+        default=None,
+        help="""Number of genes drawn from the signature data (default all).""",
+    )
+    run_parser.add_argument(
+        "--n_celltypes",
+        type=int,
+        default=None,
+        help="""Number of cell types drawn from the signature data (default
+        all).""",
+    )
+    run_parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.1,
+        help="""Standard deviation of the log-normal noise of the mixtures.""",
+    )
+    run_parser.add_argument(
+        "--seed", type=int, default=0, help="""Seed of data and deconvolution."""
+    )
+    run_parser.add_argument(
+        "--maxiter", type=int, default=1000, help="""Maximum number of iterations."""
+    )
+    run_parser.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="anneal",
+        help="""Deconvolution engine.""",
+    )
+    run_parser.add_argument(
+        "--simplex", action="store_true", help="""Anneal on the simplex."""
+    )
+    run_parser.add_argument(
+        "--warm_start",
+        type=str,
+        choices=["sqrt", "log"],
+        default=None,
+        help="""Start annealing from a least squares estimate.""",
+    )
+    run_parser.add_argument(
+        "--jobs", type=int, default=1, help="""Number of processes."""
+    )
+    run_parser.add_argument(
+        "--target_rho",
+        type=float,
+        default=None,
+        help="""Also count the objective evaluations needed to reach this
+        Spearman correlation from a random and from a warm start.""",
+    )
+    run_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="""Number of rounds of each microbenchmark.""",
+    )
+    run_parser.add_argument(
+        "--no_micro",
+        action="store_true",
+        help="""Skip the microbenchmarks.""",
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare stored benchmark results."
+    )
+    compare_parser.add_argument(
+        "result_paths",
+        type=str,
+        nargs="+",
+        help="""Paths of .json files written by the run command, e.g. for
+        different commits.""",
+    )
+
+    return parser
+
+
+def _print_table(df):
+    with_change = "change" in df.columns
+    print(
+        df.to_string(
+            float_format=lambda x: "{:.4g}".format(x),
+            formatters={"change": "{:+.1%}".format} if with_change else None,
+        )
+    )
+
+
+def main():
+    """Runs the benchmark suite or compares stored results."""
+    my_parser = argparse.ArgumentParser(
+        description=("cellanneal-benchmark measures speed and accuracy.")
+    )
+    args = init_parser(my_parser).parse_args()
+
+    if args.command == "compare":
+        results_list = []
+        for path in args.result_paths:
+            with open(path) as f:
+                results_list.append(json.load(f))
+        if len(set(results.get("data_digest") for results in results_list)) > 1:
+            print("Warning: the results were obtained on different data.\n")
+        _print_table(compare_benchmarks(results_list))
+        return
+
+    print("\n+++ Benchmarking cellanneal ... +++\n")
+    celltype_df = read_expression_data(Path(args.celltype_data_path))
+    results = run_benchmarks(
+        celltype_df,
+        n_samples=args.n_samples,
+        n_genes=args.n_genes,
+        n_celltypes=args.n_celltypes,
+        noise=args.noise,
+        seed=args.seed,
+        maxiter=args.maxiter,
+        n_jobs=args.jobs,
+        repeat=args.repeat,
+        micro=not args.no_micro,
+        target_rho=args.target_rho,
+        engine=args.engine,
+        simplex=args.simplex,
+        warm_start=args.warm_start,
+    )
+    _print_table(compare_benchmarks([results], labels=["result"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("\n+++ Results stored in {} +++".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
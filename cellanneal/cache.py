@@ -0,0 +1,238 @@
+"""Content-addressed on-disk cache of per-sample deconvolution results and of
+the per-gene statistics of signature data.
+
+A result is stored under a hash of everything it depends on: the sample's
+bulk vector and gene set, the signature data, the deconvolution parameters
+and the sample's random stream. Repeated runs over growing cohorts therefore
+only deconvolve samples which are new or whose inputs have changed.
+
+Imported data files are kept as well, as binary copies which later runs
+memory-map instead of parsing the file again (see InputCache)."""
+
+import json
+import os
+from hashlib import sha256
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame, Index
+
+
+# bump when the deconvolution procedure changes in a way that alters results
+CACHE_VERSION = b"cellanneal-result-cache-2"
+# bump when the import of data files changes
+INPUT_CACHE_VERSION = b"cellanneal-input-cache-1"
+
+
+def hash_frame(df):
+    """Digest of a dataframe's values, row and column labels."""
+    h = sha256()
+    h.update(np.ascontiguousarray(df.values, dtype=np.float64).tobytes())
+    h.update("\0".join(map(str, df.index)).encode("utf-8"))
+    h.update(b"\1")
+    h.update("\0".join(map(str, df.columns)).encode("utf-8"))
+    return h.digest()
+
+
+class ResultCache(object):
+    """
+    Directory of cached per-sample results, one .npy file per key.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory in which results are stored, it is created if needed.
+    max_size : int, optional
+        Maximum total size of the cache in bytes. When exceeded, `evict`
+        removes the least recently used results. Default is 1 GB.
+    """
+
+    def __init__(self, path, max_size=1024**3):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        # lookup statistics of this cache instance
+        self.hits = 0
+        self.misses = 0
+
+    def sample_key(self, signature_digest, genes_digest, bulk_vec, params, seed_seq):
+        """Hex key of a single sample's result. `signature_digest` is the
+        `hash_frame` digest of the signature data, `genes_digest` the digest
+        of the sample's selected genes (see `GeneSelection.digest`) and
+        `params` a dict of all parameters which influence the result."""
+        h = sha256(CACHE_VERSION)
+        h.update(signature_digest)
+        h.update(genes_digest)
+        h.update(np.ascontiguousarray(bulk_vec, dtype=np.float64).tobytes())
+        h.update(repr(sorted(params.items())).encode("utf-8"))
+        h.update(repr((seed_seq.entropy, seed_seq.spawn_key)).encode("utf-8"))
+        return h.hexdigest()
+
+    def gene_stats_key(self, signature_digest):
+        """Hex key of the per-gene dispersion statistics of the signature data
+        with `hash_frame` digest `signature_digest`."""
+        h = sha256(CACHE_VERSION)
+        h.update(b"gene-stats")
+        h.update(signature_digest)
+        return h.hexdigest()
+
+    def _file(self, key):
+        return self.path / key[:2] / (key + ".npy")
+
+    def get(self, key):
+        """Returns the cached result for `key`, or None."""
+        result = self.load(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def load(self, key):
+        """Same as `get`, without counting the lookup in the statistics."""
+        file = self._file(key)
+        try:
+            result = np.load(file)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used for eviction
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """Stores `result` under `key`."""
+        file = self._file(key)
+        file.parent.mkdir(exist_ok=True)
+        # write to a temporary file first so that concurrent runs never see
+        # partially written results
+        tmp_file = file.with_name("{}.{}.tmp".format(file.stem, os.getpid()))
+        with open(tmp_file, "wb") as f:
+            np.save(f, np.asarray(result))
+        os.replace(tmp_file, file)
+
+    def size(self):
+        """Total size of all cached results in bytes."""
+        return sum(f.stat().st_size for f in self.path.glob("*/*.npy"))
+
+    def evict(self):
+        """Removes least recently used results until the cache is no larger
+        than `max_size`. Returns the number of removed results."""
+        entries = []
+        for f in self.path.glob("*/*.npy"):
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        total = sum(size for _, size, _ in entries)
+        n_removed = 0
+        for _, size, f in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_size:
+                break
+            try:
+                f.unlink()
+            except OSError:
+                continue
+            total -= size
+            n_removed += 1
+        return n_removed
+
+
+class InputCache(object):
+    """
+    Binary copies of imported (normalised) data files, stored in the
+    subfolder "inputs" of a cache directory.
+
+    Parameters
+    ----------
+    path : str or Path
+        Cache directory, typically the one of a `ResultCache`.
+
+    Each copy consists of the values as a .npy file, which is memory-mapped
+    on loading, and of the gene and sample names. A copy is only used while
+    the size and modification time of its source file are unchanged; it is
+    replaced when the source file is imported again after a change. Input
+    copies do not count towards the size limit of the result cache.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path) / "inputs"
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def key(self, source, columns=None, dtype=np.float64):
+        """Hex key of the copy of data file `source` read with `columns` and
+        `dtype` (see `readers.read_expression_data`)."""
+        h = sha256(INPUT_CACHE_VERSION)
+        h.update(str(Path(source).resolve()).encode("utf-8"))
+        h.update(np.dtype(dtype).str.encode("utf-8"))
+        if columns is not None:
+            h.update("\0".join(map(str, columns)).encode("utf-8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def _source_state(source):
+        stat = Path(source).stat()
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self, key, source):
+        """Returns the copy stored under `key` as a dataframe backed by a
+        read-only memory map, or None if there is no copy or `source` has
+        changed since it was made."""
+        folder = self.path / key
+        try:
+            with open(folder / "meta.json") as f:
+                meta = json.load(f)
+            if meta["source"] != self._source_state(source):
+                return None
+            values = np.load(folder / "values.npy", mmap_mode="r")
+            genes = np.load(folder / "genes.npy")
+            samples = np.load(folder / "samples.npy")
+        except (OSError, ValueError, KeyError):
+            return None
+        if values.shape != (len(genes), len(samples)):
+            return None
+        return DataFrame(
+            values,
+            index=Index(genes, dtype=object, name=meta["index_name"]),
+            columns=Index(samples, dtype=object, name=meta["columns_name"]),
+            copy=False,
+        )
+
+    def put(self, key, source, df):
+        """Stores a copy of dataframe `df`, imported from `source`, under
+        `key`. Dataframes whose gene or sample names are not all strings are
+        not stored. Returns whether the copy was stored."""
+        labels = [df.index, df.columns]
+        if not all(label.inferred_type in ["string", "empty"] for label in labels):
+            return False
+        folder = self.path / key
+        folder.mkdir(exist_ok=True)
+        # invalidate an existing copy before its files are replaced
+        try:
+            (folder / "meta.json").unlink()
+        except FileNotFoundError:
+            pass
+        arrays = {
+            "values.npy": np.ascontiguousarray(df.values),
+            "genes.npy": np.asarray(df.index, dtype=str),
+            "samples.npy": np.asarray(df.columns, dtype=str),
+        }
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        for name, array in arrays.items():
+            tmp_file = folder / (name + tmp_suffix)
+            with open(tmp_file, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_file, folder / name)
+        meta = {
+            "source": self._source_state(source),
+            "index_name": df.index.name,
+            "columns_name": df.columns.name,
+        }
+        tmp_file = folder / ("meta.json" + tmp_suffix)
+        with open(tmp_file, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, folder / "meta.json")
+        return True
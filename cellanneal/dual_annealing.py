@@ -16,6 +16,8 @@ A Dual Annealing global optimization algorithm
 
 from __future__ import division, print_function, absolute_import
 
+from collections import deque
+
 import numpy as np
 from scipy.optimize import OptimizeResult
 from scipy.optimize import minimize
@@ -253,6 +255,9 @@ class StrategyChain(object):
         of the created random generator container.
     energy_state: EnergyState
         Instance of `EnergyState` class.
+    batch_size : int, optional
+        Maximum number of chain steps whose candidate locations are generated
+        and evaluated together as one block. Default value is 1.
     """
 
     def __init__(
@@ -263,6 +268,7 @@ class StrategyChain(object):
         minimizer_wrapper,
         rand_state,
         energy_state,
+        batch_size=1,
     ):
         # Local strategy chain minimum energy and location
         self.emin = energy_state.current_energy
@@ -282,6 +288,10 @@ class StrategyChain(object):
         self._rand_state = rand_state
         self.temperature_step = 0
         self.K = 100 * len(energy_state.current_location)
+        # candidates are evaluated in blocks; the block size adapts between
+        # 1 and batch_size depending on how often the chain moves
+        self.batch_size = max(int(batch_size), 1)
+        self.block_size = 1
 
     def accept_reject(self, j, e, x_visit):
         r = self._rand_state.random_sample()
@@ -294,7 +304,8 @@ class StrategyChain(object):
             pqv = 0.0
         else:
             pqv = np.exp(np.log(pqv_temp) / (1.0 - self.acceptance_param))
-        if r <= pqv:
+        accepted = r <= pqv
+        if accepted:
             # We accept the new location and update state
             self.energy_state.update_current(e, x_visit)
             self.xmin = np.copy(self.energy_state.current_location)
@@ -304,36 +315,69 @@ class StrategyChain(object):
             if j == 0 or self.energy_state.current_energy < self.emin:
                 self.emin = self.energy_state.current_energy
                 self.xmin = np.copy(self.energy_state.current_location)
+        return accepted
 
     def run(self, step, temperature):
         self.temperature_step = temperature / float(step + 1)
         self.not_improved_idx += 1
-        for j in range(self.energy_state.current_location.size * 2):
-            if j == 0:
-                if step == 0:
-                    self.energy_state_improved = True
-                else:
-                    self.energy_state_improved = False
-            x_visit = self.visit_dist.visiting(
-                self.energy_state.current_location, j, temperature
+        if step == 0:
+            self.energy_state_improved = True
+        else:
+            self.energy_state_improved = False
+        dim = self.energy_state.current_location.size
+        chain_length = dim * 2
+        j = 0
+        while j < chain_length:
+            # Generate a block of candidates from the current location, they
+            # remain valid until the chain moves to a new location. Blocks do
+            # not mix steps changing all coordinates with steps changing one.
+            block_end = dim if j < dim else chain_length
+            n_block = min(self.block_size, block_end - j)
+            x_block = np.array(
+                [
+                    self.visit_dist.visiting(
+                        self.energy_state.current_location, j + k, temperature
+                    )
+                    for k in range(n_block)
+                ]
             )
-            # Calling the objective function
-            e = self.func_wrapper.fun(x_visit)
-            if e < self.energy_state.current_energy:
-                # We have got a better energy value
-                self.energy_state.update_current(e, x_visit)
-                if e < self.energy_state.ebest:
-                    val = self.energy_state.update_best(e, x_visit, 0)
-                    if val is not None:
-                        if val:
-                            return val
-                    self.energy_state_improved = True
-                    self.not_improved_idx = 0
+            # Calling the objective function once for the whole block
+            if j < dim:
+                e_block = self.func_wrapper.fun_batch(x_block)
             else:
-                # We have not improved but do we accept the new location?
-                self.accept_reject(j, e, x_visit)
-            if self.func_wrapper.nfev >= self.func_wrapper.maxfun:
-                return "Maximum number of function call reached " "during annealing"
+                e_block = self.func_wrapper.fun_coordinates(
+                    self.energy_state.current_location,
+                    np.arange(j, j + n_block) - dim,
+                    x_block,
+                )
+            moved = False
+            for x_visit, e in zip(x_block, e_block):
+                if e < self.energy_state.current_energy:
+                    # We have got a better energy value
+                    self.energy_state.update_current(e, x_visit)
+                    moved = True
+                    if e < self.energy_state.ebest:
+                        val = self.energy_state.update_best(e, x_visit, 0)
+                        if val is not None:
+                            if val:
+                                return val
+                        self.energy_state_improved = True
+                        self.not_improved_idx = 0
+                else:
+                    # We have not improved but do we accept the new location?
+                    moved = self.accept_reject(j, e, x_visit)
+                j += 1
+                if self.func_wrapper.nfev >= self.func_wrapper.maxfun:
+                    return "Maximum number of function call reached " "during annealing"
+                if moved:
+                    # remaining candidates of this block are outdated
+                    break
+            # Shrink the block while the chain keeps moving, grow it while
+            # all candidates are rejected
+            if moved:
+                self.block_size = max(self.block_size // 2, 1)
+            else:
+                self.block_size = min(self.block_size * 2, self.batch_size)
         # End of StrategyChain loop
 
     def local_search(self):
@@ -387,10 +431,65 @@ class StrategyChain(object):
                 )
 
 
+class ConvergenceCheck(object):
+    """
+    Class used to stop the annealing early once the best energy has
+    converged, judged by its history over the last iterations.
+    Parameters
+    ----------
+    stop_iter : int
+        Number of iterations over which the improvement of the best energy
+        is assessed.
+    stop_tol : float
+        Stop if the best energy did not improve by more than `stop_tol`
+        within the last `stop_iter` iterations.
+    stop_rate : float or None
+        Stop if the relative improvement of the best energy per iteration,
+        averaged over the last `stop_iter` iterations, fell below
+        `stop_rate`. Not checked if None.
+    """
+
+    def __init__(self, stop_iter, stop_tol=0.0, stop_rate=None):
+        self.stop_iter = int(stop_iter)
+        if self.stop_iter < 1:
+            raise ValueError("stop_iter has to be a positive integer")
+        self.stop_tol = stop_tol
+        self.stop_rate = stop_rate
+        self.history = deque(maxlen=self.stop_iter + 1)
+
+    def update(self, ebest):
+        # record the best energy after an iteration, return a message if
+        # the annealing should stop
+        self.history.append(ebest)
+        if len(self.history) <= self.stop_iter:
+            return None
+        improvement = self.history[0] - ebest
+        if improvement <= self.stop_tol:
+            return (
+                "Best energy did not improve by more than {} within the "
+                "last {} iterations".format(self.stop_tol, self.stop_iter)
+            )
+        if self.stop_rate is not None:
+            rate = improvement / (
+                self.stop_iter * max(abs(self.history[0]), np.finfo(float).tiny)
+            )
+            if rate < self.stop_rate:
+                return (
+                    "Relative improvement rate of the best energy fell below "
+                    "{} per iteration".format(self.stop_rate)
+                )
+
+
 class ObjectiveFunWrapper(object):
-    def __init__(self, func, maxfun=1e7, *args):
+    def __init__(
+        self, func, maxfun=1e7, *args, vectorized=False, coordinate_update=None
+    ):
         self.func = func
         self.args = args
+        # If True, func takes a (K, n) block of locations and returns K values
+        self.vectorized = vectorized
+        # Optional incremental evaluation of single-coordinate moves
+        self.coordinate_update = coordinate_update
         # Number of objective function evaluations
         self.nfev = 0
         # Number of gradient function evaluation if used
@@ -401,8 +500,25 @@ class ObjectiveFunWrapper(object):
 
     def fun(self, x):
         self.nfev += 1
+        if self.vectorized:
+            return self.func(x[np.newaxis, :], *self.args)[0]
         return self.func(x, *self.args)
 
+    def fun_batch(self, x_block):
+        # Evaluate all rows of x_block, with a single call if possible
+        self.nfev += len(x_block)
+        if self.vectorized:
+            return np.asarray(self.func(x_block, *self.args))
+        return np.array([self.func(x, *self.args) for x in x_block])
+
+    def fun_coordinates(self, x, indices, x_block):
+        # Evaluate locations which differ from x only at one index each
+        if self.coordinate_update is None:
+            return self.fun_batch(x_block)
+        self.nfev += len(x_block)
+        values = x_block[np.arange(len(x_block)), indices]
+        return np.asarray(self.coordinate_update(x, indices, values, *self.args))
+
 
 class LocalSearchWrapper(object):
     """
@@ -413,6 +529,8 @@ class LocalSearchWrapper(object):
     LS_MAXITER_RATIO = 6
     LS_MAXITER_MIN = 100
     LS_MAXITER_MAX = 1000
+    # relative step size for finite-difference gradients
+    FD_REL_STEP = np.sqrt(np.finfo(np.float64).eps)
 
     def __init__(self, bounds, func_wrapper, **kwargs):
         self.func_wrapper = func_wrapper
@@ -433,11 +551,32 @@ class LocalSearchWrapper(object):
                 "maxiter": ls_max_iter,
             }
             self.kwargs["bounds"] = list(zip(self.lower, self.upper))
+            # With a vectorized objective, the finite-difference gradient
+            # is computed from a single block evaluation
+            if self.func_wrapper.vectorized:
+                self.kwargs["jac"] = True
+
+    def fun_and_grad(self, x):
+        # Forward differences as in scipy's '2-point' scheme, stepping
+        # backwards for components where the forward step leaves the bounds
+        sign_x = np.where(x >= 0, 1.0, -1.0)
+        h = self.FD_REL_STEP * sign_x * np.maximum(1.0, np.abs(x))
+        x_h = x + h
+        out_of_bounds = (x_h < self.lower) | (x_h > self.upper)
+        h[out_of_bounds] *= -1
+        h = (x + h) - x
+        x_block = np.vstack((x, x + np.diag(h)))
+        f_block = self.func_wrapper.fun_batch(x_block)
+        return f_block[0], (f_block[1:] - f_block[0]) / h
 
     def local_search(self, x, e):
         # Run local search from the given x location where energy value is e
         x_tmp = np.copy(x)
-        mres = self.minimizer(self.func_wrapper.fun, x, **self.kwargs)
+        if self.kwargs.get("jac") is True:
+            fun = self.fun_and_grad
+        else:
+            fun = self.func_wrapper.fun
+        mres = self.minimizer(fun, x, **self.kwargs)
         if "njev" in mres.keys():
             self.func_wrapper.ngev += mres.njev
         if "nhev" in mres.keys():
@@ -454,6 +593,11 @@ class LocalSearchWrapper(object):
             return e, x_tmp
 
 
+def _spawn_random_state(seed_seq):
+    # RandomState drawing from a new independent child stream of seed_seq
+    return np.random.RandomState(np.random.MT19937(seed_seq.spawn(1)[0]))
+
+
 def dual_annealing(
     func,
     bounds,
@@ -469,6 +613,14 @@ def dual_annealing(
     no_local_search=False,
     callback=None,
     x0=None,
+    vectorized=False,
+    batch_size=16,
+    coordinate_update=None,
+    stop_iter=None,
+    stop_tol=0.0,
+    stop_rate=None,
+    abort=None,
+    profile=None,
 ):
     """
     Find the global minimum of a function using Dual Annealing.
@@ -515,13 +667,15 @@ def dual_annealing(
         algorithm is in the middle of a local search, this number will be
         exceeded, the algorithm will stop just after the local search is
         done. Default value is 1e7.
-    seed : {int or `~numpy.random.mtrand.RandomState` instance}, optional
+    seed : {None, int, `~numpy.random.RandomState`, `~numpy.random.SeedSequence`}, optional
         If `seed` is not specified the `~numpy.random.mtrand.RandomState`
         singleton is used.
         If `seed` is an int, a new ``RandomState`` instance is used,
         seeded with `seed`.
         If `seed` is already a ``RandomState`` instance, then that
         instance is used.
+        If `seed` is a ``SeedSequence``, the annealing and each re-annealing
+        restart draw from their own independent child streams of it.
         Specify `seed` for repeatable minimizations. The random numbers
         generated with this seed only affect the visiting distribution
         function and new coordinates generation.
@@ -541,6 +695,48 @@ def dual_annealing(
         If the callback implementation returns True, the algorithm will stop.
     x0 : ndarray, shape(n,), optional
         Coordinates of a single n-dimensional starting point.
+    vectorized : bool, optional
+        If True, ``func`` is passed a 2-D array of shape ``(K, n)`` holding
+        ``K`` locations and must return an array of the ``K`` function
+        values. Candidates of the strategy chain and the finite-difference
+        gradient of the local search are then evaluated in blocks.
+        Default is False.
+    batch_size : int, optional
+        Maximum number of strategy chain candidates which are generated and
+        evaluated as one block. Candidates generated after the current
+        location changes are discarded, so the block size adapts between 1
+        and `batch_size` with the acceptance rate. Only used if `vectorized`
+        is True. Default value is 16.
+    coordinate_update : callable, optional
+        A function with signature
+        ``coordinate_update(x, indices, values, *args)`` which returns the
+        function values at the locations obtained from ``x`` by setting
+        ``x[indices[k]] = values[k]``, separately for each ``k``. If given,
+        it is used for the strategy chain steps which change a single
+        coordinate, allowing objectives to evaluate these moves
+        incrementally.
+    stop_iter : int, optional
+        If given, the annealing stops early once the best energy has
+        converged: when it did not improve by more than `stop_tol` within
+        the last `stop_iter` iterations, or when its relative improvement
+        per iteration over that window fell below `stop_rate`. The reason
+        is reported in ``message``. Default is None (no early stopping).
+    stop_tol : float, optional
+        Absolute tolerance for the improvement of the best energy within
+        `stop_iter` iterations. Default value is 0.
+    stop_rate : float, optional
+        Minimum relative improvement rate of the best energy per iteration.
+        Default is None (not checked).
+    abort : callable, optional
+        A function without arguments which is called after every iteration;
+        if it returns True, the search stops with the best solution found so
+        far and ``success`` set to False, e.g. to cancel a run from another
+        thread or process. Unlike `callback`, which is only called when a new
+        minimum is found, it is checked at a regular pace.
+    profile : Profile, optional
+        If given, the time spent in the objective function, the strategy
+        chain and the local search and the number of objective evaluations
+        of the local search are recorded in this `profiling.Profile`.
     Returns
     -------
     res : OptimizeResult
@@ -641,11 +837,22 @@ def dual_annealing(
         raise ValueError("Bounds do not have the same dimensions")
 
     # Wrapper for the objective function
-    func_wrapper = ObjectiveFunWrapper(func, maxfun, *args)
+    func_wrapper = ObjectiveFunWrapper(
+        func,
+        maxfun,
+        *args,
+        vectorized=vectorized,
+        coordinate_update=coordinate_update,
+    )
     # Wrapper fot the minimizer
     minimizer_wrapper = LocalSearchWrapper(bounds, func_wrapper, **local_search_options)
     # Initialization of RandomState for reproducible runs if seed provided
-    rand_state = check_random_state(seed)
+    if isinstance(seed, np.random.SeedSequence):
+        seed_seq = seed
+        rand_state = _spawn_random_state(seed_seq)
+    else:
+        seed_seq = None
+        rand_state = check_random_state(seed)
     # Initialization of the energy state
     energy_state = EnergyState(lower, upper, callback)
     energy_state.reset(func_wrapper, rand_state, x0)
@@ -656,8 +863,22 @@ def dual_annealing(
     visit_dist = VisitingDistribution(lower, upper, visit, rand_state)
     # Strategy chain instance
     strategy_chain = StrategyChain(
-        accept, visit_dist, func_wrapper, minimizer_wrapper, rand_state, energy_state
+        accept,
+        visit_dist,
+        func_wrapper,
+        minimizer_wrapper,
+        rand_state,
+        energy_state,
+        batch_size if vectorized else 1,
     )
+    if profile is not None:
+        profile.instrument_annealing(func_wrapper, strategy_chain, minimizer_wrapper)
+    # Early stopping based on convergence of the best energy
+    if stop_iter is not None:
+        convergence_check = ConvergenceCheck(stop_iter, stop_tol, stop_rate)
+        convergence_check.update(energy_state.ebest)
+    else:
+        convergence_check = None
     need_to_stop = False
     iteration = 0
     message = []
@@ -680,6 +901,13 @@ def dual_annealing(
                 break
             # Need a re-annealing process?
             if temperature < temperature_restart:
+                if seed_seq is not None:
+                    # the restart draws its start location, visits and
+                    # acceptances from a new child stream, independent of
+                    # how much of the stream the earlier segments used
+                    rand_state = _spawn_random_state(seed_seq)
+                    visit_dist.rand_state = rand_state
+                    strategy_chain._rand_state = rand_state
                 energy_state.reset(func_wrapper, rand_state)
                 break
             # starting strategy chain
@@ -698,6 +926,19 @@ def dual_annealing(
                     optimize_res.success = False
                     break
             iteration += 1
+            # Was the search cancelled?
+            if abort is not None and abort():
+                message.append("Aborted")
+                need_to_stop = True
+                optimize_res.success = False
+                break
+            # Has the best energy converged?
+            if convergence_check is not None:
+                val = convergence_check.update(energy_state.ebest)
+                if val is not None:
+                    message.append(val)
+                    need_to_stop = True
+                    break
 
     # Setting the OptimizeResult values
     optimize_res.x = energy_state.xbest
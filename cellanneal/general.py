@@ -1,12 +1,36 @@
+import time
 import numpy as np
-from pandas import DataFrame, cut, Series
+from pandas import DataFrame, Series
+from hashlib import sha256
 
 # functional requirements
 from scipy.spatial.distance import correlation
+from scipy.optimize import nnls
 
 # personalized dual_annealing function
 from .dual_annealing import dual_annealing
 
+# ranking and the compiled per-sample objective
+from .objective import rankdata, rankdata_rows, MixtureObjective
+from .objective import SimplexObjective, stick_breaking, inverse_stick_breaking
+
+# process pool with shared memory for parallel deconvolution
+from .parallel import imap_unordered, resolve_n_jobs, shared_array
+from .parallel import abort_requested, set_abort_event
+
+# on-disk cache of per-sample results
+from .cache import hash_frame
+
+# genes selected for each sample
+from .selection import GeneSelection, gene_positions, selected_genes
+from .store import BulkStore
+
+# progress events and their sinks
+from .telemetry import emit
+
+# optional measurement of the phases of each sample's deconvolution
+from .profiling import OBJECTIVE_PHASES, Profile, current_profile, set_profile
+
 # we choose to ignore warnings at this stage because console output is
 # part of the user experience - make sure to enable when developing
 import warnings
@@ -21,41 +45,59 @@ def make_gene_dictionary(
     bulk_min=1e-5,
     bulk_max=0.01,
     remove_mito=True,
+    cache=None,
+    high_var_genes=None,
+    events=None,
 ):
     """Finds highly variable genes across cell types and checks for expression
-    thresholds within each bulk separately, returns a dictionary of lists were
-    each list contains the identified gene for the bulk given as as they appear
-    __alphabetically sorted__ by column names.
+    thresholds within each bulk separately, returns a GeneSelection which
+    behaves like a dictionary of lists were each list contains the
+    identified gene for the bulk given as as they appear __alphabetically
+    sorted__ by column names.
     If n_high_var_genes is given, this number of highly variable genes is
     returned. If it is None, the default parameters for flavor='seurat' are
-    used and the length of the resulting gene list depends on availability."""
-    # order bulk columns alphabetically
-    bulk_df = bulk_df.sort_index(axis=1)
+    used and the length of the resulting gene list depends on availability.
+    cache is an optional ResultCache in which the dispersion statistics of
+    the signature data are kept for later runs. A list of previously found
+    high_var_genes can be passed to skip their identification, e.g. when
+    gene sets are built for chunks of samples.
+    events is the sink of the progress events (see telemetry.py), the
+    console if None."""
     # first, find the most variable genes across cell types
-    high_var_genes = find_high_var_genes(celltype_df, disp_min=disp_min)
-
-    print(
-        """{} highly variable genes identified in cell type
-        reference.""".format(
-            len(high_var_genes)
+    if high_var_genes is None:
+        high_var_genes = find_high_var_genes(
+            celltype_df, disp_min=disp_min, cache=cache
         )
-    )
+        emit(events, "high_var_genes", n_genes=len(high_var_genes))
 
     # now, for each bulk, we find the genes which comply with our expression
-    # thresholds, and then keep only those highly variable genes which do
-    # to ensure usage of correct gene list later one, store in dict
-    gene_dict = {}
-    for bulk in bulk_df.columns:
-        min_max_genes = find_thr_genes(
-            bulk_df[bulk], min_thr=bulk_min, max_thr=bulk_max, remove_mito=remove_mito
-        )
-        thr_highvar_genes = [x for x in min_max_genes if x in high_var_genes]
-        gene_dict[bulk] = thr_highvar_genes
-        print(
-            "\t{} of these are within thresholds for sample {}".format(
-                len(thr_highvar_genes), bulk
-            )
-        )
+    # thresholds, and then keep only those highly variable genes which do;
+    # masks over genes are computed once and combined for all bulks at once
+    genes = bulk_df.index
+    gene_mask = genes.isin(high_var_genes)
+    if remove_mito:
+        gene_mask &= ~is_mito_gene(genes)
+    # thresholds relative to each bulk's total expression, data in a
+    # BulkStore is processed block by block
+    if isinstance(bulk_df, BulkStore):
+        blocks = bulk_df.blocks()
+    else:
+        blocks = [bulk_df.values]
+    selected = []
+    for values in blocks:
+        colsum = np.nansum(values, axis=0)
+        with np.errstate(invalid="ignore"):
+            selected.append((values > colsum * bulk_min) & (values < colsum * bulk_max))
+    selected = np.hstack(selected) & gene_mask[:, np.newaxis]
+
+    # to ensure usage of correct gene list later one, store in a compact
+    # selection with bulk columns ordered alphabetically
+    bulk_names = bulk_df.columns.sort_values()
+    gene_dict = GeneSelection(
+        genes, bulk_names, selected[:, bulk_df.columns.get_indexer(bulk_names)]
+    )
+    for bulk, n_genes in zip(bulk_names, gene_dict.counts()):
+        emit(events, "gene_set", sample=bulk, n_genes=int(n_genes))
 
     return gene_dict
 
@@ -65,12 +107,21 @@ def calc_gene_expression(mix_vec, bulk_vec, celltype_df, gene_list):
     for this sample (i.e. all data only for one of the bulk samples),
     calculates the mixed expression and the fold change compared to the
     experimentally observed bulk expression and returns a dataframe with
-    these two values as well as the original bulk measurement."""
+    these two values as well as the original bulk measurement.
+    gene_list may also be a GeneSelection, in which case the genes selected
+    for the sample named like bulk_vec are used."""
+    if isinstance(gene_list, GeneSelection):
+        selection, sample = gene_list, bulk_vec.name
+        gene_list = selected_genes(selection, sample)
+    else:
+        selection, sample = {bulk_vec.name: gene_list}, bulk_vec.name
 
     # subset celltype_df and bulk_vec to the genes supplied in gene_list
-    bulk_vec_sub = bulk_vec.loc[gene_list].values
+    bulk_vec_sub = bulk_vec.values[gene_positions(selection, sample, bulk_vec.index)]
     bulk_vec_sub_comp = bulk_vec_sub / bulk_vec_sub.sum()
-    celltype_df_sub = celltype_df.loc[gene_list].values
+    celltype_df_sub = celltype_df.values[
+        gene_positions(selection, sample, celltype_df.index)
+    ]
 
     # calculate the mixed gene expression vector
     mixed_expression = np.dot(mix_vec, celltype_df_sub.T).T
@@ -97,22 +148,23 @@ def calc_gene_expression(mix_vec, bulk_vec, celltype_df, gene_list):
     return gene_comp_df
 
 
-def find_high_var_genes(
-    celltype_df,
-    disp_min=0.5,
-):
-    """Finds highly variable genes across cell types in celltype_df.
-    The implementation follows scanpy's highly_variable_genes procedure for
-    flavor 'Seurat'."""
+def gene_dispersion_stats(celltype_df):
+    """Computes the per-gene statistics of scanpy's highly_variable_genes
+    procedure for flavor 'Seurat' across the cell types in celltype_df.
+    Returns an array of shape (genes, 3) holding the log mean, the log
+    dispersion and the dispersion normalised within the gene's mean
+    expression bin (NaN where undefined)."""
+    values = np.asarray(celltype_df.values, dtype=np.float64)
+    n_types = values.shape[1]
     # normalize counts within each celltype to sum 1
-    sc_ref_norm = celltype_df.div(celltype_df.sum(axis=0), axis=1)
+    sc_ref_norm = values / values.sum(axis=0)
 
     # calculate mean and variance of each gene across types
-    mean = np.mean(sc_ref_norm, axis=1)
-    mean_of_sq = np.multiply(sc_ref_norm, sc_ref_norm).mean(axis=1)
+    mean = sc_ref_norm.mean(axis=1)
+    mean_of_sq = np.square(sc_ref_norm).mean(axis=1)
     var = mean_of_sq - mean**2
     # enforce R convention (unbiased estimator) for variance
-    var *= np.shape(sc_ref_norm)[1] / (np.shape(sc_ref_norm)[1] - 1)
+    var *= n_types / (n_types - 1)
     # set entries equal to zero to small value to avoid div by 0 value
     mean[mean == 0] = 1e-12
     # caculate dispersion from var and mean
@@ -120,50 +172,94 @@ def find_high_var_genes(
 
     # log versions of mean and dispersion are needed
     dispersion[dispersion == 0] = np.nan
-    dispersion = np.log(dispersion)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dispersion = np.log(dispersion)
     mean = np.log1p(mean)
 
-    # collect in a dataframe
-    df = DataFrame(index=sc_ref_norm.index)
-    df["means"] = mean
-    df["dispersions"] = dispersion
+    # group into 20 bins of equal width in mean expression, closed on the
+    # right, with the lowest edge extended by 0.1% of the range (as pandas'
+    # cut)
+    n_bins = 20
+    mn, mx = np.nanmin(mean), np.nanmax(mean)
+    if mn == mx:
+        mn -= 0.001 * abs(mn) if mn != 0 else 0.001
+        mx += 0.001 * abs(mx) if mx != 0 else 0.001
+        edges = np.linspace(mn, mx, n_bins + 1)
+    else:
+        edges = np.linspace(mn, mx, n_bins + 1)
+        edges[0] -= (mx - mn) * 0.001
+    mean_bin = np.searchsorted(edges, mean, side="left") - 1
+    mean_bin[np.isnan(mean) | (mean_bin < 0) | (mean_bin >= n_bins)] = -1
 
-    # group into 20 bins
-    df["mean_bin"] = cut(df["means"], bins=20)
-    disp_grouped = df.groupby("mean_bin")["dispersions"]
     # mean and std of dispersion in each group
-    disp_mean_bin = disp_grouped.mean()
-    disp_std_bin = disp_grouped.std(ddof=1)
-
-    # retrieve those genes that have nan std, these are the ones where
-    # only a single gene fell in the bin and implicitly set them to have
-    # a normalized disperion of 1
-    one_gene_per_bin = disp_std_bin.isnull()
-    disp_std_bin[one_gene_per_bin.values] = disp_mean_bin[
-        one_gene_per_bin.values
-    ].values
-    disp_mean_bin[one_gene_per_bin.values] = 0
+    valid = (mean_bin >= 0) & ~np.isnan(dispersion)
+    count = np.bincount(mean_bin[valid], minlength=n_bins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        disp_mean_bin = (
+            np.bincount(mean_bin[valid], weights=dispersion[valid], minlength=n_bins)
+            / count
+        )
+        sq_dev = np.bincount(
+            mean_bin[valid],
+            weights=(dispersion[valid] - disp_mean_bin[mean_bin[valid]]) ** 2,
+            minlength=n_bins,
+        )
+        disp_std_bin = np.where(count > 1, np.sqrt(sq_dev / (count - 1)), np.nan)
+
+    # those bins with nan std, where only a single gene fell in the bin,
+    # implicitly get a normalized disperion of 1
+    one_gene_per_bin = np.isnan(disp_std_bin)
+    disp_std_bin[one_gene_per_bin] = disp_mean_bin[one_gene_per_bin]
+    disp_mean_bin[one_gene_per_bin] = 0
 
     # normalize dispersions with respect to mean and std within each
-    # gene's expression bin
-    df["dispersions_norm"] = (
-        df["dispersions"].values - disp_mean_bin[df["mean_bin"].values].values
-    ) / disp_std_bin[df["mean_bin"].values].values
+    # gene's expression bin, genes outside all bins remain undefined
+    disp_mean_bin = np.append(disp_mean_bin, np.nan)
+    disp_std_bin = np.append(disp_std_bin, np.nan)
+    dispersion_norm = (dispersion - disp_mean_bin[mean_bin]) / disp_std_bin[mean_bin]
+
+    return np.column_stack((mean, dispersion, dispersion_norm))
+
+
+def find_high_var_genes(
+    celltype_df,
+    disp_min=0.5,
+    cache=None,
+):
+    """Finds highly variable genes across cell types in celltype_df.
+    The implementation follows scanpy's highly_variable_genes procedure for
+    flavor 'Seurat'. If cache (a ResultCache) is given, the per-gene
+    statistics (see gene_dispersion_stats) are stored under the content hash
+    of celltype_df and reused, so that only the threshold disp_min is
+    applied for a known signature."""
+    stats = None
+    if cache is not None:
+        stats_key = cache.gene_stats_key(hash_frame(celltype_df))
+        stats = cache.load(stats_key)
+        if stats is not None and stats.shape != (len(celltype_df.index), 3):
+            stats = None
+    if stats is None:
+        stats = gene_dispersion_stats(celltype_df)
+        if cache is not None:
+            cache.put(stats_key, stats)
 
     # check which genes pass dispersion and expression thresholds
-    dispersion_norm = df["dispersions_norm"].values.astype("float32")
+    dispersion_norm = stats[:, 2].astype("float32")
     dispersion_norm[np.isnan(dispersion_norm)] = 0  # similar to Seurat
     gene_subset = dispersion_norm > disp_min
 
-    # write to df
-    df["highly_variable"] = gene_subset
-
     # get list of gene names
-    high_var_genes = df.loc[df["highly_variable"]].index.tolist()
+    high_var_genes = celltype_df.index[gene_subset].tolist()
 
     return high_var_genes
 
 
+def is_mito_gene(genes):
+    """Boolean mask of the mitochondrial genes (names starting with "mt-" in
+    any case) in an index or list of gene names."""
+    return np.char.startswith(np.char.lower(np.asarray(genes, dtype=str)), "mt-")
+
+
 def find_thr_genes(
     series,  # pandas series in which to find compliant genes
     min_thr=1e-5,  # minimum required expression
@@ -208,44 +304,6 @@ def find_thr_genes(
 
 
 # deconvolution functions
-def rankdata(a):
-    """
-    Assign ranks to data, dealing with ties appropriately.
-    Ranks begin at 1. The average of the ranks that would have been assigned to
-    all the tied values is assigned to each value.
-
-    This function is a subset of scipy.stats.rankdata, to be found here
-    https://github.com/scipy/scipy/blob/v1.4.1/scipy/stats/stats.py .
-
-    Parameters
-    ----------
-    a : array_like
-        The array of values to be ranked. Must be 1D.
-
-    Returns
-    -------
-    ranks : ndarray
-         An array of length equal to the size of `a`, containing rank
-         scores.
-
-    """
-    arr = np.ravel(np.asarray(a))
-    sorter = np.argsort(arr, kind="quicksort")
-
-    inv = np.empty(sorter.size, dtype=np.intp)
-    inv[sorter] = np.arange(sorter.size, dtype=np.intp)
-
-    arr = arr[sorter]
-    obs = np.r_[True, arr[1:] != arr[:-1]]
-    dense = obs.cumsum()[inv]
-
-    # cumulative counts of each unique value
-    count = np.r_[np.nonzero(obs)[0], len(obs)]
-
-    # average method
-    return 0.5 * (count[dense] + count[dense - 1] + 1)
-
-
 # function that takes parameters specifying distribution and returns distance
 # of resulting mixed data to a single bulk composition
 def calculate_distance(
@@ -274,6 +332,34 @@ def calculate_distance(
     return dist
 
 
+# batched version of calculate_distance which scores a whole block of
+# candidate mixtures at once
+def calculate_distance_batch(
+    params_block,  # (K, C) array, one set of params per row
+    comp_vec_ranked,  # the gene expression vector with which to compare the resulting mixtures
+    sc_data,  # single_cell data from which to mix new samples
+):
+    """Computes `calculate_distance` for each row of `params_block` and
+    returns the K distances as an array. All mixtures are computed with a
+    single matrix product and ranked row-wise."""
+    # create array of the contributions and normalise each row to sum 1
+    conv = np.atleast_2d(np.asarray(params_block, dtype=np.float64))
+    mixtures = conv / conv.sum(axis=1, keepdims=True)
+
+    # compute the countsums of all mixtures from sc data, shape (K, genes)
+    mixed_counts = np.dot(mixtures, sc_data.T)
+
+    # rank each mixed vector and calculate Pearson correlation on ranked data
+    mixed_ranked = rankdata_rows(mixed_counts)
+    mixed_centered = mixed_ranked - mixed_ranked.mean(axis=1, keepdims=True)
+    comp_centered = comp_vec_ranked - comp_vec_ranked.mean()
+    corr = np.dot(mixed_centered, comp_centered) / (
+        np.linalg.norm(mixed_centered, axis=1) * np.linalg.norm(comp_centered)
+    )
+
+    return 1 - corr
+
+
 # define a function that returns the composition given the parameters of the
 # distribution
 def return_mixture(params):
@@ -283,6 +369,206 @@ def return_mixture(params):
     return mixture
 
 
+# fast non-negative least squares estimate of the mixture, used as starting
+# point for dual annealing
+def nnls_mixture(sc_data, bulk_vec, scale="sqrt"):
+    """Solves a non-negative least squares fit of the bulk expression by the
+    signature profiles and returns the normalised mixture, or None if no
+    usable solution is found. Genes are weighted so that residuals are
+    compared on square-root scale (scale='sqrt') or, to first order, on log
+    scale (scale='log') of the bulk expression; otherwise the few most
+    highly expressed genes would dominate the fit."""
+    bulk_vec = np.asarray(bulk_vec, dtype=np.float64)
+    sc_data = np.asarray(sc_data, dtype=np.float64)
+    keep = bulk_vec > 0
+    bulk_sub = bulk_vec[keep] / bulk_vec[keep].sum()
+    if scale == "sqrt":
+        weights = 1 / np.sqrt(bulk_sub)
+    elif scale == "log":
+        weights = 1 / bulk_sub
+    else:
+        raise ValueError("scale must be one of 'sqrt' or 'log'.")
+    try:
+        params, _ = nnls(sc_data[keep] * weights[:, np.newaxis], bulk_sub * weights)
+    except RuntimeError:
+        return None
+    if not np.all(np.isfinite(params)) or params.sum() <= 0:
+        return None
+    return params / params.sum()
+
+
+def sample_digest(gene_idx, bulk_vec):
+    """Digest of the input of a single sample: the positions gene_idx of its
+    selected genes in the signature data and its bulk expression bulk_vec
+    on these genes."""
+    h = sha256(np.asarray(gene_idx, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(bulk_vec, dtype=np.float64).tobytes())
+    return h.digest()
+
+
+def sample_seed_sequence(seed, digest):
+    """Returns the random stream of a single sample as a child of the
+    run-level seed. The child is derived from the sample's input (its
+    sample_digest) rather than its name or position, so that samples with
+    identical input draw from the same stream and a sample's result does
+    not depend on the order of samples, on which other samples are part of
+    the run or on how they are distributed over processes."""
+    return np.random.SeedSequence(
+        entropy=seed, spawn_key=(int.from_bytes(digest[:8], "little"),)
+    )
+
+
+class DeconvolutionAborted(Exception):
+    """Raised by deconvolve when a run is aborted through its abort event."""
+
+
+# registry of deconvolution engines by name, see register_engine
+ENGINES = {}
+
+
+def register_engine(name):
+    """Decorator which makes a function available as deconvolution engine
+    `name` (see the engine argument of deconvolve). The function is called
+    as engine(sc_data, bulk_vec, seed_seq, options) with a sample's subset
+    of signature and bulk data, its random stream and the dict of
+    deconvolution parameters. It returns the (not necessarily normalised)
+    mixture parameters and a dict with the number of iterations (nit),
+    objective evaluations (nfev), the final value of its objective (fun)
+    and the reason it stopped (stop_reason), and raises ValueError if the
+    sample cannot be deconvolved. Long-running engines should stop early
+    once abort_requested() returns True. While profiling, current_profile()
+    returns the Profile of the sample, in which engines may record the time
+    of their phases."""
+
+    def decorator(func):
+        ENGINES[name] = func
+        return func
+
+    return decorator
+
+
+@register_engine("anneal")
+def anneal_engine(sc_data, bulk_vec, seed_seq, options):
+    """Dual annealing on the Spearman distance, the most accurate engine."""
+    # compile the objective for this sample once
+    objective = MixtureObjective(sc_data, bulk_vec)
+    profile = current_profile()
+    if profile is not None:
+        profile.instrument(objective, OBJECTIVE_PHASES)
+    # optionally start from a fast least squares estimate
+    x0 = None
+    if options["warm_start"]:
+        x0 = nnls_mixture(sc_data, bulk_vec, scale=options["warm_start"])
+    # search either the box of unnormalised fractions, evaluating single
+    # coordinate moves incrementally, or the simplex of mixtures directly
+    simplex = options["simplex"] and sc_data.shape[1] > 1
+    if simplex:
+        func = SimplexObjective(objective)
+        coordinate_update = None
+        if x0 is not None:
+            x0 = inverse_stick_breaking(x0)
+    else:
+        func = objective
+        coordinate_update = objective.coordinate_moves
+    res = dual_annealing(
+        func,
+        bounds=[[0, 1] for x in range(sc_data.shape[1] - simplex)],
+        maxiter=options["maxiter"],
+        no_local_search=False,
+        vectorized=True,
+        coordinate_update=coordinate_update,
+        seed=seed_seq,
+        x0=x0,
+        stop_iter=options["stop_iter"],
+        stop_tol=options["stop_tol"],
+        stop_rate=options["stop_rate"],
+        abort=abort_requested,
+        profile=profile,
+    )
+    info = {
+        "nit": res.nit,
+        "nfev": res.nfev,
+        "fun": float(res.fun),
+        "stop_reason": "; ".join(res.message),
+    }
+    if simplex:
+        return stick_breaking(res.x), info
+    return res.x, info
+
+
+@register_engine("nnls")
+def nnls_engine(sc_data, bulk_vec, seed_seq, options):
+    """Deterministic non-negative least squares fit on square-root scale
+    (see nnls_mixture). Takes milliseconds per sample at a slightly lower
+    correlation than annealing, which makes it suited for triage of large
+    cohorts."""
+    profile = current_profile()
+    if profile is None:
+        params = nnls_mixture(sc_data, bulk_vec, scale="sqrt")
+    else:
+        params = profile.timed(nnls_mixture, "least_squares")(
+            sc_data, bulk_vec, scale="sqrt"
+        )
+    if params is None:
+        raise ValueError("No non-negative least squares solution found.")
+    info = {
+        "nit": 0,
+        "nfev": 0,
+        "fun": calculate_distance(params, rankdata(bulk_vec), sc_data),
+        "stop_reason": "least squares solution",
+    }
+    return params, info
+
+
+# deconvolve a single sample given its subset of signature and bulk data,
+# options holds the deconvolution parameters (see deconvolve); returns the
+# mixture and a dict describing the engine's run, including its wall time
+# and, if profile is True, the time of its phases (see profiling.py)
+def _deconvolve_task(sc_data, bulk_vec, name, seed_seq, options, profile=False):
+    previous_profile = set_profile(Profile() if profile else None)
+    start = time.perf_counter()
+    try:
+        params, info = ENGINES[options["engine"]](sc_data, bulk_vec, seed_seq, options)
+        mixture = return_mixture(params)
+    except ValueError:
+        # reported as failed by deconvolve
+        mixture = np.empty(sc_data.shape[1])
+        mixture[:] = np.nan
+        info = {"nit": np.nan, "nfev": np.nan, "stop_reason": "failed"}
+    finally:
+        sample_profile = set_profile(previous_profile)
+    info.setdefault("fun", np.nan)
+    info["wall_time"] = time.perf_counter() - start
+    if profile:
+        info["profile"] = sample_profile.summary(nfev=info["nfev"])
+    return mixture, info
+
+
+# the signature block of a gene set group, stored in column-major order so
+# that its transpose (cell types x genes, as used by MixtureObjective) is
+# contiguous and samples of the group need not copy it
+def _group_block(signature, gene_idx):
+    return np.asfortranarray(signature[gene_idx], dtype=np.float64)
+
+
+# signature block of the most recent gene set group in a worker process
+_WORKER_BLOCK = {}
+
+
+# same as above for worker processes, which hold the signature data in
+# shared memory; tasks arrive ordered by gene set group, so that a worker
+# usually builds each group's signature block once
+def _deconvolve_shared_task(
+    group, gene_idx, bulk_vec, name, seed_seq, options, profile=False
+):
+    if group not in _WORKER_BLOCK:
+        _WORKER_BLOCK.clear()
+        _WORKER_BLOCK[group] = _group_block(shared_array("signature"), gene_idx)
+    return _deconvolve_task(
+        _WORKER_BLOCK[group], bulk_vec, name, seed_seq, options, profile
+    )
+
+
 # function to select genes according to given threshold and deconvolve the
 # resulting mixture
 def deconvolve(
@@ -290,67 +576,305 @@ def deconvolve(
     bulk_df,
     maxiter,
     gene_dict,
+    n_jobs=1,
+    seed=None,
+    cache=None,
+    warm_start=None,
+    stop_iter=None,
+    stop_tol=0.0,
+    stop_rate=None,
+    return_info=False,
+    engine="anneal",
+    simplex=False,
+    progress=None,
+    abort=None,
+    events=None,
+    profile=False,
 ):
-    # sort bulk df columns alphabetically to ensure consistency
-    bulk_df = bulk_df.sort_index(axis=1)
-    # for each of the bulks, subset bulk and single-cell data according to the
-    # gene list, retain only raw data matrices after this (df --> np.array)
-    sc_list = []
+    """Deconvolves each sample (column) in bulk_df into the cell types in
+    celltype_df based on the sample's gene list in gene_dict. With n_jobs
+    other than 1, samples are distributed over a pool of n_jobs processes
+    (-1 uses all CPUs) which share a single copy of the signature data.
+    seed is the run-level seed (a non-negative integer); each sample draws
+    from its own child stream, so results for a given seed are identical
+    irrespective of sample order and n_jobs. If seed is None, fresh entropy
+    is used.
+    cache is an optional ResultCache; samples whose inputs, parameters and
+    seed match a cached result are not deconvolved again. Cache hits are
+    only possible with a fixed seed.
+    warm_start ('sqrt' or 'log') starts the annealing of each sample from
+    a non-negative least squares estimate of its mixture (see nnls_mixture)
+    instead of a random point, which allows for a much smaller maxiter.
+    stop_iter, stop_tol and stop_rate enable early stopping of the annealing
+    once the best distance of a sample improved by no more than stop_tol
+    within stop_iter iterations, or by less than a relative rate of
+    stop_rate per iteration (see dual_annealing); maxiter then only serves
+    as an upper bound.
+    If return_info is True, a second dataframe is returned which holds the
+    number of iterations (nit), objective evaluations (nfev) and the reason
+    the annealing stopped for each sample.
+    engine selects the solver from ENGINES: 'anneal' (default) for dual
+    annealing, 'nnls' for a fast deterministic least squares fit which
+    ignores maxiter, warm_start and the early stopping options. Further
+    engines can be added with register_engine.
+    With simplex=True, the annealing engine searches the simplex of
+    mixtures via stick-breaking coordinates instead of the box of
+    unnormalised fractions, in which all multiples of a parameter vector
+    give the same mixture; this removes one dimension from the search.
+    Samples with identical gene sets share one signature block, and samples
+    whose subset bulk data is identical as well (e.g. technical replicates)
+    are deconvolved only once, since they draw from the same random stream
+    (see sample_seed_sequence); all but the alphabetically first of them
+    are reported as its duplicates.
+    bulk_df may also be a BulkStore, in which case only the selected genes
+    of each sample are read from disk.
+    progress is an optional callable, progress(n_done, n_total, sample) is
+    called whenever a sample has been deconvolved, where n_total is the
+    number of samples to be deconvolved (without cache hits and duplicates),
+    and once before the first sample with n_done=0 and sample None.
+    abort is an optional threading or multiprocessing Event (the latter for
+    n_jobs other than 1); once it is set, the run stops between samples and
+    between annealing iterations and DeconvolutionAborted is raised.
+    events is the sink of the progress events (see telemetry.py), the
+    console if None; a sample_end event reports the wall time, nit, nfev,
+    final energy (fun) and stop reason of each deconvolved sample. Both
+    sample_start and sample_end events count the samples to be
+    deconvolved, as progress does (n_started and n_done of n_total).
+    With profile=True, the time spent in the phases of each sample's
+    deconvolution (objective, matrix product, ranking, correlation,
+    strategy chain, local search) and the objective evaluations of the
+    annealing and the local search are measured and reported as dict
+    profile of the sample_end event (see profiling.py)."""
+    if engine not in ENGINES:
+        raise ValueError(
+            "Unknown engine {}, choose from {}.".format(engine, sorted(ENGINES))
+        )
+    n_jobs = resolve_n_jobs(n_jobs)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    # process bulk columns alphabetically to ensure consistency, without
+    # copying the bulk data
+    bulk_names = bulk_df.columns.sort_values()
+    # selected genes are handled by integer positions, gene lists are
+    # converted once
+    if not isinstance(gene_dict, GeneSelection):
+        gene_dict = GeneSelection.from_dict(
+            {bulk: gene_dict[bulk] for bulk in bulk_names}, bulk_df.index
+        )
+    # for each of the bulks, subset bulk data according to the gene list and
+    # find the rows of the signature data belonging to these genes, retain
+    # only raw data arrays after this (df --> np.array)
+    gene_idx_list = []
     bulk_comp_list = []  # compositional version of subset bulk data
-    bulk_ranked_list = []  # ranked version of subset bulk data
-
-    for b, bulk in enumerate(bulk_df.columns):
+    digest_list = []  # digest of the input of each sample
 
-        # first, subset and rank bulk data
-        bulk_sub = bulk_df[bulk].loc[gene_dict[bulk]].values
+    for b, bulk in enumerate(bulk_names):
+        # first, subset bulk data
+        bulk_sub = bulk_df[bulk].values[gene_dict.positions(bulk, bulk_df.index)]
         bulk_comp_list.append(bulk_sub)
-        bulk_ranked = rankdata(bulk_sub)
-        bulk_ranked_list.append(bulk_ranked)
 
-        # next, subset sc data
-        sc_sub = celltype_df.loc[gene_dict[bulk]].values
-        sc_list.append(sc_sub)
+        # next, locate genes in sc data
+        gene_idx = gene_dict.positions(bulk, celltype_df.index)
+        gene_idx_list.append(gene_idx.astype(np.int32))
+        digest_list.append(sample_digest(gene_idx, bulk_sub))
+
+    # restrict the signature data to the union of all selected genes as a
+    # single contiguous array, samples only hold indices into it; their
+    # signature blocks are built when needed and released afterwards
+    selected = np.zeros(len(celltype_df.index), dtype=bool)
+    for gene_idx in gene_idx_list:
+        selected[gene_idx] = True
+    signature = np.ascontiguousarray(celltype_df.values[selected], dtype=np.float64)
+    # position of each selected gene in the restricted signature
+    position = (np.cumsum(selected) - 1).astype(np.int32)
+    gene_idx_list = [position[gene_idx] for gene_idx in gene_idx_list]
 
-    # go through all mixtures and deconvolve them separately
-    mixture_list = []
     # total number of samples for print message
-    N_samples = len(bulk_df.columns)
-    for i, mixt in enumerate(bulk_df.columns):
-        print("Deconvolving sample {} of {} ({}) ...".format(i + 1, N_samples, mixt))
-        try:
-            res = dual_annealing(
-                calculate_distance,
-                bounds=[[0, 1] for x in range(len(celltype_df.columns))],
-                maxiter=maxiter,
-                args=[bulk_ranked_list[i], sc_list[i]],
-                no_local_search=False,
+    N_samples = len(bulk_names)
+
+    # group samples by gene set, one signature block is built per group;
+    # within a group, samples with identical bulk data are solved only once
+    group_list = []  # gene set group of each sample
+    group_keys = {}
+    solve_list = []  # sample whose solution is used for each sample
+    solve_keys = {}
+    group_first = {}  # first sample of each group
+    for i in range(N_samples):
+        gene_key = sha256(gene_idx_list[i].tobytes()).digest()
+        group = group_keys.setdefault(gene_key, len(group_keys))
+        group_list.append(group)
+        # samples of a group share a single index array
+        gene_idx_list[i] = gene_idx_list[group_first.setdefault(group, i)]
+        solve_list.append(solve_keys.setdefault(digest_list[i], i))
+    N_duplicates = sum(solve_list[i] != i for i in range(N_samples))
+    emit(
+        events,
+        "sample_groups",
+        n_samples=N_samples,
+        n_groups=len(group_keys),
+        n_duplicates=N_duplicates,
+    )
+
+    mixture_list = [None] * N_samples
+    info_list = [None] * N_samples
+    seed_list = [sample_seed_sequence(seed, digest) for digest in digest_list]
+    # all parameters which influence the result of a sample
+    options = {
+        "engine": engine,
+        "maxiter": maxiter,
+        "warm_start": warm_start,
+        "stop_iter": stop_iter,
+        "stop_tol": stop_tol,
+        "stop_rate": stop_rate,
+        "simplex": simplex,
+    }
+
+    # look up previous results, only samples without one are deconvolved
+    todo = list(range(N_samples))
+    if cache is not None:
+        signature_digest = hash_frame(celltype_df)
+        cache_keys = [
+            cache.sample_key(
+                signature_digest,
+                gene_dict.digest(mixt),
+                bulk_comp_list[i],
+                options,
+                seed_list[i],
             )
-            mixture = return_mixture(res.x)
-            mixture_list.append(mixture)
-        except ValueError:
-            print(
-                "\nError: Sample {} could not be deconvolved.\nPossibly the gene set for this sample is too small.\nSee online documentation for more info.\n".format(
-                    mixt
+            for i, mixt in enumerate(bulk_names)
+        ]
+        todo = []
+        for i in range(N_samples):
+            mixture_list[i] = cache.get(cache_keys[i])
+            if mixture_list[i] is None:
+                todo.append(i)
+            else:
+                info_list[i] = {"nit": np.nan, "nfev": np.nan, "stop_reason": "cached"}
+        emit(events, "cache", hits=N_samples - len(todo), misses=len(todo))
+
+    # samples to be solved, the results of duplicates are copied later;
+    # ordered by group so that each group's signature block is built once
+    solve = sorted(
+        set(solve_list[i] for i in todo if mixture_list[solve_list[i]] is None),
+        key=lambda i: (group_list[i], i),
+    )
+
+    if progress is not None:
+        progress(0, len(solve), None)
+    emit(events, "deconvolution_start", n_total=len(solve), n_jobs=n_jobs)
+
+    def sample_end(n_done, i):
+        # report a deconvolved sample
+        emit(
+            events,
+            "sample_end",
+            sample=bulk_names[i],
+            n_done=n_done,
+            n_total=len(solve),
+            **info_list[i]
+        )
+        if progress is not None:
+            progress(n_done, len(solve), bulk_names[i])
+
+    # go through all remaining mixtures and deconvolve them separately
+    if n_jobs == 1:
+        block_group, block = None, None
+        previous_abort = set_abort_event(abort)
+        try:
+            for n_done, i in enumerate(solve):
+                mixt = bulk_names[i]
+                emit(
+                    events,
+                    "sample_start",
+                    sample=mixt,
+                    n_started=n_done + 1,
+                    n_total=len(solve),
+                )
+                if group_list[i] != block_group:
+                    block_group = group_list[i]
+                    block = _group_block(signature, gene_idx_list[i])
+                mixture_list[i], info_list[i] = _deconvolve_task(
+                    block,
+                    bulk_comp_list[i],
+                    mixt,
+                    seed_list[i],
+                    options,
+                    profile,
                 )
+                # the result of an interrupted sample is discarded
+                if abort_requested():
+                    raise DeconvolutionAborted("Deconvolution aborted.")
+                sample_end(n_done + 1, i)
+        finally:
+            set_abort_event(previous_abort)
+        block = None
+    elif len(solve) > 0:
+        tasks = [
+            (
+                group_list[i],
+                gene_idx_list[i],
+                bulk_comp_list[i],
+                bulk_names[i],
+                seed_list[i],
+                options,
+                profile,
             )
-            mixture = np.empty(len(celltype_df.columns))
-            mixture[:] = np.nan
-            mixture_list.append(mixture)
+            for i in solve
+        ]
+        results = imap_unordered(
+            _deconvolve_shared_task,
+            tasks,
+            n_jobs,
+            shared={"signature": signature},
+            abort=abort,
+        )
+        # results arrive in order of completion, sort them back into place
+        for n_done, (t, (mixture, info)) in enumerate(results):
+            if abort is not None and abort.is_set():
+                results.close()
+                raise DeconvolutionAborted("Deconvolution aborted.")
+            mixture_list[solve[t]] = mixture
+            info_list[solve[t]] = info
+            sample_end(n_done + 1, solve[t])
+
+    # duplicate samples take the solution of their first occurrence
+    for i in todo:
+        if solve_list[i] != i:
+            mixture_list[i] = mixture_list[solve_list[i]].copy()
+            info_list[i] = {
+                "nit": np.nan,
+                "nfev": np.nan,
+                "stop_reason": "duplicate of {}".format(bulk_names[solve_list[i]]),
+            }
+
+    # store new results, failed samples are not cached
+    if cache is not None:
+        for i in todo:
+            if not np.any(np.isnan(mixture_list[i])):
+                cache.put(cache_keys[i], mixture_list[i])
+        cache.evict()
 
     # grab the results, write them into a dataframe and return it
     spears = []
     pears = []
     for i, mixture in enumerate(mixture_list):
-        # calculate final spearson correlations
-        mixed_counts = np.dot(mixture, sc_list[i].T).T
+        # calculate final spearson correlations, mixing all selected genes
+        # at once avoids building the sample's signature block again
+        mixed_counts = np.dot(signature, mixture)[gene_idx_list[i]]
         mixed_compositional = mixed_counts / mixed_counts.sum()
         mixed_ranked = rankdata(mixed_counts)
-        spears.append(1 - correlation(mixed_ranked, bulk_ranked_list[i]))
+        bulk_ranked = rankdata(bulk_comp_list[i])
+        spears.append(1 - correlation(mixed_ranked, bulk_ranked))
         pears.append(1 - correlation(mixed_compositional, bulk_comp_list[i]))
 
     data_out = np.hstack((np.array(mixture_list), np.array([spears, pears]).T))
     cols_out = celltype_df.columns.tolist() + ["rho_Spearman", "rho_Pearson"]
 
-    all_mix_df = DataFrame(data=data_out, columns=cols_out, index=bulk_df.columns)
+    all_mix_df = DataFrame(data=data_out, columns=cols_out, index=bulk_names)
 
+    if return_info:
+        info_df = DataFrame(
+            info_list, columns=["nit", "nfev", "stop_reason"], index=bulk_names
+        )
+        return all_mix_df, info_df
     return all_mix_df
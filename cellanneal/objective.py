@@ -0,0 +1,337 @@
+"""Ranking functions and the per-sample objective which is minimised by
+dual annealing during deconvolution."""
+
+import numpy as np
+
+
+def rankdata(a):
+    """
+    Assign ranks to data, dealing with ties appropriately.
+    Ranks begin at 1. The average of the ranks that would have been assigned to
+    all the tied values is assigned to each value.
+
+    This function is a subset of scipy.stats.rankdata, to be found here
+    https://github.com/scipy/scipy/blob/v1.4.1/scipy/stats/stats.py .
+
+    Parameters
+    ----------
+    a : array_like
+        The array of values to be ranked. Must be 1D.
+
+    Returns
+    -------
+    ranks : ndarray
+         An array of length equal to the size of `a`, containing rank
+         scores.
+
+    """
+    arr = np.ravel(np.asarray(a))
+    sorter = np.argsort(arr, kind="quicksort")
+
+    inv = np.empty(sorter.size, dtype=np.intp)
+    inv[sorter] = np.arange(sorter.size, dtype=np.intp)
+
+    arr = arr[sorter]
+    obs = np.r_[True, arr[1:] != arr[:-1]]
+    dense = obs.cumsum()[inv]
+
+    # cumulative counts of each unique value
+    count = np.r_[np.nonzero(obs)[0], len(obs)]
+
+    # average method
+    return 0.5 * (count[dense] + count[dense - 1] + 1)
+
+
+def rankdata_rows(a):
+    """
+    Row-wise version of `rankdata` for a 2D array, i.e. each row of `a` is
+    ranked independently with ties receiving the average of their ranks.
+
+    All rows are sorted in a single call; only rows which actually contain
+    ties fall back to the tie-aware 1D `rankdata`.
+
+    Parameters
+    ----------
+    a : array_like
+        The array of values to be ranked. Must be 2D.
+
+    Returns
+    -------
+    ranks : ndarray
+         An array of the same shape as `a`, containing the rank scores of
+         each row.
+
+    """
+    arr = np.asarray(a)
+    n_rows, n_cols = arr.shape
+    sorter = np.argsort(arr, axis=1, kind="quicksort")
+
+    # ordinal ranks, valid for all rows without ties
+    ranks = np.empty(arr.shape, dtype=np.float64)
+    ordinal = np.broadcast_to(np.arange(1, n_cols + 1, dtype=np.float64), arr.shape)
+    np.put_along_axis(ranks, sorter, ordinal, axis=1)
+
+    # rows with ties need average ranks
+    arr_sorted = np.take_along_axis(arr, sorter, axis=1)
+    tied_rows = np.nonzero((arr_sorted[:, 1:] == arr_sorted[:, :-1]).any(axis=1))[0]
+    for r in tied_rows:
+        ranks[r] = rankdata(arr[r])
+
+    return ranks
+
+
+class MixtureObjective(object):
+    """
+    Spearman distance between the mixtures of a fixed set of signature
+    profiles and a single bulk sample, compiled once per sample.
+
+    The signature block is stored contiguously as (cell types, genes) and the
+    bulk ranks are stored centred and scaled to unit norm, so that each
+    evaluation consists of one matrix product into a preallocated buffer, a
+    sort and a single dot product. Normalising the parameters is not
+    needed as ranks are invariant to the scale of the mixture.
+
+    Parameters
+    ----------
+    sc_data : array_like
+        Signature data of shape (genes, cell types), subset to the genes
+        used for this sample.
+    bulk_vec : array_like
+        Bulk expression of this sample for the same genes.
+
+    Calling the object with a 1D array of parameters returns a single
+    distance, calling it with a 2D array of shape (K, cell types) returns
+    the K distances of all rows. Moves which change a single coordinate can
+    be evaluated incrementally via `coordinate_moves`.
+    """
+
+    # number of incremental updates of the reference location after which
+    # it is recomputed from scratch to keep rounding errors from building up
+    REFRESH_INTERVAL = 32
+
+    # a single evaluation whose mixed expression has at most one descent per
+    # REPAIR_FRACTION genes in the order of the previous one, e.g. a
+    # finite-difference step of the local search, repairs that order instead
+    # of sorting from scratch; descents are counted in a window of
+    # REPAIR_WINDOW genes in the middle of that order
+    REPAIR_FRACTION = 8
+    REPAIR_WINDOW = 256
+
+    def __init__(self, sc_data, bulk_vec):
+        self.sc_block = np.ascontiguousarray(np.asarray(sc_data).T, dtype=np.float64)
+        self.n_celltypes, self.n_genes = self.sc_block.shape
+
+        # centred, unit-norm bulk ranks; dotting these with any rank vector
+        # gives the covariance part of Pearson's correlation directly
+        bulk_ranks = rankdata(bulk_vec)
+        bulk_ranks -= bulk_ranks.mean()
+        self.bulk_ranks = bulk_ranks / np.linalg.norm(bulk_ranks)
+
+        # all rank vectors of length n_genes share the same mean and, in the
+        # absence of ties, the same norm after centring
+        self._rank_mean_sq = self.n_genes * ((self.n_genes + 1) / 2.0) ** 2
+        self._ordinal = np.arange(1, self.n_genes + 1, dtype=np.float64)
+        self._ordinal_norm = np.sqrt(
+            np.dot(self._ordinal, self._ordinal) - self._rank_mean_sq
+        )
+
+        # reusable output buffers, grown on demand for larger blocks
+        self._mixed = np.empty((1, self.n_genes))
+        self._gathered = np.empty((1, self.n_genes))
+
+        # reference location for incremental single-coordinate moves
+        self._ref_x = None
+        self._moves = None
+        # sort order of the last single evaluation
+        self._last_sorter = None
+
+    def _buffers(self, n_rows):
+        if self._mixed.shape[0] < n_rows:
+            self._mixed = np.empty((n_rows, self.n_genes))
+            self._gathered = np.empty((n_rows, self.n_genes))
+        return self._mixed[:n_rows], self._gathered[:n_rows]
+
+    def __call__(self, params):
+        params = np.asarray(params, dtype=np.float64)
+        if params.ndim == 1:
+            return self.evaluate_block(params[np.newaxis, :])[0]
+        return self.evaluate_block(params)
+
+    def mixed_expression(self, params_block):
+        """Returns the (unnormalised) mixed expression of each row of
+        `params_block` in a reused buffer."""
+        params_block = np.ascontiguousarray(params_block, dtype=np.float64)
+        mixed, _ = self._buffers(len(params_block))
+        np.dot(params_block, self.sc_block, out=mixed)
+        return mixed
+
+    def distance_from_ranks(self, ranks):
+        """Spearman distance of a single ranked mixture to the bulk sample."""
+        norm_sq = np.dot(ranks, ranks) - self._rank_mean_sq
+        return 1 - np.dot(ranks, self.bulk_ranks) / np.sqrt(norm_sq)
+
+    def _sorted_distances(self, mixed, sorter, mixed_sorted):
+        # Without ties, the gene at sorted position p has rank p + 1, so the
+        # covariance with the bulk ranks is a dot product of the bulk ranks
+        # gathered in sorted order with 1, ..., n_genes
+        _, gathered = self._buffers(len(mixed))
+        np.take(self.bulk_ranks, sorter, out=gathered)
+        dist = 1 - np.dot(gathered, self._ordinal) / self._ordinal_norm
+        # rows with ties need average ranks
+        tied_rows = np.nonzero(
+            (mixed_sorted[:, 1:] == mixed_sorted[:, :-1]).any(axis=1)
+        )[0]
+        for r in tied_rows:
+            dist[r] = self.distance_from_ranks(rankdata(mixed[r]))
+        return dist
+
+    def _sort_rows(self, mixed):
+        # sort order and sorted values of each row; any sort order gives the
+        # same distances, as tied rows are ranked separately
+        if len(mixed) == 1 and self._last_sorter is not None:
+            start = max(0, (self.n_genes - self.REPAIR_WINDOW) // 2)
+            window = mixed[0, self._last_sorter[start : start + self.REPAIR_WINDOW]]
+            descents = np.count_nonzero(window[1:] < window[:-1])
+            if descents * self.REPAIR_FRACTION <= len(window):
+                sorter, mixed_sorted = self._repair_sort(mixed, self._last_sorter)
+                self._last_sorter = sorter[0]
+                return sorter, mixed_sorted
+        sorter = np.argsort(mixed, axis=1, kind="quicksort")
+        if len(mixed) == 1:
+            self._last_sorter = sorter[0]
+        return sorter, np.take_along_axis(mixed, sorter, axis=1)
+
+    def evaluate_block(self, params_block):
+        """Returns the distance of each row of `params_block`."""
+        mixed = self.mixed_expression(params_block)
+        sorter, mixed_sorted = self._sort_rows(mixed)
+        return self._sorted_distances(mixed, sorter, mixed_sorted)
+
+    def set_reference(self, x):
+        """Computes the mixed expression and its sort order at location `x`
+        from scratch. Single-coordinate moves are evaluated relative to this
+        reference."""
+        self._ref_x = np.array(x, dtype=np.float64)
+        self._ref_mixed = np.dot(self._ref_x, self.sc_block)
+        self._ref_sorter = np.argsort(self._ref_mixed, kind="stable")
+        self._ref_updates = 0
+        self._moves = None
+
+    def _sync_reference(self, x):
+        if self._ref_x is None:
+            self.set_reference(x)
+            return
+        changed = np.nonzero(x != self._ref_x)[0]
+        if len(changed) == 0:
+            return
+        # if x is one of the previously evaluated moves (i.e. it has been
+        # accepted), its mixed expression and sort order become the reference
+        if (
+            len(changed) == 1
+            and self._moves is not None
+            and self._ref_updates < self.REFRESH_INTERVAL
+        ):
+            indices, values, mixed, sorter = self._moves
+            match = np.nonzero((indices == changed[0]) & (values == x[changed[0]]))[0]
+            if len(match) > 0:
+                self._ref_x = np.array(x, dtype=np.float64)
+                self._ref_mixed = mixed[match[0]].copy()
+                self._ref_sorter = sorter[match[0]].copy()
+                self._ref_updates += 1
+                self._moves = None
+                return
+        self.set_reference(x)
+
+    def _moved_expression(self, indices, deltas):
+        # mixed expression after changing coordinate indices[k] by deltas[k]
+        mixed = self.sc_block[indices] * deltas[:, np.newaxis]
+        mixed += self._ref_mixed
+        return mixed
+
+    def _repair_sort(self, mixed, ref_sorter):
+        # sort order and sorted values of each row, starting from the order
+        # `ref_sorter` of a nearby location
+        mixed_nearly_sorted = mixed[:, ref_sorter]
+        local_sorter = np.argsort(mixed_nearly_sorted, axis=1, kind="stable")
+        sorter = ref_sorter[local_sorter]
+        return sorter, np.take_along_axis(mixed_nearly_sorted, local_sorter, axis=1)
+
+    def coordinate_moves(self, x, indices, values):
+        """Returns the distances of the locations obtained from `x` by setting
+        ``x[indices[k]] = values[k]``, separately for each k.
+
+        Instead of recomputing the mixtures, the reference mixed expression
+        is updated by a single scaled signature column per move. The new
+        values are almost sorted in the order of the reference, so the sort
+        order is repaired with a stable sort (timsort) of the reordered
+        values, which is much cheaper than sorting from scratch."""
+        x = np.asarray(x, dtype=np.float64)
+        indices = np.asarray(indices, dtype=np.intp)
+        values = np.asarray(values, dtype=np.float64)
+        self._sync_reference(x)
+
+        mixed = self._moved_expression(indices, values - x[indices])
+        # repair the sort order of the reference
+        sorter, mixed_sorted = self._repair_sort(mixed, self._ref_sorter)
+
+        # keep the moves so that an accepted one can become the reference
+        self._moves = (indices, values, mixed, sorter)
+        return self._sorted_distances(mixed, sorter, mixed_sorted)
+
+
+def stick_breaking(u):
+    """Maps points of the unit cube of dimension C - 1 (last axis of `u`)
+    onto the simplex of C mixture fractions summing to 1. The k-th
+    coordinate is the fraction of the remaining stick assigned to the k-th
+    cell type, transformed with the inverse CDF of Beta(1, C - k) so that a
+    uniform point in the cube yields a uniform point on the simplex. The map
+    is a bijection on the interior of the cube and, unlike the box
+    parameterisation, has no direction along which the mixture is
+    unchanged."""
+    u = np.asarray(u, dtype=np.float64)
+    n_rest = np.arange(u.shape[-1], 0, -1)
+    # length of the remaining stick before each break, starting from 1
+    with np.errstate(divide="ignore"):
+        log_rest = np.cumsum(np.log1p(-u) / n_rest, axis=-1)
+    rest = np.concatenate((np.ones(u.shape[:-1] + (1,)), np.exp(log_rest)), axis=-1)
+    return np.concatenate((rest[..., :-1] - rest[..., 1:], rest[..., -1:]), axis=-1)
+
+
+def inverse_stick_breaking(mixture):
+    """Inverse of `stick_breaking` for a single mixture, which is normalised
+    first. Coordinates which do not influence the mixture (the remaining
+    stick is empty) are set to 0."""
+    mixture = np.asarray(mixture, dtype=np.float64)
+    mixture = mixture / mixture.sum()
+    # remaining stick after each break, summed from the end for accuracy
+    rest = np.cumsum(mixture[::-1])[::-1]
+    n_rest = np.arange(len(mixture) - 1, 0, -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = rest[1:] / rest[:-1]
+    u = np.where(rest[:-1] > 0, 1 - np.power(np.clip(ratio, 0, 1), n_rest), 0.0)
+    return np.clip(u, 0, 1)
+
+
+class SimplexObjective(object):
+    """
+    Evaluates a `MixtureObjective` on stick-breaking coordinates (see
+    `stick_breaking`), so that dual annealing searches the C - 1
+    dimensional simplex of mixtures instead of the box [0, 1]^C, in which
+    every ray from the origin maps to the same mixture.
+
+    Parameters
+    ----------
+    objective : MixtureObjective
+        Objective of the sample in terms of mixture fractions.
+
+    As in `MixtureObjective`, calling the object with a 2D array evaluates
+    all rows at once. A change of one coordinate rescales all later
+    fractions, so there are no incremental single-coordinate moves.
+    """
+
+    def __init__(self, objective):
+        self.objective = objective
+        self.n_params = objective.n_celltypes - 1
+
+    def __call__(self, u):
+        return self.objective(stick_breaking(u))
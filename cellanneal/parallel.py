@@ -0,0 +1,113 @@
+"""Process-pool execution of per-sample tasks. Large read-only arrays (such as
+the signature matrix) are placed in shared memory once and mapped by all
+worker processes instead of being pickled into every task."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# arrays attached by the current worker process, by name
+_SHARED_ARRAYS = {}
+# shared memory blocks need to stay referenced while the arrays are in use
+_SHARED_BLOCKS = []
+# event which signals the current process to abort its work, if any
+_ABORT_EVENT = None
+
+
+def resolve_n_jobs(n_jobs):
+    """Translates `n_jobs` into a number of processes; None and 1 mean
+    serial execution, negative values count back from the number of CPUs
+    (-1 uses all of them)."""
+    if n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs == 0:
+        raise ValueError("n_jobs must not be 0.")
+    if n_jobs < 0:
+        n_jobs = max(os.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+class SharedArrays(object):
+    """Context manager which copies a dict of arrays into shared memory
+    blocks and releases them on exit. `specs` describes the blocks for
+    `attach_shared_arrays` in the worker processes."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.blocks = []
+        self.specs = {}
+
+    def __enter__(self):
+        for name, array in self.arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.blocks.append(block)
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def set_abort_event(event):
+    """Sets the event (e.g. a multiprocessing.Event) which signals the
+    current process to abort, None to unset it. Returns the previous
+    event."""
+    global _ABORT_EVENT
+    previous, _ABORT_EVENT = _ABORT_EVENT, event
+    return previous
+
+
+def abort_requested():
+    """Whether the abort event of the current process is set."""
+    return _ABORT_EVENT is not None and _ABORT_EVENT.is_set()
+
+
+def attach_shared_arrays(specs, abort=None):
+    """Worker initializer, maps the shared memory blocks described by
+    `specs` into numpy arrays available via `shared_array` and sets the
+    abort event of the worker."""
+    set_abort_event(abort)
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _SHARED_BLOCKS.append(block)
+        _SHARED_ARRAYS[name] = np.ndarray(
+            shape, dtype=np.dtype(dtype), buffer=block.buf
+        )
+
+
+def shared_array(name):
+    """Returns the shared array `name` inside a worker process."""
+    return _SHARED_ARRAYS[name]
+
+
+def imap_unordered(func, tasks, n_jobs, shared=None, abort=None):
+    """Runs ``func(*task)`` for every task in a pool of `n_jobs` processes
+    and yields ``(i, result)`` pairs in order of completion, where `i` is
+    the position of the task in `tasks`. The arrays in the dict `shared` are
+    placed in shared memory and can be accessed from `func` through
+    `shared_array`. `abort` is an optional multiprocessing.Event which the
+    workers can check with `abort_requested`. Tasks which have not started
+    are cancelled when the caller stops iterating."""
+    with SharedArrays(shared or {}) as arrays:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=attach_shared_arrays,
+            initargs=(arrays.specs, abort),
+        ) as pool:
+            futures = {pool.submit(func, *task): i for i, task in enumerate(tasks)}
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
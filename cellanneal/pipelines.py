@@ -1,7 +1,25 @@
 import time
+from itertools import count
+import numpy as np
+from numpy.random import SeedSequence
 
 from .general import make_gene_dictionary, deconvolve, calc_gene_expression
-from .plots import plot_pies, plot_mix_heatmap, plot_mix_heatmap_log, plot_scatter
+from .general import find_high_var_genes
+from .cache import ResultCache
+from .readers import read_sample_names, iter_sample_chunks
+from .telemetry import CONSOLE, MultiSink, Stage, emit
+from .profiling import RunProfile
+
+
+def _read_chunks(chunks, events):
+    # reading each chunk of samples from file is reported as stage read
+    chunks = iter(chunks)
+    for c in count():
+        with Stage(events, "read", chunk=c):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
 
 
 def cellanneal_pipe(
@@ -13,43 +31,110 @@ def cellanneal_pipe(
     bulk_min,
     bulk_max,
     maxiter,
-    output_path,
-):  # path object!
+    output_path,  # path object!
+    n_jobs=1,
+    seed=None,
+    cache_dir=None,
+    cache_size=1024**3,
+    warm_start=None,
+    stop_iter=None,
+    stop_tol=0.0,
+    stop_rate=None,
+    engine="anneal",
+    simplex=False,
+    chunk_size=None,
+    dtype=np.float64,
+    plots=True,
+    progress=None,
+    abort=None,
+    events=None,
+    profile=False,
+):
     """Serves as entrypoint into cellanneal pipeline for both gui and cli
-    once all data and parameters have been collected."""
+    once all data and parameters have been collected. If cache_dir is
+    given, per-sample results are cached there (up to cache_size bytes) and
+    reused by later runs with the same data, parameters and seed, as are the
+    dispersion statistics of the signature data. With
+    warm_start ('sqrt' or 'log'), annealing starts from a non-negative least
+    squares estimate of each mixture. stop_iter, stop_tol and stop_rate
+    stop the annealing of a sample early once its best fit has converged
+    (see deconvolve). engine selects the deconvolution engine, 'anneal' or
+    the fast 'nnls'; simplex=True lets the annealing search the simplex of
+    mixtures directly.
+    With chunk_size, the pipeline runs in streaming mode: samples are
+    processed in chunks of chunk_size and the results of each chunk are
+    appended to the output files as soon as it is finished, so that memory
+    is bounded by the chunk size. If bulk_df is None, the chunks are read
+    from bulk_data_path one at a time, with values of type dtype. No
+    figures are produced in this mode.
+    bulk_df may also be a BulkStore, whose samples are then only read when
+    needed.
+    With plots=False, no figures are produced and the plotting libraries
+    are not imported.
+    progress and abort are passed on to deconvolve, to follow the
+    deconvolution of the samples (of each chunk) and to abort the run by
+    setting the abort event, which raises DeconvolutionAborted.
+    events is the sink of the progress events of the run (see
+    telemetry.py), e.g. a JSONLinesSink for monitoring or a QuietSink; the
+    console if None.
+    With profile=True, the wall time of the stages of the run and of the
+    phases of each sample's deconvolution are measured (see profiling.py)
+    and written to profile_<timestamp>.txt and profile_samples_<timestamp>.csv
+    next to the parameters file. profile may also be a RunProfile which
+    already holds earlier stages of the run, such as the import of the
+    data."""
+    run_start = time.perf_counter()
+    # the profile collects the events of the run
+    run_profile = RunProfile() if profile is True else profile or None
+    if run_profile is not None:
+        events = MultiSink(CONSOLE if events is None else events, run_profile)
+
+    # without a user-defined seed, draw one so that the run can be repeated
+    if seed is None:
+        seed = SeedSequence().entropy
 
     """ 2) Identify highly variable genes and genes that pass the thresholds
     for each bulk. """
     # extract names
-    bulk_names = bulk_df.columns.tolist()
+    if bulk_df is None:
+        bulk_names = read_sample_names(bulk_data_path).tolist()
+    else:
+        bulk_names = bulk_df.columns.tolist()
     celltypes = celltype_df.columns.tolist()
 
     # check here for uniqueness
     if len(bulk_names) > len(set(bulk_names)):
-        print(
-            "Error: The names of the mixtures are not unique. Please give a unique name to each mixture."
+        emit(
+            events,
+            "error",
+            message="The names of the mixtures are not unique. Please give a unique name to each mixture.",
         )
         return 0
     if len(celltypes) > len(set(celltypes)):
-        print(
-            "Error: The names of the cell types are not unique. Please give a unique name to each cell type."
+        emit(
+            events,
+            "error",
+            message="The names of the cell types are not unique. Please give a unique name to each cell type.",
         )
         return 0
 
-    # produce lists of genes on which to base deconvolution
-    print("\n+++ Constructing gene sets ... +++")
-    gene_dict = make_gene_dictionary(
-        celltype_df, bulk_df, disp_min=disp_min, bulk_min=bulk_min, bulk_max=bulk_max
-    )
-
-    """ 3) Run cellanneal. """
-    print("\n+++ Running cellanneal ... +++")
-    all_mix_df = deconvolve(
-        celltype_df=celltype_df, bulk_df=bulk_df, maxiter=maxiter, gene_dict=gene_dict
-    )
-
-    """ 4) Write results to file."""
-    print("\n+++ Writing results to file ... +++")
+    # the mixture data is processed in chunks of samples, a single chunk
+    # unless running in streaming mode
+    if chunk_size is None:
+        chunks = [bulk_df]
+    elif bulk_df is None:
+        chunks = _read_chunks(
+            iter_sample_chunks(bulk_data_path, chunk_size, dtype=dtype), events
+        )
+    else:
+        # the chunks are taken from the data passed in, bulk_df is rebound
+        # to each chunk below
+        source = bulk_df
+        ordered = sorted(bulk_names)
+        chunks = (
+            source[ordered[start : start + chunk_size]]
+            for start in range(0, len(ordered), chunk_size)
+        )
 
     # make top level folder for all results from this run
     # get timestamp for labelling
@@ -67,29 +152,107 @@ def cellanneal_pipe(
     figure_folder_path.mkdir(parents=True, exist_ok=True)
     genexpr_folder_path = top_folder_path / "genewise_comparison"
     genexpr_folder_path.mkdir(parents=True, exist_ok=True)
-
-    # first, write the mix matrix to csv
     deconv_name = "deconvolution_" + bulk_file_ID + ".csv"
     result_path = deconv_folder_path / deconv_name
-    all_mix_df.sort_index(axis=0, inplace=True)
-    all_mix_df.to_csv(result_path, header=True, index=True, sep=",")
-
-    # next, write the actual and estimated gene expression to file,
-    # this has to be done per sample as the genes are sample specific
-    # a mix_df version without correlation entries is needed
-    all_mix_df_no_corr = all_mix_df[celltypes]
-    for sample_name in bulk_names:
-        gene_comp_df = calc_gene_expression(
-            mix_vec=all_mix_df_no_corr.loc[sample_name],
-            bulk_vec=bulk_df[sample_name],
-            celltype_df=celltype_df,
-            gene_list=gene_dict[sample_name],
-        )
-        # construct export path for this sample
-        sample_gene_name = "expression_" + bulk_file_ID + "_" + sample_name + ".csv"
-        sample_gene_path = genexpr_folder_path / sample_gene_name
-        gene_comp_df.sort_index(axis=0, inplace=True)
-        gene_comp_df.to_csv(sample_gene_path, header=True, index=True, sep=",")
+    info_path = deconv_folder_path / ("run_info_" + bulk_file_ID + ".csv")
+
+    cache = ResultCache(cache_dir, max_size=cache_size) if cache_dir else None
+    high_var_genes = None
+    N_done = 0
+    for c, bulk_df in enumerate(chunks):
+        if chunk_size is not None:
+            emit(
+                events,
+                "chunk_start",
+                chunk=c,
+                first=N_done + 1,
+                last=N_done + len(bulk_df.columns),
+                n_samples=len(bulk_names),
+            )
+
+        # produce lists of genes on which to base deconvolution, highly
+        # variable genes are identified for the first chunk only
+        with Stage(events, "gene_sets", chunk=c):
+            if high_var_genes is None:
+                high_var_genes = find_high_var_genes(
+                    celltype_df, disp_min=disp_min, cache=cache
+                )
+                emit(events, "high_var_genes", n_genes=len(high_var_genes))
+            gene_dict = make_gene_dictionary(
+                celltype_df,
+                bulk_df,
+                disp_min=disp_min,
+                bulk_min=bulk_min,
+                bulk_max=bulk_max,
+                cache=cache,
+                high_var_genes=high_var_genes,
+                events=events,
+            )
+
+        """ 3) Run cellanneal. """
+        with Stage(events, "deconvolution", chunk=c):
+            all_mix_df, info_df = deconvolve(
+                celltype_df=celltype_df,
+                bulk_df=bulk_df,
+                maxiter=maxiter,
+                gene_dict=gene_dict,
+                n_jobs=n_jobs,
+                seed=seed,
+                cache=cache,
+                warm_start=warm_start,
+                stop_iter=stop_iter,
+                stop_tol=stop_tol,
+                stop_rate=stop_rate,
+                return_info=True,
+                engine=engine,
+                simplex=simplex,
+                progress=progress,
+                abort=abort,
+                events=events,
+                profile=run_profile is not None,
+            )
+
+        """ 4) Write results to file."""
+        with Stage(events, "write", chunk=c):
+            # first, write the mix matrix to csv, later chunks are appended
+            all_mix_df.sort_index(axis=0, inplace=True)
+            all_mix_df.to_csv(
+                result_path,
+                header=c == 0,
+                index=True,
+                sep=",",
+                mode="w" if c == 0 else "a",
+            )
+
+            # iterations, evaluations and stopping reason of each sample's annealing
+            info_df.sort_index(axis=0, inplace=True)
+            info_df.to_csv(
+                info_path,
+                header=c == 0,
+                index=True,
+                sep=",",
+                mode="w" if c == 0 else "a",
+            )
+
+            # next, write the actual and estimated gene expression to file,
+            # this has to be done per sample as the genes are sample specific
+            # a mix_df version without correlation entries is needed
+            all_mix_df_no_corr = all_mix_df[celltypes]
+            for sample_name in bulk_df.columns:
+                gene_comp_df = calc_gene_expression(
+                    mix_vec=all_mix_df_no_corr.loc[sample_name],
+                    bulk_vec=bulk_df[sample_name],
+                    celltype_df=celltype_df,
+                    gene_list=gene_dict,
+                )
+                # construct export path for this sample
+                sample_gene_name = (
+                    "expression_" + bulk_file_ID + "_" + sample_name + ".csv"
+                )
+                sample_gene_path = genexpr_folder_path / sample_gene_name
+                gene_comp_df.sort_index(axis=0, inplace=True)
+                gene_comp_df.to_csv(sample_gene_path, header=True, index=True, sep=",")
+        N_done += len(bulk_df.columns)
 
     # write a text file with all parameters
     param_file_path = top_folder_path / "parameters_{}.txt".format(timestamp)
@@ -104,42 +267,102 @@ def cellanneal_pipe(
         file.write("minimum expression in mixture: {}\n".format(bulk_min))
         file.write("maximum expression in mixture: {}\n".format(bulk_max))
         file.write("minimum dispersion: {}\n".format(disp_min))
+        file.write("deconvolution engine: {}\n".format(engine))
+        file.write("search on the simplex: {}\n".format(simplex))
         file.write("maximum number of iterations: {}\n".format(maxiter))
+        file.write("number of parallel processes: {}\n".format(n_jobs))
+        file.write("random seed: {}\n".format(seed))
+        file.write("warm start: {}\n".format(warm_start))
+        if stop_iter is not None:
+            file.write(
+                "early stopping: {} iterations, tolerance {}, rate {}\n".format(
+                    stop_iter, stop_tol, stop_rate
+                )
+            )
+        if cache is not None:
+            file.write(
+                "result cache: {} ({} hits, {} misses)\n".format(
+                    cache_dir, cache.hits, cache.misses
+                )
+            )
+        if not plots:
+            file.write("figures: disabled\n")
+        if chunk_size is not None:
+            file.write("streaming mode: chunks of {} samples\n".format(chunk_size))
+        if run_profile is not None:
+            file.write("profile: profile_{}.txt\n".format(timestamp))
 
     """ 5) Produce plots and save to folder"""
     # we only want figures if there are less than 100 samples
-    if len(bulk_names) > 100:
-        print(
-            "\nInfo: cellanneal does not produce figures for runs with more than 100 samples. If you would like cellanneal to produce figures, consider splitting your data into several input files with less than 100 mixtures each."
+    if not plots:
+        emit(events, "info", message="figures are disabled for this run.")
+    elif chunk_size is not None:
+        emit(
+            events,
+            "info",
+            message="cellanneal does not produce figures in streaming mode.",
+        )
+    elif len(bulk_names) > 100:
+        emit(
+            events,
+            "info",
+            message="cellanneal does not produce figures for runs with more than 100 samples. If you would like cellanneal to produce figures, consider splitting your data into several input files with less than 100 mixtures each.",
         )
     # plot results
     else:
-        print('\n+++ Storing figures in folder "figures" ... +++')
-        try:
-            pie_path = figure_folder_path / "pies_{}.pdf".format(bulk_file_ID)
-            plot_pies(all_mix_df, save_path=pie_path)
+        with Stage(events, "figures"):
+            try:
+                # matplotlib and seaborn are only loaded when figures are made
+                from .plots import plot_pies, plot_mix_heatmap, plot_mix_heatmap_log
+                from .plots import plot_scatter
 
-            heat_path = figure_folder_path / "heat_{}.pdf".format(bulk_file_ID)
-            plot_mix_heatmap(all_mix_df, rownorm=False, save_path=heat_path)
+                pie_path = figure_folder_path / "pies_{}.pdf".format(bulk_file_ID)
+                plot_pies(all_mix_df, save_path=pie_path)
 
-            heat_log_path = figure_folder_path / "heat_log10_{}.pdf".format(
-                bulk_file_ID
-            )
-            plot_mix_heatmap_log(all_mix_df, rownorm=False, save_path=heat_log_path)
+                heat_path = figure_folder_path / "heat_{}.pdf".format(bulk_file_ID)
+                plot_mix_heatmap(all_mix_df, rownorm=False, save_path=heat_path)
 
-            scatter_path = figure_folder_path / "scatter_{}.pdf".format(bulk_file_ID)
-            plot_scatter(
-                all_mix_df, bulk_df, celltype_df, gene_dict, save_path=scatter_path
-            )
-        except:
-            print("\nError: Plots could not be created.")
+                heat_log_path = figure_folder_path / "heat_log10_{}.pdf".format(
+                    bulk_file_ID
+                )
+                plot_mix_heatmap_log(all_mix_df, rownorm=False, save_path=heat_log_path)
 
-    print("\n+++ Finished. +++\n")
+                scatter_path = figure_folder_path / "scatter_{}.pdf".format(
+                    bulk_file_ID
+                )
+                plot_scatter(
+                    all_mix_df, bulk_df, celltype_df, gene_dict, save_path=scatter_path
+                )
+            except:
+                emit(events, "error", message="Plots could not be created.")
+
+    emit(
+        events,
+        "run_end",
+        n_samples=len(bulk_names),
+        wall_time=time.perf_counter() - run_start,
+    )
+    if run_profile is not None:
+        run_profile.write(top_folder_path, timestamp)
 
 
 def run_cellanneal(
-    celltype_df, bulk_df, disp_min, bulk_min, bulk_max, maxiter
-):  # path object!
+    celltype_df,
+    bulk_df,
+    disp_min,
+    bulk_min,
+    bulk_max,
+    maxiter,
+    n_jobs=1,
+    seed=None,
+    warm_start=None,
+    stop_iter=None,
+    stop_tol=0.0,
+    stop_rate=None,
+    engine="anneal",
+    simplex=False,
+    events=None,
+):
     """Combines gene set identification and deconvolution into a single
     function.
 
@@ -150,20 +373,54 @@ def run_cellanneal(
     bulk_min   -  minimum expression in mixture data for genes
     bulk_max  -  maximum expression in mixture data for genes
     maxiter  -  maximum number of iterations for scipy's dual annealing
+    n_jobs  -  number of processes to deconvolve samples in parallel
+               (-1 uses all CPUs)
+    seed  -  run-level random seed, results for a given seed are reproducible
+    warm_start  -  'sqrt' or 'log' to start annealing from a non-negative least
+                   squares estimate of each mixture, None for a random start
+    stop_iter  -  stop annealing a mixture once its best distance improved by
+                  no more than stop_tol within stop_iter iterations, None to
+                  always run maxiter iterations
+    stop_tol  -  absolute tolerance for early stopping
+    stop_rate  -  also stop once the relative improvement per iteration falls
+                  below stop_rate, None to disable
+    engine  -  'anneal' for dual annealing or 'nnls' for a fast deterministic
+               least squares fit (ignores maxiter and the annealing options)
+    simplex  -  if True, anneal on stick-breaking coordinates of the simplex
+                of mixtures rather than on unnormalised fractions
+    events  -  sink of the progress events (see telemetry.py), the console
+               if None
 
     Output:
     all_mix_df  -  a dataframe containing cell type fractions for each mixture"""
 
     # produce lists of genes on which to base deconvolution
-    print("\n+++ Constructing gene sets ... +++")
-    gene_dict = make_gene_dictionary(
-        celltype_df, bulk_df, disp_min=disp_min, bulk_min=bulk_min, bulk_max=bulk_max
-    )
+    with Stage(events, "gene_sets"):
+        gene_dict = make_gene_dictionary(
+            celltype_df,
+            bulk_df,
+            disp_min=disp_min,
+            bulk_min=bulk_min,
+            bulk_max=bulk_max,
+            events=events,
+        )
 
     """ 3) Run cellanneal. """
-    print("\n+++ Running cellanneal ... +++")
-    all_mix_df = deconvolve(
-        celltype_df=celltype_df, bulk_df=bulk_df, maxiter=maxiter, gene_dict=gene_dict
-    )
+    with Stage(events, "deconvolution"):
+        all_mix_df = deconvolve(
+            celltype_df=celltype_df,
+            bulk_df=bulk_df,
+            maxiter=maxiter,
+            gene_dict=gene_dict,
+            n_jobs=n_jobs,
+            seed=seed,
+            warm_start=warm_start,
+            stop_iter=stop_iter,
+            stop_tol=stop_tol,
+            stop_rate=stop_rate,
+            engine=engine,
+            simplex=simplex,
+            events=events,
+        )
 
     return all_mix_df
@@ -5,6 +5,8 @@ from seaborn import heatmap
 from scipy.stats import spearmanr
 from scipy.spatial.distance import correlation
 
+from .selection import gene_positions
+
 
 rcParams["axes.prop_cycle"] = cycler(
     color=[
@@ -242,12 +244,12 @@ def plot_scatter(mix_df, bulk_df, celltype_df, gene_dict, save_path=None):
 
     for b, bulk in enumerate(bulk_df.columns):
         # first, subset bulk data
-        bulk_sub = bulk_df[bulk].loc[gene_dict[bulk]].values
+        bulk_sub = bulk_df[bulk].values[gene_positions(gene_dict, bulk, bulk_df.index)]
         bulk_sub = bulk_sub / np.sum(bulk_sub)
         bulk_comp_list.append(bulk_sub)
 
         # next, subset sc data
-        sc_sub = celltype_df.loc[gene_dict[bulk]].values
+        sc_sub = celltype_df.values[gene_positions(gene_dict, bulk, celltype_df.index)]
         sc_list.append(sc_sub)
 
     # for each mixture, plot a scatterplot of mixed vs real bulk
@@ -0,0 +1,219 @@
+"""Measurement of where the time of a deconvolution goes.
+
+A Profile records the wall time and number of calls of the phases of a
+single sample's deconvolution: the parts of the objective function (matrix
+product, ranking and correlation), the strategy chain and the local search
+of the annealing, including the time L-BFGS-B spends outside the objective,
+and the objective evaluations of chain and local search. Phases are timed
+by replacing methods of the objects involved with timed versions on the
+instance only, so that nothing changes for runs without profiling.
+
+A RunProfile collects the stages of a run and the profiles of all samples
+from the progress events (see telemetry.py) and writes them to a report."""
+
+import time
+from collections import defaultdict
+from functools import wraps
+
+from pandas import DataFrame
+
+
+# phase of each method of MixtureObjective which is timed
+OBJECTIVE_PHASES = {
+    "mixed_expression": "matrix_product",
+    "_moved_expression": "matrix_product",
+    "_sort_rows": "ranking",
+    "_repair_sort": "ranking",
+    "set_reference": "reference",
+    "_sorted_distances": "correlation",
+}
+
+
+# profile of the sample deconvolved by the current process, if any
+_PROFILE = None
+
+
+def set_profile(profile):
+    """Makes `profile` (or None) the profile of the current process and
+    returns the previous one."""
+    global _PROFILE
+    previous = _PROFILE
+    _PROFILE = profile
+    return previous
+
+
+def current_profile():
+    """The profile of the current process, None unless profiling."""
+    return _PROFILE
+
+
+class Profile(object):
+    """
+    Wall time and number of calls of the phases of a deconvolution, and
+    further counts such as the number of objective evaluations.
+
+    Phases are named freely; nested phases (e.g. the objective within the
+    local search) are each recorded with their full time.
+    """
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    def add(self, phase, seconds, calls=1):
+        """Adds `calls` calls taking `seconds` in total to `phase`."""
+        self.times[phase] += seconds
+        self.calls[phase] += calls
+
+    def timed(self, func, phase):
+        """Returns a version of `func` which records its calls in `phase`."""
+
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+
+        return timed_func
+
+    def instrument(self, obj, phases):
+        """Times the methods of `obj` named by the keys of dict `phases` in
+        the phases given by its values, for this instance only."""
+        for name, phase in phases.items():
+            if hasattr(obj, name):
+                setattr(obj, name, self.timed(getattr(obj, name), phase))
+
+    def instrument_annealing(self, func_wrapper, strategy_chain, minimizer_wrapper):
+        """Times the objective evaluations (phase objective), strategy chain
+        and local search of dual_annealing, and counts the evaluations of
+        the local search (the others belong to the annealing)."""
+        # without coordinate updates, fun_coordinates calls fun_batch
+        objective_methods = ["fun", "fun_batch"]
+        if func_wrapper.coordinate_update is not None:
+            objective_methods.append("fun_coordinates")
+        self.instrument(func_wrapper, dict.fromkeys(objective_methods, "objective"))
+        self.instrument(strategy_chain, {"run": "strategy_chain"})
+        local_search = minimizer_wrapper.local_search
+
+        @wraps(local_search)
+        def timed_local_search(x, e):
+            nfev = func_wrapper.nfev
+            objective_time = self.times["objective"]
+            start = time.perf_counter()
+            try:
+                return local_search(x, e)
+            finally:
+                self.add("local_search", time.perf_counter() - start)
+                self.add(
+                    "local_search_objective",
+                    self.times["objective"] - objective_time,
+                    calls=0,
+                )
+                self.counts["nfev_local_search"] += func_wrapper.nfev - nfev
+
+        minimizer_wrapper.local_search = timed_local_search
+
+    def summary(self, nfev=None):
+        """Flat dict of the time (phase_time) and calls (phase_calls) of all
+        phases. Given the total number of evaluations nfev, the evaluations
+        of the annealing (nfev_chain) and of the local search
+        (nfev_local_search) are included, as is the time L-BFGS-B spends
+        outside the objective (lbfgsb_overhead_time)."""
+        summary = {}
+        for phase in sorted(self.times):
+            summary[phase + "_time"] = self.times[phase]
+            if self.calls[phase] > 0:
+                summary[phase + "_calls"] = self.calls[phase]
+        if "local_search" in self.times:
+            summary["lbfgsb_overhead_time"] = (
+                self.times["local_search"] - self.times["local_search_objective"]
+            )
+        summary.update(self.counts)
+        if nfev is not None:
+            summary["nfev_chain"] = nfev - self.counts["nfev_local_search"]
+            summary["nfev_local_search"] = self.counts["nfev_local_search"]
+        return summary
+
+
+class RunProfile(object):
+    """
+    Sink of progress events (see telemetry.py) which collects the wall time
+    of the stages of a run and the profiles of its samples, as reported by
+    deconvolve with profile=True, and writes them to a report.
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.samples = []
+
+    def __call__(self, record):
+        if record["event"] == "stage_end":
+            self.stages[record["stage"]] += record["wall_time"]
+        elif record["event"] == "run_end":
+            self.stages["pipeline"] = record["wall_time"]
+        elif record["event"] == "sample_end":
+            row = {
+                "sample": record["sample"],
+                "wall_time": record["wall_time"],
+                "nit": record["nit"],
+                "nfev": record["nfev"],
+            }
+            row.update(record.get("profile", {}))
+            self.samples.append(row)
+
+    def sample_table(self):
+        """Dataframe with the profile of each sample, in seconds."""
+        df = DataFrame(self.samples)
+        if len(df) > 0:
+            df = df.set_index("sample").sort_index()
+        return df
+
+    def report(self):
+        """Text of the run report: the wall time of each stage and the
+        phases of all samples' deconvolution summed over samples."""
+        lines = ["wall time of the stages of the run (s):"]
+        for stage, seconds in self.stages.items():
+            lines.append("  {:<34}{:>12.3f}".format(stage, seconds))
+        df = self.sample_table()
+        lines.append("")
+        lines.append("{} samples deconvolved".format(len(df)))
+        if len(df) == 0:
+            return "\n".join(lines) + "\n"
+        total = df["wall_time"].sum()
+        lines.append("phases summed over samples (s, % of sample time, calls):")
+        columns = ["wall_time"] + [
+            c for c in df.columns if c.endswith("_time") and c != "wall_time"
+        ]
+        for column in columns:
+            seconds = df[column].sum()
+            calls_column = column[: -len("_time")] + "_calls"
+            calls = df[calls_column].sum() if calls_column in df else ""
+            lines.append(
+                "  {:<34}{:>12.3f}{:>8.1f} %{:>14}".format(
+                    "sample" if column == "wall_time" else column[: -len("_time")],
+                    seconds,
+                    100 * seconds / total if total > 0 else 0,
+                    calls,
+                )
+            )
+        lines.append("objective evaluations:")
+        for column in ["nfev", "nfev_chain", "nfev_local_search"]:
+            if column in df:
+                lines.append("  {:<34}{:>12.0f}".format(column, df[column].sum()))
+        return "\n".join(lines) + "\n"
+
+    def write(self, folder, name):
+        """Writes the run report to profile_<name>.txt and the sample
+        profiles to profile_samples_<name>.csv in `folder`."""
+        with open(folder / "profile_{}.txt".format(name), "w") as file:
+            file.write("profile of cellanneal run ({})\n\n".format(name))
+            file.write(self.report())
+        self.sample_table().to_csv(
+            folder / "profile_samples_{}.csv".format(name),
+            header=True,
+            index=True,
+            sep=",",
+        )
@@ -0,0 +1,346 @@
+"""Reading of mixture and signature data files, including chunked reading of
+the samples of large mixture files.
+
+Text files (.csv, .txt, optionally compressed as .gz or .zst) are parsed
+with pandas' fast C parser after detecting the delimiter from the header
+line, and values are read directly with the requested float type. Given a
+cache directory, imported data are also stored as binary copies which later
+runs memory-map instead of parsing the file again. Mixture data can also be
+read from a BulkStore directory (see store.py), which write_bulk_store
+creates from a data file."""
+
+import csv
+import gzip
+import io
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame, concat, read_csv, read_excel
+
+from .cache import InputCache
+from .store import BulkStore, is_bulk_store
+from .telemetry import emit
+
+
+def prepare_expression_df(df):
+    """Changes all gene names to uppercase to make further course case
+    insensitive, sums duplicate genes and sets missing values to 0, as done
+    for all imported data. Genes are sorted alphabetically."""
+    df.index = df.index.str.upper()
+    # genes without a name are dropped, as by grouping
+    if df.index.hasnans:
+        df = df[df.index.notna()]
+    if df.index.is_unique:
+        # same result as grouping, without the cost of it
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+    else:
+        df = df.groupby(df.index).sum()
+    if df.isna().values.any():
+        df = df.fillna(0)
+    return df
+
+
+# compressed files are recognised by their (last) extension
+_COMPRESSIONS = {"gz": "gzip", "zst": "zstd", "zstd": "zstd"}
+
+
+def _split_name(path):
+    # file format and compression of a path such as data.csv.gz
+    parts = path.name.split(".")
+    compression = _COMPRESSIONS.get(parts[-1])
+    if compression is not None:
+        parts = parts[:-1]
+    return parts[-1], compression
+
+
+def _is_text(path):
+    extension, compression = _split_name(path)
+    if extension in ["csv", "txt"]:
+        return True
+    if extension in ["xlsx", "xls"] and compression is None:
+        return False
+    raise ImportError("Unsupported file format: {}".format(path.name))
+
+
+def _open_text(path):
+    # text handle of a possibly compressed file, decompressed on the fly
+    _, compression = _split_name(path)
+    if compression == "gzip":
+        return gzip.open(path, "rt", newline="")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Reading zstd-compressed files requires the zstandard package."
+            )
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(reader, newline="")
+    return open(path, newline="")
+
+
+def sniff_delimiter(path):
+    """Detects the delimiter of a text file from its header line."""
+    with _open_text(path) as f:
+        header = f.readline()
+    try:
+        return csv.Sniffer().sniff(header, delimiters=",;\t ").delimiter
+    except csv.Error:
+        return ","
+
+
+def _read_excel(path, **kwargs):
+    engine = "openpyxl" if _split_name(path)[0] == "xlsx" else "xlrd"
+    return read_excel(path, index_col=0, engine=engine, **kwargs)
+
+
+def read_sample_names(path):
+    """Names of the samples (columns) in a data file, read from its header
+    only."""
+    if is_bulk_store(path):
+        return BulkStore(path).columns
+    if _is_text(path):
+        df = read_csv(path, index_col=0, sep=sniff_delimiter(path), nrows=0)
+    else:
+        df = _read_excel(path, nrows=0)
+    return df.columns
+
+
+def read_expression_data(
+    path, columns=None, dtype=np.float64, cache_dir=None, events=None
+):
+    """Reads a mixture or signature data file with genes as rows and samples
+    or cell types as columns and prepares it with prepare_expression_df.
+
+    Input:
+    path  -  Path of a .csv, .txt (both optionally compressed as .gz or
+             .zst), .xlsx or .xls file or of a BulkStore directory
+    columns  -  names of the columns to read, None for all
+    dtype  -  float type of the values, e.g. np.float32 to halve memory
+    cache_dir  -  optional cache directory; if given, the prepared data are
+                  memory-mapped from a binary copy made by an earlier call,
+                  as long as the file is unchanged, or such a copy is made
+    events  -  sink of the progress events (see telemetry.py), the console
+               if None; the use of a binary copy is reported as event
+               input_cache
+
+    Output:
+    df  -  dataframe with the data
+
+    Raises ValueError if the file content cannot be parsed."""
+    if is_bulk_store(path):
+        # data in a store is prepared already and read without parsing
+        return BulkStore(path).read(columns).astype(dtype, copy=False)
+    if cache_dir is None:
+        return _read_expression_data(path, columns, dtype)
+    cache = InputCache(cache_dir)
+    key = cache.key(path, columns=columns, dtype=dtype)
+    df = cache.load(key, path)
+    if df is not None:
+        emit(events, "input_cache", file=path.name, cache_dir=str(cache_dir))
+        return df
+    df = _read_expression_data(path, columns, dtype)
+    try:
+        stored = cache.put(key, path, df)
+    except OSError:
+        stored = False
+    if stored:
+        # continue with the memory-mapped copy, whose pages are shared with
+        # other processes reading the same data
+        mapped_df = cache.load(key, path)
+        if mapped_df is not None:
+            return mapped_df
+    return df
+
+
+def _read_expression_data(path, columns, dtype):
+    if not _is_text(path):
+        df = _read_excel(path)
+        if columns is not None:
+            df = df[list(columns)]
+        return prepare_expression_df(df.astype(dtype))
+
+    delimiter = sniff_delimiter(path)
+    sample_names = read_csv(path, index_col=0, sep=delimiter, nrows=0).columns
+    if columns is None:
+        usecols = None
+        names = sample_names
+    else:
+        names = sample_names[sample_names.isin(columns)]
+        if len(names) < len(set(columns)):
+            raise ValueError("Columns missing from {}.".format(path.name))
+        # columns are selected by position, the gene names are in column 0
+        usecols = [0] + list(np.flatnonzero(sample_names.isin(columns)) + 1)
+    df = read_csv(
+        path,
+        index_col=0,
+        sep=delimiter,
+        usecols=usecols,
+        dtype={name: dtype for name in names},
+        engine="c",
+    )
+    return prepare_expression_df(df)
+
+
+# number of values per chunk of rows when a text file is spooled
+SPOOL_SIZE = 2**22
+
+
+def _spool_text_file(path, blocks, dtype, spool_file):
+    # Parses a text file once, in chunks of rows, and writes the values of
+    # each block of samples within each chunk of rows to spool_file, one
+    # after the other. Returns the gene names in file order and the offset
+    # and number of rows of each chunk of rows in the spool.
+    delimiter = sniff_delimiter(path)
+    sample_names = read_csv(path, index_col=0, sep=delimiter, nrows=0).columns
+    positions = [sample_names.get_indexer(block) for block in blocks]
+    reader = read_csv(
+        path,
+        index_col=0,
+        sep=delimiter,
+        dtype={name: dtype for name in sample_names},
+        engine="c",
+        chunksize=max(1, SPOOL_SIZE // max(1, len(sample_names))),
+    )
+    genes = []
+    segments = []
+    offset = 0
+    with open(spool_file, "wb") as f:
+        for rows in reader:
+            values = rows.values
+            genes.append(rows.index)
+            segments.append((offset, len(rows)))
+            for pos in positions:
+                np.ascontiguousarray(values[:, pos], dtype=dtype).tofile(f)
+            offset += values.size
+    genes = genes[0].append(genes[1:]) if genes else sample_names[:0]
+    return genes, segments
+
+
+def _iter_spooled_blocks(path, blocks, dtype, spool_dir=None):
+    # Yields the samples of each block (list of sample names) of a text
+    # file as raw dataframes, parsing the file only once. Values are
+    # spooled to a temporary file, of which only one block at a time is
+    # held in memory.
+    with tempfile.TemporaryDirectory(dir=spool_dir) as folder:
+        spool_file = Path(folder) / "spool.bin"
+        genes, segments = _spool_text_file(path, blocks, dtype, spool_file)
+        spool = None
+        if spool_file.stat().st_size > 0:
+            spool = np.memmap(spool_file, dtype=dtype, mode="r")
+        start = 0
+        for block in blocks:
+            width = len(block)
+            values = np.empty((len(genes), width), dtype=dtype)
+            row = 0
+            for offset, n_rows in segments:
+                begin = offset + n_rows * start
+                values[row : row + n_rows] = spool[
+                    begin : begin + n_rows * width
+                ].reshape(n_rows, width)
+                row += n_rows
+            start += width
+            yield DataFrame(values, index=genes, columns=block, copy=False)
+        del spool
+
+
+def iter_sample_chunks(path, chunk_size, dtype=np.float64, spool_dir=None):
+    """Yields the samples of a data file in alphabetical order as dataframes
+    of at most chunk_size samples (columns), each prepared with
+    prepare_expression_df. Text files are parsed only once, in chunks of
+    rows, and their values spooled to a temporary file in spool_dir (the
+    system's temporary directory if None), so that only the samples of a
+    single chunk are held in memory; Excel files are read at once."""
+    if is_bulk_store(path):
+        yield from BulkStore(path).iter_chunks(chunk_size, dtype=dtype)
+        return
+    ordered = read_sample_names(path).sort_values()
+    blocks = [
+        ordered[start : start + chunk_size]
+        for start in range(0, len(ordered), chunk_size)
+    ]
+    if not _is_text(path):
+        bulk_df = read_expression_data(path, dtype=dtype)
+        for block in blocks:
+            yield bulk_df[block]
+        return
+    for chunk in _iter_spooled_blocks(path, blocks, dtype, spool_dir):
+        yield prepare_expression_df(chunk)
+
+
+def _iter_text_rows(path, delimiter, samples, positions, duplicated, dtype):
+    # Yields the values of samples in a text file in chunks of rows, as
+    # pairs of the positions of their genes in the store (given for each
+    # row of the file, -1 for genes without a name) and values, missing
+    # values set to 0. Rows of duplicated genes are held back and summed
+    # at the end as by prepare_expression_df, whose (compensated) sums
+    # differ from adding the rows one by one in the last digit.
+    reader = read_csv(
+        path,
+        index_col=0,
+        sep=delimiter,
+        dtype={name: dtype for name in samples},
+        engine="c",
+        chunksize=max(1, SPOOL_SIZE // max(1, len(samples))),
+    )
+    start = 0
+    duplicate_rows = []
+    for chunk in reader:
+        chunk_positions = positions[start : start + len(chunk)]
+        chunk_duplicated = duplicated[start : start + len(chunk)]
+        start += len(chunk)
+        values = chunk[samples].values
+        if chunk_duplicated.any():
+            duplicate_rows.append(
+                DataFrame(
+                    values[chunk_duplicated], index=chunk_positions[chunk_duplicated]
+                )
+            )
+        keep = (chunk_positions >= 0) & ~chunk_duplicated
+        yield chunk_positions[keep], np.nan_to_num(values[keep], copy=False, nan=0.0)
+    if duplicate_rows:
+        sums = concat(duplicate_rows).groupby(level=0).sum()
+        yield sums.index.values, sums.values.astype(dtype, copy=False)
+
+
+def write_bulk_store(path, store_path, chunk_size=256, dtype=np.float64):
+    """Converts a mixture data file into a BulkStore in the (new) directory
+    store_path, with blocks of chunk_size samples in alphabetical order. The
+    values of text files are parsed in a single pass over chunks of rows,
+    which are written directly into the preallocated blocks of the store,
+    so that files larger than memory can be converted; only the gene
+    column is scanned beforehand. Excel files are read at once. Returns the
+    store."""
+    if _is_text(path):
+        delimiter = sniff_delimiter(path)
+        sample_names = read_csv(path, index_col=0, sep=delimiter, nrows=0).columns
+        ordered = sample_names.sort_values()
+        raw_genes = read_csv(
+            path, index_col=0, sep=delimiter, usecols=[0], engine="c"
+        ).index
+        # genes are prepared as by prepare_expression_df: upper case, without
+        # missing names, sorted and with duplicates summed
+        genes = raw_genes.str.upper()
+        store_genes = genes[genes.notna()].unique().sort_values()
+        store = BulkStore.create(
+            store_path, store_genes, dtype=dtype, index_name=raw_genes.name
+        )
+        positions = store_genes.get_indexer(genes)
+        duplicated = genes.notna() & genes.duplicated(keep=False)
+        store.append_rows(
+            ordered,
+            _iter_text_rows(path, delimiter, ordered, positions, duplicated, dtype),
+            chunk_size=chunk_size,
+        )
+        return store
+
+    store = None
+    for chunk in iter_sample_chunks(path, chunk_size, dtype=dtype):
+        if store is None:
+            store = BulkStore.create(
+                store_path, chunk.index, dtype=dtype, index_name=chunk.index.name
+            )
+        store.append(chunk, chunk_size=chunk_size)
+    return store
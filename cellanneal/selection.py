@@ -0,0 +1,155 @@
+"""Compact representation of the genes selected for each mixture sample."""
+
+from collections.abc import Mapping
+from hashlib import sha256
+
+import numpy as np
+from pandas import Index
+
+
+class GeneSelection(Mapping):
+    """
+    Genes selected for each sample, stored as a bit-packed boolean matrix
+    over a single gene index shared by all samples.
+
+    Parameters
+    ----------
+    genes : array_like
+        Gene names, typically the index of the mixture data.
+    samples : array_like
+        Sample names.
+    mask : array_like
+        Boolean array of shape (genes, samples), True where a gene is
+        selected for a sample.
+
+    The object behaves like the dictionary of gene lists returned by
+    earlier versions of `make_gene_dictionary`: iterating over it yields
+    the sample names and ``selection[sample]`` returns the list of selected
+    gene names, in the order of `genes`. Internally, samples are handled via
+    integer positions (see `indices` and `positions`), which avoids label
+    lookups of every selected gene for every sample.
+    """
+
+    def __init__(self, genes, samples, mask):
+        self.genes = Index(genes)
+        self.samples = Index(samples)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (len(self.genes), len(self.samples)):
+            raise ValueError("mask must be of shape (genes, samples).")
+        # one packed row of bits per sample
+        self._packed = np.packbits(mask.T, axis=1)
+        # positions of the gene index in other indices, see positions
+        self._lookups = {}
+        self._genes_digest = None
+
+    @classmethod
+    def from_dict(cls, gene_dict, genes):
+        """Builds a selection from a dictionary of gene lists. All selected
+        genes must be contained in `genes`."""
+        genes = Index(genes)
+        mask = np.zeros((len(genes), len(gene_dict)), dtype=bool)
+        for j, sample in enumerate(gene_dict):
+            idx = genes.get_indexer(gene_dict[sample])
+            if np.any(idx < 0):
+                raise KeyError(
+                    "Genes selected for sample {} are missing from the data.".format(
+                        sample
+                    )
+                )
+            mask[idx, j] = True
+        return cls(genes, list(gene_dict), mask)
+
+    def mask(self, sample):
+        """Boolean mask over `genes` of the genes selected for `sample`."""
+        row = self._packed[self.samples.get_loc(sample)]
+        return np.unpackbits(row, count=len(self.genes)).view(bool)
+
+    def indices(self, sample):
+        """Integer positions in `genes` of the genes selected for `sample`."""
+        return np.flatnonzero(self.mask(sample))
+
+    def positions(self, sample, index):
+        """Integer positions in `index` (e.g. the index of the signature
+        data) of the genes selected for `sample`. The gene index is looked
+        up in `index` only once per index object. Raises KeyError if a
+        selected gene is missing from `index`."""
+        key = id(index)
+        if key not in self._lookups or self._lookups[key][0] is not index:
+            if index.equals(self.genes):
+                lookup = np.arange(len(index))
+            else:
+                lookup = index.get_indexer(self.genes)
+            # keep a reference to the index so that its id stays unique
+            self._lookups[key] = (index, lookup)
+        positions = self._lookups[key][1][self.indices(sample)]
+        if np.any(positions < 0):
+            raise KeyError(
+                "Genes selected for sample {} are missing from the data.".format(sample)
+            )
+        return positions
+
+    def digest(self, sample):
+        """Digest of the names of the genes selected for `sample`."""
+        if self._genes_digest is None:
+            self._genes_digest = sha256(
+                "\0".join(map(str, self.genes)).encode("utf-8")
+            ).digest()
+        h = sha256(self._genes_digest)
+        h.update(self.indices(sample).astype(np.int64).tobytes())
+        return h.digest()
+
+    def counts(self):
+        """Number of selected genes for each sample."""
+        return np.unpackbits(self._packed, axis=1, count=len(self.genes)).sum(axis=1)
+
+    def __getitem__(self, sample):
+        return self.genes[self.mask(sample)].tolist()
+
+    def __setitem__(self, sample, gene_list):
+        # replaces (or adds) a sample's selection given a list of gene names
+        mask = self.genes.isin(gene_list)
+        if mask.sum() < len(set(gene_list)):
+            raise KeyError(
+                "Genes selected for sample {} are missing from the data.".format(sample)
+            )
+        row = np.packbits(mask)
+        if sample in self.samples:
+            self._packed[self.samples.get_loc(sample)] = row
+        else:
+            self.samples = self.samples.append(Index([sample]))
+            self._packed = np.vstack((self._packed, row))
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __contains__(self, sample):
+        return sample in self.samples
+
+    def to_dict(self):
+        """Returns the selection as a dictionary of gene lists."""
+        return {sample: self[sample] for sample in self.samples}
+
+
+def gene_positions(gene_dict, sample, index):
+    """Integer positions in `index` of the genes selected for `sample`, for
+    a GeneSelection or a dictionary of gene lists. Raises KeyError if a
+    selected gene is missing from `index`."""
+    if isinstance(gene_dict, GeneSelection):
+        return gene_dict.positions(sample, index)
+    positions = index.get_indexer(gene_dict[sample])
+    if np.any(positions < 0):
+        raise KeyError(
+            "Genes selected for sample {} are missing from the data.".format(sample)
+        )
+    return positions
+
+
+def selected_genes(gene_dict, sample):
+    """Names of the genes selected for `sample` as an Index, for a
+    GeneSelection or a dictionary of gene lists."""
+    if isinstance(gene_dict, GeneSelection):
+        return gene_dict.genes[gene_dict.indices(sample)]
+    return Index(gene_dict[sample])
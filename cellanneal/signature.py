@@ -0,0 +1,332 @@
+"""Construction of signature data from single-cell count matrices.
+
+The cells of a sparse cells x genes count matrix (Matrix Market or scipy's
+CSR/CSC .npz format) are aggregated into one expression profile per cell
+type. The matrix is streamed from disk in chunks of non-zero entries and
+never densified, so that memory use is bounded by the size of the signature
+and the chunk size rather than by the number of cells."""
+
+import argparse
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame, read_csv
+
+from .readers import _open_text, _split_name, prepare_expression_df
+from .telemetry import emit
+
+
+def _read_mtx_header(f):
+    # reads the banner, comments and size line of a Matrix Market file
+    banner = f.readline().lower().split()
+    if len(banner) < 5 or banner[0] != "%%matrixmarket" or banner[2] != "coordinate":
+        raise ValueError("Not a Matrix Market file in coordinate format.")
+    field, symmetry = banner[3], banner[4]
+    if field not in ["real", "integer", "pattern"] or symmetry != "general":
+        raise ValueError(
+            "Unsupported Matrix Market format: {} {}.".format(field, symmetry)
+        )
+    line = f.readline()
+    while line.startswith("%") or not line.strip():
+        line = f.readline()
+    n_rows, n_cols, _ = (int(x) for x in line.split())
+    return (n_rows, n_cols), field
+
+
+def _iter_mtx_entries(path, chunk_size):
+    with _open_text(path) as f:
+        _, field = _read_mtx_header(f)
+        columns = [0, 1] if field == "pattern" else [0, 1, 2]
+        chunks = read_csv(
+            f,
+            delim_whitespace=True,
+            header=None,
+            usecols=columns,
+            dtype={0: np.int64, 1: np.int64, 2: np.float64},
+            comment="%",
+            chunksize=chunk_size,
+            engine="c",
+        )
+        for chunk in chunks:
+            values = np.ones(len(chunk)) if field == "pattern" else chunk[2].values
+            # indices are 1-based
+            yield chunk[0].values - 1, chunk[1].values - 1, values
+
+
+def _iter_npy(f, chunk_size):
+    # reads a .npy array from a file object in pieces of chunk_size elements
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    remaining = int(np.prod(shape))
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        yield np.frombuffer(f.read(n * dtype.itemsize), dtype=dtype, count=n)
+        remaining -= n
+
+
+def _npz_info(path):
+    with np.load(path) as npz:
+        sparse_format = npz["format"].item()
+        if isinstance(sparse_format, bytes):
+            sparse_format = sparse_format.decode("ascii")
+        if sparse_format not in ["csr", "csc"]:
+            raise ValueError(
+                "Unsupported sparse format {}, use csr or csc.".format(sparse_format)
+            )
+        return tuple(int(n) for n in npz["shape"]), sparse_format
+
+
+def _iter_npz_entries(path, chunk_size):
+    _, sparse_format = _npz_info(path)
+    with np.load(path) as npz:
+        indptr = npz["indptr"]
+    with zipfile.ZipFile(path) as zf:
+        with zf.open("indices.npy") as fi, zf.open("data.npy") as fd:
+            start = 0
+            for indices, data in zip(
+                _iter_npy(fi, chunk_size), _iter_npy(fd, chunk_size)
+            ):
+                # row (csr) or column (csc) of each entry
+                major = (
+                    np.searchsorted(
+                        indptr, np.arange(start, start + len(data)), side="right"
+                    )
+                    - 1
+                )
+                start += len(data)
+                if sparse_format == "csr":
+                    yield major, indices.astype(np.int64), data.astype(np.float64)
+                else:
+                    yield indices.astype(np.int64), major, data.astype(np.float64)
+
+
+def matrix_shape(path):
+    """Shape of a count matrix in Matrix Market (.mtx, optionally compressed
+    as .gz or .zst) or scipy's sparse .npz format."""
+    if _split_name(path)[0] == "npz":
+        return _npz_info(path)[0]
+    with _open_text(path) as f:
+        return _read_mtx_header(f)[0]
+
+
+def iter_matrix_entries(path, chunk_size=250000):
+    """Yields the non-zero entries of a count matrix in chunks of at most
+    chunk_size entries, as arrays of (0-based) rows, columns and values."""
+    if _split_name(path)[0] == "npz":
+        return _iter_npz_entries(path, chunk_size)
+    return _iter_mtx_entries(path, chunk_size)
+
+
+def read_names(path, column=0):
+    """Reads names (e.g. of genes or cell types), one per line, from
+    `column` of a comma- or tab-separated text file."""
+    with _open_text(path) as f:
+        first_line = f.readline()
+    sep = "\t" if "\t" in first_line or "," not in first_line else ","
+    with _open_text(path) as f:
+        names = read_csv(f, sep=sep, header=None, dtype=str, keep_default_na=False)
+    return names.iloc[:, column].values
+
+
+def _drop_header(names, n):
+    # name files may start with a header line
+    if len(names) == n + 1:
+        return names[1:]
+    return names
+
+
+def build_signature(
+    counts_path,
+    labels_path,
+    genes_path=None,
+    normalize_cells=True,
+    chunk_size=250000,
+    label_column=-1,
+    gene_column=0,
+    events=None,
+):
+    """Builds signature data from a sparse count matrix of single cells.
+
+    Input:
+    counts_path  -  Path of the count matrix, cells x genes or genes x cells,
+                    in Matrix Market (.mtx, optionally as .mtx.gz or .mtx.zst)
+                    or scipy's CSR/CSC .npz format
+    labels_path  -  Path of a text file with the cell type of each cell, one
+                    line per cell in matrix order, labels are taken from
+                    label_column; cells without a label are left out
+    genes_path  -  Path of a text file with the gene names, one line per
+                   gene, names are taken from gene_column; if None, genes
+                   are numbered
+    normalize_cells  -  if True, each cell's counts are normalised to sum 1
+                        before aggregation, so that all cells of a type
+                        contribute equally; otherwise counts are pooled
+    chunk_size  -  number of non-zero entries processed at a time
+    events  -  sink of the progress events (see telemetry.py), the console
+               if None; the size of the data is reported as event
+               single_cell_data
+
+    Output:
+    celltype_df  -  signature data with genes as rows and cell types as
+                    columns, each column normalised to sum 1 and prepared
+                    as imported data (see prepare_expression_df)
+
+    The orientation of the matrix is inferred from the number of labels. A
+    file with one line more than cells or genes is read without its first
+    line (header)."""
+    shape = matrix_shape(counts_path)
+    labels = read_names(labels_path, column=label_column)
+    if len(labels) in [shape[0], shape[0] + 1]:
+        cell_axis = 0
+    elif len(labels) in [shape[1], shape[1] + 1]:
+        cell_axis = 1
+    else:
+        raise ValueError(
+            "{} labels do not match a matrix of shape {}.".format(len(labels), shape)
+        )
+    n_cells, n_genes = shape[cell_axis], shape[1 - cell_axis]
+    labels = _drop_header(labels, n_cells)
+    if genes_path is None:
+        genes = np.arange(n_genes).astype(str)
+    else:
+        genes = _drop_header(read_names(genes_path, column=gene_column), n_genes)
+        if len(genes) != n_genes:
+            raise ValueError(
+                "{} gene names do not match {} genes.".format(len(genes), n_genes)
+            )
+
+    # cell type of each cell, -1 for unlabelled cells
+    celltypes, type_of = np.unique(labels, return_inverse=True)
+    if celltypes[0] == "":
+        celltypes = celltypes[1:]
+        type_of = type_of - 1
+    n_types = len(celltypes)
+    emit(
+        events,
+        "single_cell_data",
+        n_cells=int(np.sum(type_of >= 0)),
+        n_celltypes=n_types,
+        n_genes=n_genes,
+    )
+
+    def entries():
+        # (cell, gene, value) of the non-zero entries of labelled cells
+        for rows, cols, values in iter_matrix_entries(counts_path, chunk_size):
+            cells, gene_idx = (rows, cols) if cell_axis == 0 else (cols, rows)
+            keep = type_of[cells] >= 0
+            yield cells[keep], gene_idx[keep], values[keep]
+
+    if normalize_cells:
+        # a first pass over the matrix collects each cell's total counts
+        totals = np.zeros(n_cells)
+        for cells, _, values in entries():
+            totals += np.bincount(cells, weights=values, minlength=n_cells)
+        with np.errstate(divide="ignore"):
+            scale = np.where(totals > 0, 1 / totals, 0)
+
+    # pseudobulk of each cell type, accumulated over chunks of entries
+    pseudobulk = np.zeros(n_types * n_genes)
+    for cells, gene_idx, values in entries():
+        if normalize_cells:
+            values = values * scale[cells]
+        pseudobulk += np.bincount(
+            type_of[cells] * n_genes + gene_idx,
+            weights=values,
+            minlength=n_types * n_genes,
+        )
+    pseudobulk = pseudobulk.reshape(n_types, n_genes).T
+    with np.errstate(invalid="ignore"):
+        pseudobulk /= pseudobulk.sum(axis=0)
+
+    celltype_df = DataFrame(pseudobulk, index=genes, columns=celltypes)
+    return prepare_expression_df(celltype_df)
+
+
+def init_parser(parser):
+    """Initialize parser arguments."""
+    parser.add_argument(
+        "counts_path",
+        type=str,
+        help=(
+            """Path to the sparse count matrix of single cells; .mtx (also
+            .mtx.gz) or scipy .npz (csr or csc) format, cells x genes or
+            genes x cells."""
+        ),
+    )
+
+    parser.add_argument(
+        "labels_path",
+        type=str,
+        help=("""Path to a text file with the cell type of each cell."""),
+    )
+
+    parser.add_argument(
+        "output_path",
+        type=str,
+        help=("""Path of the .csv file in which to store the signature data."""),
+    )
+
+    parser.add_argument(
+        "--genes",
+        type=str,
+        default=None,
+        help=("""Path to a text file with the name of each gene."""),
+    )
+
+    parser.add_argument(
+        "--gene_column",
+        type=int,
+        default=0,
+        help=("""Column of the gene file which holds the gene names."""),
+    )
+
+    parser.add_argument(
+        "--label_column",
+        type=int,
+        default=-1,
+        help=("""Column of the label file which holds the cell types."""),
+    )
+
+    parser.add_argument(
+        "--pool_counts",
+        action="store_true",
+        help=(
+            """Pool the counts of all cells of a type instead of normalising
+            each cell first."""
+        ),
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=250000,
+        help=("""Number of non-zero matrix entries processed at a time."""),
+    )
+
+    return parser
+
+
+def main():
+    """Builds a signature data file for cellanneal from single-cell data."""
+    my_parser = argparse.ArgumentParser(
+        description=(
+            "cellanneal-signature builds signature data from single-cell counts."
+        )
+    )
+    args = init_parser(my_parser).parse_args()
+
+    print("\n+++ Building signature data ... +++\n")
+    celltype_df = build_signature(
+        Path(args.counts_path),
+        Path(args.labels_path),
+        genes_path=Path(args.genes) if args.genes else None,
+        normalize_cells=not args.pool_counts,
+        chunk_size=args.chunk_size,
+        label_column=args.label_column,
+        gene_column=args.gene_column,
+    )
+    celltype_df.to_csv(args.output_path, header=True, index=True, sep=",")
+    print("\n+++ Signature data stored in {} +++".format(args.output_path))
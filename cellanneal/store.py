@@ -0,0 +1,227 @@
+"""On-disk store of mixture data for cohorts which do not fit into memory.
+
+A bulk store is a directory in which the samples (columns) of a mixture data
+set are kept in blocks of columns, one .npy file per block, in the spirit of
+a Zarr array chunked along columns. Blocks are memory-mapped when accessed,
+so that only the data of the samples (and genes) actually used is read."""
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame, Index, Series
+
+
+STORE_FORMAT = "cellanneal-bulk-store"
+STORE_VERSION = 1
+
+
+def is_bulk_store(path):
+    """Whether path is the directory of a BulkStore."""
+    return Path(path).is_dir() and (Path(path) / "meta.json").is_file()
+
+
+class BulkStore(object):
+    """
+    Mixture data stored in blocks of columns in a directory.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory of an existing store, see `create` for making a new one.
+
+    Genes are rows and samples are columns, as in a mixture dataframe, and
+    the store provides the parts of the dataframe interface used by
+    `make_gene_dictionary`, `deconvolve` and `cellanneal_pipe`: `index`
+    (genes), `columns` (samples), ``store[sample]`` for a single sample as
+    a Series backed by a read-only memory map and ``store[samples]`` for a
+    list of samples as a dataframe held in memory.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._open()
+
+    def _open(self):
+        with open(self.path / "meta.json") as f:
+            meta = json.load(f)
+        if meta.get("format") != STORE_FORMAT:
+            raise ValueError("{} is not a bulk store.".format(self.path))
+        if meta["version"] > STORE_VERSION:
+            raise ValueError(
+                "{} was written by a newer version of cellanneal.".format(self.path)
+            )
+        self.dtype = np.dtype(meta["dtype"])
+        self._chunks = meta["chunks"]
+        self.index = Index(
+            np.load(self.path / "genes.npy"), dtype=object, name=meta["index_name"]
+        )
+        # samples are appended to the names before the metadata is updated
+        samples = np.load(self.path / "samples.npy")[: sum(self._chunks)]
+        self.columns = Index(samples, dtype=object)
+        # block and column within the block of each sample
+        self._block_of = np.repeat(np.arange(len(self._chunks)), self._chunks)
+        self._column_of = np.concatenate(
+            [np.arange(n) for n in self._chunks] + [np.zeros(0, dtype=int)]
+        )
+        self._blocks = {}
+
+    @classmethod
+    def create(cls, path, genes, dtype=np.float64, index_name=None):
+        """Creates an empty store for data on `genes` in directory `path`,
+        which must not exist yet, and returns it."""
+        path = Path(path)
+        path.mkdir(parents=True)
+        (path / "blocks").mkdir()
+        np.save(path / "genes.npy", np.asarray(genes, dtype=str))
+        np.save(path / "samples.npy", np.zeros(0, dtype=str))
+        meta = {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "dtype": np.dtype(dtype).str,
+            "index_name": index_name,
+            "chunks": [],
+        }
+        _write_json(path / "meta.json", meta)
+        return cls(path)
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    def _block_file(self, b):
+        return self.path / "blocks" / "{:06d}.npy".format(b)
+
+    def block(self, b):
+        """Values of block `b` as a read-only memory map of shape (genes,
+        samples of the block)."""
+        if b not in self._blocks:
+            self._blocks[b] = np.load(self._block_file(b), mmap_mode="r")
+        return self._blocks[b]
+
+    def blocks(self):
+        """Yields the values of all blocks in the order of `columns`."""
+        for b in range(len(self._chunks)):
+            yield self.block(b)
+
+    def append(self, df, chunk_size=256):
+        """Appends the samples of dataframe `df` as new blocks of at most
+        chunk_size samples. `df` must hold data on the same genes in the same
+        order as the store, and new sample names must be unique."""
+        if not df.index.equals(self.index):
+            raise ValueError("The genes of the data do not match the store.")
+        if df.columns.has_duplicates or self.columns.isin(df.columns).any():
+            raise ValueError("Sample names in the store must be unique.")
+        with open(self.path / "meta.json") as f:
+            meta = json.load(f)
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        for start in range(0, len(df.columns), chunk_size):
+            values = df.values[:, start : start + chunk_size]
+            block_file = self._block_file(len(meta["chunks"]))
+            tmp_file = block_file.with_name(block_file.name + tmp_suffix)
+            with open(tmp_file, "wb") as f:
+                # columns are contiguous on disk
+                np.save(f, np.asfortranarray(values, dtype=self.dtype))
+            os.replace(tmp_file, block_file)
+            meta["chunks"].append(values.shape[1])
+        self._commit(meta, df.columns)
+
+    def append_rows(self, samples, row_chunks, chunk_size=256):
+        """Appends the samples named `samples` as new blocks of at most
+        chunk_size samples, whose values are given in chunks of rows:
+        `row_chunks` yields pairs of positions in `index` (the genes of the
+        rows) and arrays of shape (rows, samples), which are added to the
+        zero-initialised blocks, so that rows of the same gene are summed.
+        The blocks are preallocated as memory-mapped files, which allows to
+        write data larger than memory in a single pass over its rows."""
+        samples = Index(samples)
+        if samples.has_duplicates or self.columns.isin(samples).any():
+            raise ValueError("Sample names in the store must be unique.")
+        with open(self.path / "meta.json") as f:
+            meta = json.load(f)
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        starts = range(0, len(samples), chunk_size)
+        block_files = [
+            self._block_file(len(meta["chunks"]) + k) for k in range(len(starts))
+        ]
+        tmp_files = [f.with_name(f.name + tmp_suffix) for f in block_files]
+        blocks = [
+            # columns are contiguous on disk
+            np.lib.format.open_memmap(
+                tmp_file,
+                mode="w+",
+                dtype=self.dtype,
+                shape=(len(self.index), len(samples[start : start + chunk_size])),
+                fortran_order=True,
+            )
+            for tmp_file, start in zip(tmp_files, starts)
+        ]
+        for rows, values in row_chunks:
+            rows = np.asarray(rows)
+            # rows of the same gene within a chunk are summed as well
+            unique = len(np.unique(rows)) == len(rows)
+            for block, start in zip(blocks, starts):
+                block_values = values[:, start : start + chunk_size]
+                if unique:
+                    block[rows] += block_values
+                else:
+                    np.add.at(block, rows, block_values)
+        for block in blocks:
+            block.flush()
+            meta["chunks"].append(block.shape[1])
+        # the memory maps are closed before the files are moved into place
+        block = blocks = None
+        for tmp_file, block_file in zip(tmp_files, block_files):
+            os.replace(tmp_file, block_file)
+        self._commit(meta, samples)
+
+    def _commit(self, meta, samples):
+        # the names of the appended samples are written before the metadata,
+        # so that readers see either the old or the new store
+        samples = self.columns.append(Index(samples))
+        tmp_file = self.path / ("samples.npy.{}.tmp".format(os.getpid()))
+        with open(tmp_file, "wb") as f:
+            np.save(f, np.asarray(samples, dtype=str))
+        os.replace(tmp_file, self.path / "samples.npy")
+        _write_json(self.path / "meta.json", meta)
+        self._open()
+
+    def read(self, columns=None):
+        """Reads the samples in `columns` (all if None) into a dataframe."""
+        columns = self.columns if columns is None else Index(columns)
+        pos = self.columns.get_indexer(columns)
+        if np.any(pos < 0):
+            raise KeyError("Samples missing from the store.")
+        values = np.empty((len(self.index), len(pos)), dtype=self.dtype, order="F")
+        # read block by block, each block is opened once
+        blocks = self._block_of[pos]
+        for b in np.unique(blocks):
+            (j,) = np.nonzero(blocks == b)
+            values[:, j] = self.block(b)[:, self._column_of[pos[j]]]
+        return DataFrame(values, index=self.index, columns=columns, copy=False)
+
+    def iter_chunks(self, chunk_size, dtype=None):
+        """Yields the samples in alphabetical order as dataframes of at most
+        chunk_size samples, optionally converted to dtype."""
+        ordered = self.columns.sort_values()
+        for start in range(0, len(ordered), chunk_size):
+            chunk = self.read(ordered[start : start + chunk_size])
+            yield chunk if dtype is None else chunk.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            j = self.columns.get_loc(key)
+            column = self.block(self._block_of[j])[:, self._column_of[j]]
+            return Series(column, index=self.index, name=key, copy=False)
+        return self.read(key)
+
+    def __len__(self):
+        return len(self.columns)
+
+
+def _write_json(file, obj):
+    tmp_file = file.with_name("{}.{}.tmp".format(file.name, os.getpid()))
+    with open(tmp_file, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_file, file)
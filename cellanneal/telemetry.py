@@ -0,0 +1,236 @@
+"""Structured progress events of a cellanneal run and sinks which report them.
+
+make_gene_dictionary, deconvolve and cellanneal_pipe report what they are
+doing as events: dicts with the kind of event ("event"), the time at which
+it occurred ("time", seconds since the epoch) and further fields, e.g. the
+wall time, iterations (nit), objective evaluations (nfev), final energy
+(fun) and stop reason of each deconvolved sample. Any callable which takes
+such a dict can serve as sink for the events; ConsoleSink prints the
+human-readable messages cellanneal has always shown, QuietSink reports
+errors only and JSONLinesSink writes one JSON object per line (NDJSON) to
+a file, which other programs can follow during long runs."""
+
+import json
+import math
+import sys
+import time
+
+
+# headers printed by ConsoleSink at the start of the pipeline's stages
+STAGE_TITLES = {
+    "import_mixture": "Importing mixture data",
+    "import_signature": "Importing signature data",
+    "gene_sets": "Constructing gene sets",
+    "deconvolution": "Running cellanneal",
+    "write": "Writing results to file",
+    "figures": 'Storing figures in folder "figures"',
+}
+
+
+def emit(sink, event, **fields):
+    """Passes an event of kind `event` with the given fields to `sink`,
+    the console (see ConsoleSink) if sink is None."""
+    record = {"event": event, "time": time.time()}
+    record.update(fields)
+    (CONSOLE if sink is None else sink)(record)
+
+
+class Stage(object):
+    """
+    Context manager which emits the start and end of a stage of a run.
+
+    Parameters
+    ----------
+    sink : callable or None
+        Sink of the events, see `emit`.
+    stage : str
+        Name of the stage, e.g. one of `STAGE_TITLES`.
+    **fields
+        Further fields of both events.
+
+    The end event carries the wall time of the stage in seconds and is
+    emitted even if the stage raises an exception.
+    """
+
+    def __init__(self, sink, stage, **fields):
+        self.sink = sink
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        emit(self.sink, "stage_start", stage=self.stage, **self.fields)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        emit(
+            self.sink,
+            "stage_end",
+            stage=self.stage,
+            wall_time=time.perf_counter() - self.start,
+            completed=exc_type is None,
+            **self.fields
+        )
+        return False
+
+
+def _format_sample_end(record):
+    if record["stop_reason"] == "failed":
+        return "\nError: Sample {} could not be deconvolved.\nPossibly the gene set for this sample is too small.\nSee online documentation for more info.\n".format(
+            record["sample"]
+        )
+    text = "Finished sample {} of {} ({}) in {:.2f} s".format(
+        record["n_done"], record["n_total"], record["sample"], record["wall_time"]
+    )
+    if record["nit"] > 0:
+        text += ", {} iterations, {} evaluations, distance {:.6g}".format(
+            record["nit"], record["nfev"], record["fun"]
+        )
+    return text + " ({})".format(record["stop_reason"])
+
+
+class ConsoleSink(object):
+    """
+    Prints events as human-readable messages.
+
+    Parameters
+    ----------
+    stream : file-like, optional
+        Stream to which messages are written. Default is standard output
+        at the time of each event.
+
+    Events of unknown kinds are ignored.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def _message(self, record):
+        event = record["event"]
+        if event == "stage_start":
+            if record["stage"] in STAGE_TITLES:
+                return "\n+++ {} ... +++".format(STAGE_TITLES[record["stage"]])
+        elif event == "chunk_start":
+            return "\n+++ Processing samples {} to {} of {} ... +++".format(
+                record["first"], record["last"], record["n_samples"]
+            )
+        elif event == "high_var_genes":
+            return """{} highly variable genes identified in cell type
+        reference.""".format(
+                record["n_genes"]
+            )
+        elif event == "gene_set":
+            return "\t{} of these are within thresholds for sample {}".format(
+                record["n_genes"], record["sample"]
+            )
+        elif event == "sample_groups":
+            return "{} samples share {} gene sets, {} samples are duplicates of others.".format(
+                record["n_samples"], record["n_groups"], record["n_duplicates"]
+            )
+        elif event == "single_cell_data":
+            return "{} cells of {} cell types, {} genes.".format(
+                record["n_cells"], record["n_celltypes"], record["n_genes"]
+            )
+        elif event == "input_cache":
+            return "using binary copy of {} from {}".format(
+                record["file"], record["cache_dir"]
+            )
+        elif event == "cache":
+            return "Result cache: {} hits, {} misses.".format(
+                record["hits"], record["misses"]
+            )
+        elif event == "deconvolution_start":
+            if record["n_jobs"] != 1 and record["n_total"] > 0:
+                return "Deconvolving {} samples in {} processes ...".format(
+                    record["n_total"], record["n_jobs"]
+                )
+        elif event == "sample_start":
+            return "Deconvolving sample {} of {} ({}) ...".format(
+                record["n_started"], record["n_total"], record["sample"]
+            )
+        elif event == "sample_end":
+            return _format_sample_end(record)
+        elif event == "info":
+            return "\nInfo: {}".format(record["message"])
+        elif event == "error":
+            return "Error: {}".format(record["message"])
+        elif event == "run_end":
+            return "\n+++ Finished. +++\n"
+        return None
+
+    def __call__(self, record):
+        message = self._message(record)
+        if message is not None:
+            print(message, file=self.stream or sys.stdout)
+
+
+class QuietSink(object):
+    """Discards all events except errors, which are printed to standard
+    error."""
+
+    def __call__(self, record):
+        if record["event"] == "error":
+            print("Error: {}".format(record["message"]), file=sys.stderr)
+
+
+def _json_value(value):
+    # numpy scalars are converted to python numbers, NaN and infinity are
+    # not valid JSON and written as null
+    if hasattr(value, "item") and getattr(value, "ndim", None) == 0:
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+class JSONLinesSink(object):
+    """
+    Writes events as newline-delimited JSON, one object per line.
+
+    Parameters
+    ----------
+    path : str or Path
+        File to which events are written.
+    append : bool, optional
+        Whether to append to an existing file rather than replace it.
+        Default is False.
+
+    Each line is flushed when written, so that the file can be followed
+    while the run progresses. Non-finite numbers are written as null. Use
+    the sink as context manager or call `close` when done.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, "a" if append else "w", encoding="utf-8")
+
+    def __call__(self, record):
+        record = {key: _json_value(value) for key, value in record.items()}
+        line = json.dumps(record, default=str)
+        self.file.write(line + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class MultiSink(object):
+    """Passes each event on to all of the given sinks."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def __call__(self, record):
+        for sink in self.sinks:
+            sink(record)
+
+
+# default sink of all functions which report events
+CONSOLE = ConsoleSink()
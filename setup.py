@@ -25,6 +25,7 @@ setup(
         "xlrd",
         "openpyxl",
     ],
+    extras_require={"zstd": ["zstandard"]},
     classifiers=[
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python",
@@ -33,5 +34,11 @@ setup(
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
-    entry_points={"console_scripts": ["cellanneal = cellanneal.__main__:main"]},
+    entry_points={
+        "console_scripts": [
+            "cellanneal = cellanneal.__main__:main",
+            "cellanneal-signature = cellanneal.signature:main",
+            "cellanneal-benchmark = cellanneal.benchmark:main",
+        ]
+    },
 )
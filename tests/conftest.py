@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pandas import DataFrame
+
+from cellanneal.readers import read_expression_data
+
+EXAMPLE_DATA = Path(__file__).parent.parent / "examples" / "example_data"
+
+
+@pytest.fixture(scope="session")
+def mixture_path():
+    return EXAMPLE_DATA / "mixture_data_liver_tumor.csv"
+
+
+@pytest.fixture(scope="session")
+def signature_df():
+    return read_expression_data(EXAMPLE_DATA / "signature_data_human_liver.csv")
+
+
+@pytest.fixture(scope="session")
+def bulk_df(mixture_path):
+    return read_expression_data(mixture_path)
+
+
+@pytest.fixture(params=["csv", "csv.gz", "txt"])
+def mixture_file(request, tmp_path):
+    rng = np.random.default_rng(5)
+    genes = ["gene{}".format(i) for i in rng.permutation(60)]
+    # duplicate genes (also in other case), a gene without a name and
+    # missing values
+    genes[3] = "GENE7"
+    genes[10] = "gene7"
+    genes[20] = np.nan
+    samples = ["s{:02d}".format(j) for j in rng.permutation(11)]
+    df = DataFrame(rng.random((60, 11)).round(3), index=genes, columns=samples)
+    df.index.name = "gene"
+    df.iloc[5, 2] = np.nan
+    path = tmp_path / "mixture.{}".format(request.param)
+    df.to_csv(path, sep="\t" if request.param == "txt" else ",")
+    return path
@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from cellanneal.benchmark import LAZY_MODULES, check_startup, startup_benchmark
+from cellanneal.benchmark import run_benchmarks, synthetic_mixtures
+from cellanneal.benchmark import warm_start_benchmark
+from cellanneal.general import make_gene_dictionary
+from cellanneal.telemetry import QuietSink
+
+
+def test_warm_start_benchmark(signature_df):
+    bulk_df, signature_sub, _ = synthetic_mixtures(
+        signature_df, n_samples=3, n_genes=1500, n_celltypes=6, seed=2
+    )
+    gene_dict = make_gene_dictionary(signature_sub, bulk_df, events=QuietSink())
+    bench_df = warm_start_benchmark(
+        signature_sub, bulk_df, gene_dict, 0.99, maxiter=50, seed=2
+    )
+    assert list(bench_df.index) == sorted(bulk_df.columns)
+    for label in ["random", "warm"]:
+        # the evaluations are counted wherever the target was reached
+        reached = bench_df["rho_" + label] >= 0.99
+        assert bench_df.loc[reached, "nfev_" + label].ge(1).all()
+        assert bench_df.loc[~reached, "nfev_" + label].isna().all()
+
+
+def test_run_benchmarks_stores_warm_start(signature_df, tmp_path):
+    results = run_benchmarks(
+        signature_df,
+        n_samples=2,
+        n_genes=1000,
+        n_celltypes=5,
+        maxiter=20,
+        micro=False,
+        target_rho=0.99,
+    )
+    assert set(results["warm_start"]) == {
+        "{}_{}".format(metric, label)
+        for metric in ["reached", "nfev", "time"]
+        for label in ["random", "warm"]
+    }
+    assert len(results["warm_start_samples"]) == 2
+    path = tmp_path / "results.json"
+    with open(path, "w") as f:
+        json.dump(results, f)
+    with open(path) as f:
+        assert json.load(f)["settings"]["target_rho"] == 0.99
+    assert np.isfinite(results["deconvolution"]["mae"])
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "import cellanneal",
+        "import cellanneal.__main__",
+        "from cellanneal.pipelines import cellanneal_pipe",
+    ],
+)
+def test_startup_is_lazy(statement, monkeypatch):
+    # the fresh interpreters import cellanneal from this checkout
+    monkeypatch.chdir(Path(__file__).parent.parent)
+    _, loaded = startup_benchmark(statement, repeat=1)
+    assert not set(loaded) & set(LAZY_MODULES)
+    # a generous limit which only fails for gross regressions
+    assert check_startup(max_time=10.0, statement=statement, repeat=1) <= 10.0
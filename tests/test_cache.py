@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+from cellanneal import cache as cache_module
+from cellanneal.cache import ResultCache
+from cellanneal.general import deconvolve, make_gene_dictionary
+from cellanneal.selection import GeneSelection
+from cellanneal.telemetry import QuietSink
+
+
+@pytest.fixture(scope="module")
+def data(signature_df, bulk_df):
+    bulk = bulk_df[bulk_df.columns[:2]]
+    gene_dict = make_gene_dictionary(signature_df, bulk, events=QuietSink())
+    return signature_df, bulk, gene_dict
+
+
+def run(data, cache_path, gene_dict=None, **kwargs):
+    signature_df, bulk, default_gene_dict = data
+    options = dict(maxiter=3, seed=1)
+    options.update(kwargs)
+    cache = ResultCache(cache_path)
+    result = deconvolve(
+        signature_df,
+        bulk,
+        options.pop("maxiter"),
+        default_gene_dict if gene_dict is None else gene_dict,
+        cache=cache,
+        return_info=True,
+        events=QuietSink(),
+        **options
+    )
+    return result, cache
+
+
+def test_rerun_hits_cache(data, tmp_path):
+    (first, _), cache = run(data, tmp_path)
+    assert cache.hits == 0 and cache.misses == 2
+    (second, info), cache = run(data, tmp_path)
+    assert cache.hits == 2 and cache.misses == 0
+    assert (info["stop_reason"] == "cached").all()
+    assert second.equals(first)
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"engine": "nnls"},
+        {"maxiter": 4},
+        {"warm_start": "sqrt"},
+        {"stop_iter": 2},
+        {"simplex": True},
+        {"seed": 2},
+    ],
+)
+def test_changed_parameters_miss(data, tmp_path, change):
+    run(data, tmp_path)
+    _, cache = run(data, tmp_path, **change)
+    assert cache.hits == 0 and cache.misses == 2
+
+
+def test_changed_gene_set_misses(data, tmp_path):
+    run(data, tmp_path)
+    _, bulk, gene_dict = data
+    gene_lists = gene_dict.to_dict()
+    sample = bulk.columns[0]
+    gene_lists[sample] = gene_lists[sample][1:]
+    changed = GeneSelection.from_dict(gene_lists, bulk.index)
+    _, cache = run(data, tmp_path, gene_dict=changed)
+    # only the sample with a different gene set is deconvolved again
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_cache_version_invalidates(data, tmp_path, monkeypatch):
+    run(data, tmp_path)
+    monkeypatch.setattr(cache_module, "CACHE_VERSION", b"cellanneal-test-version")
+    _, cache = run(data, tmp_path)
+    assert cache.hits == 0 and cache.misses == 2
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    cache = ResultCache(tmp_path)
+    keys = ["{:02x}".format(i) * 32 for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, np.full(100, float(i)))
+        # entries were used one after the other
+        os.utime(cache._file(key), (1000 + i, 1000 + i))
+    entry_size = cache._file(keys[0]).stat().st_size
+    # using the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) is not None
+    cache.max_size = 2 * entry_size
+    assert cache.evict() == 2
+    assert cache.load(keys[1]) is None and cache.load(keys[2]) is None
+    assert cache.load(keys[0]) is not None and cache.load(keys[3]) is not None
+    assert cache.size() <= cache.max_size
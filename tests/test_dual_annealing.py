@@ -0,0 +1,57 @@
+import numpy as np
+
+from cellanneal import dual_annealing as da
+
+
+def sphere(x):
+    return np.sum((x - 0.3) ** 2)
+
+
+def state_of(rand_state):
+    key, pos, has_gauss = rand_state.get_state()[1:4]
+    return key.copy(), pos, has_gauss
+
+
+def test_restarts_draw_from_new_streams(monkeypatch):
+    # record the random states of the annealing and its restarts, and the
+    # state of each one when the next one is spawned
+    states = []
+    states_at_restart = []
+    spawn = da._spawn_random_state
+
+    def recording_spawn(seed_seq):
+        if states:
+            states_at_restart.append(state_of(states[-1]))
+        states.append(spawn(seed_seq))
+        return states[-1]
+
+    monkeypatch.setattr(da, "_spawn_random_state", recording_spawn)
+    result = da.dual_annealing(
+        sphere,
+        bounds=[[0, 1]] * 3,
+        maxiter=40,
+        seed=np.random.SeedSequence(7),
+        restart_temp_ratio=0.1,
+        no_local_search=True,
+    )
+    assert result.nit == 40
+    assert len(states) > 2
+    # after a restart, the earlier streams are no longer drawn from
+    for rand_state, state in zip(states, states_at_restart):
+        key, pos, has_gauss = state_of(rand_state)
+        assert np.array_equal(key, state[0]) and (pos, has_gauss) == state[1:]
+
+
+def test_seed_sequence_is_reproducible():
+    results = [
+        da.dual_annealing(
+            sphere,
+            bounds=[[0, 1]] * 3,
+            maxiter=40,
+            seed=np.random.SeedSequence(7),
+            restart_temp_ratio=0.1,
+        )
+        for _ in range(2)
+    ]
+    assert np.array_equal(results[0].x, results[1].x)
+    assert results[0].nfev == results[1].nfev
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from pandas import DataFrame, cut
+
+from cellanneal.cache import ResultCache, hash_frame
+from cellanneal.general import deconvolve, find_high_var_genes
+from cellanneal.general import gene_dispersion_stats, make_gene_dictionary
+from cellanneal.telemetry import QuietSink
+
+
+def reference_dispersion_norm(celltype_df):
+    # per-gene computation with pandas, as done before gene_dispersion_stats
+    sc_ref_norm = celltype_df.div(celltype_df.sum(axis=0), axis=1)
+    mean = np.mean(sc_ref_norm, axis=1)
+    mean_of_sq = np.multiply(sc_ref_norm, sc_ref_norm).mean(axis=1)
+    var = mean_of_sq - mean**2
+    var *= np.shape(sc_ref_norm)[1] / (np.shape(sc_ref_norm)[1] - 1)
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+
+    df = DataFrame(index=sc_ref_norm.index)
+    df["means"] = mean
+    df["dispersions"] = dispersion
+    df["mean_bin"] = cut(df["means"], bins=20)
+    disp_grouped = df.groupby("mean_bin")["dispersions"]
+    disp_mean_bin = disp_grouped.mean()
+    disp_std_bin = disp_grouped.std(ddof=1)
+    one_gene_per_bin = disp_std_bin.isnull()
+    disp_std_bin[one_gene_per_bin.values] = disp_mean_bin[
+        one_gene_per_bin.values
+    ].values
+    disp_mean_bin[one_gene_per_bin.values] = 0
+    return (
+        df["dispersions"].values - disp_mean_bin[df["mean_bin"].values].values
+    ) / disp_std_bin[df["mean_bin"].values].values
+
+
+def reference_high_var_genes(celltype_df, disp_min):
+    dispersion_norm = reference_dispersion_norm(celltype_df).astype("float32")
+    dispersion_norm[np.isnan(dispersion_norm)] = 0
+    return celltype_df.index[dispersion_norm > disp_min].tolist()
+
+
+@pytest.fixture
+def celltype_df():
+    rng = np.random.default_rng(3)
+    values = rng.gamma(0.5, 20.0, size=(600, 7)).round()
+    # genes without expression, with equal expression in all cell types and
+    # a single highly expressed gene, which is alone in its mean bin
+    values[:20] = 0
+    values[20:30] = 5
+    values[30] = 5000
+    genes = ["GENE{:04d}".format(i) for i in range(len(values))]
+    return DataFrame(values, index=genes, columns=list("ABCDEFG"))
+
+
+def test_dispersion_stats_match_reference(celltype_df):
+    stats = gene_dispersion_stats(celltype_df)
+    np.testing.assert_allclose(
+        stats[:, 2], reference_dispersion_norm(celltype_df), rtol=1e-10
+    )
+
+
+@pytest.mark.parametrize("disp_min", [-1.0, 0.0, 0.5, 1.0, 2.0])
+def test_high_var_genes_match_reference(celltype_df, disp_min):
+    expected = reference_high_var_genes(celltype_df, disp_min)
+    assert find_high_var_genes(celltype_df, disp_min) == expected
+
+
+def test_cached_high_var_genes_match_reference(celltype_df, tmp_path):
+    expected = reference_high_var_genes(celltype_df, 0.5)
+    cache = ResultCache(tmp_path)
+    assert find_high_var_genes(celltype_df, 0.5, cache=cache) == expected
+    # the second call uses the stored statistics
+    assert cache.load(cache.gene_stats_key(hash_frame(celltype_df))) is not None
+    assert find_high_var_genes(celltype_df, 0.5, cache=cache) == expected
+
+
+def deconvolve_samples(signature_df, bulk, cache=None, **kwargs):
+    events = QuietSink()
+    gene_dict = make_gene_dictionary(signature_df, bulk, events=events)
+    return deconvolve(
+        signature_df, bulk, 5, gene_dict, seed=1, cache=cache, events=events, **kwargs
+    )
+
+
+@pytest.fixture(scope="module")
+def replicates(bulk_df):
+    # two samples with identical data and a third one
+    bulk = bulk_df[bulk_df.columns[:2]].copy()
+    bulk.columns = ["B", "C"]
+    bulk["A"] = bulk["B"]
+    return bulk
+
+
+def test_duplicate_result_does_not_depend_on_run(signature_df, replicates, tmp_path):
+    alone = deconvolve_samples(signature_df, replicates[["B"]])
+    together = deconvolve_samples(signature_df, replicates)
+    assert together.loc["B"].equals(alone.loc["B"])
+    assert together.loc["A"].equals(alone.loc["B"])
+    # results cached in a run with the duplicate are those of a run without
+    deconvolve_samples(signature_df, replicates, cache=ResultCache(tmp_path))
+    cache = ResultCache(tmp_path)
+    cached = deconvolve_samples(signature_df, replicates[["B"]], cache=cache)
+    assert cache.hits == 1
+    assert cached.equals(alone)
+
+
+def test_results_do_not_depend_on_order_or_processes(signature_df, bulk_df):
+    expected = deconvolve_samples(signature_df, bulk_df)
+    reordered = deconvolve_samples(signature_df, bulk_df[bulk_df.columns[::-1]])
+    parallel = deconvolve_samples(signature_df, bulk_df, n_jobs=2)
+    assert reordered.equals(expected)
+    assert parallel.equals(expected)
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from cellanneal.general import calculate_distance
+from cellanneal.objective import MixtureObjective, rankdata
+
+# tolerance of incremental against full evaluations of the objective
+RTOL = 1e-9
+ATOL = 1e-12
+
+
+def make_data(seed, n_genes=400, n_celltypes=6, ties=False):
+    rng = np.random.default_rng(seed)
+    sc_data = rng.gamma(0.7, 10.0, size=(n_genes, n_celltypes))
+    if ties:
+        # repeated genes tie in every mixture
+        sc_data[1::5] = sc_data[::5]
+    bulk_vec = sc_data @ rng.dirichlet(np.ones(n_celltypes))
+    bulk_vec *= rng.lognormal(sigma=0.2, size=n_genes)
+    return sc_data, bulk_vec, rng
+
+
+def moved_points(x, indices, values):
+    points = np.repeat(x[np.newaxis, :], len(indices), axis=0)
+    points[np.arange(len(indices)), indices] = values
+    return points
+
+
+@pytest.mark.parametrize("ties", [False, True])
+def test_coordinate_moves_match_full_evaluation(ties):
+    sc_data, bulk_vec, rng = make_data(0, ties=ties)
+    objective = MixtureObjective(sc_data, bulk_vec)
+    x = rng.random(sc_data.shape[1])
+    # a chain of moves of which one is accepted at each step, so that the
+    # reference is updated incrementally and refreshed from scratch
+    for step in range(3 * MixtureObjective.REFRESH_INTERVAL):
+        indices = rng.integers(sc_data.shape[1], size=8)
+        values = rng.random(8)
+        incremental = objective.coordinate_moves(x, indices, values)
+        points = moved_points(x, indices, values)
+        np.testing.assert_allclose(incremental, objective(points), rtol=RTOL, atol=ATOL)
+        x = points[rng.integers(len(points))]
+
+
+def test_coordinate_moves_after_jump():
+    # moves from a location which is not one of the evaluated moves
+    sc_data, bulk_vec, rng = make_data(1)
+    objective = MixtureObjective(sc_data, bulk_vec)
+    for _ in range(5):
+        x = rng.random(sc_data.shape[1])
+        indices = np.arange(sc_data.shape[1])
+        values = rng.random(sc_data.shape[1])
+        np.testing.assert_allclose(
+            objective.coordinate_moves(x, indices, values),
+            objective(moved_points(x, indices, values)),
+            rtol=RTOL,
+            atol=ATOL,
+        )
+
+
+def test_objective_matches_calculate_distance():
+    sc_data, bulk_vec, rng = make_data(2, ties=True)
+    objective = MixtureObjective(sc_data, bulk_vec)
+    params = rng.random((10, sc_data.shape[1]))
+    expected = [calculate_distance(p, rankdata(bulk_vec), sc_data) for p in params]
+    np.testing.assert_allclose(objective(params), expected, rtol=RTOL, atol=ATOL)
+
+
+@pytest.mark.parametrize("ties", [False, True])
+def test_single_evaluations_match_calculate_distance(ties):
+    # finite-difference steps, which repair the previous sort order, and
+    # unrelated locations, which are sorted from scratch
+    sc_data, bulk_vec, rng = make_data(3, ties=ties)
+    objective = MixtureObjective(sc_data, bulk_vec)
+    bulk_ranks = rankdata(bulk_vec)
+    x = rng.random(sc_data.shape[1])
+    for _ in range(5):
+        for step in [0.0, 1e-8, 1e-4, 1e-2]:
+            point = x + step * rng.standard_normal(sc_data.shape[1])
+            np.testing.assert_allclose(
+                objective(point),
+                calculate_distance(point, bulk_ranks, sc_data),
+                rtol=RTOL,
+                atol=ATOL,
+            )
+        x = rng.random(sc_data.shape[1])
@@ -0,0 +1,53 @@
+import pytest
+from pandas import read_csv
+
+from cellanneal.pipelines import cellanneal_pipe
+from cellanneal.readers import write_bulk_store
+from cellanneal.store import BulkStore
+from cellanneal.telemetry import QuietSink
+
+
+def run_pipe(signature_df, bulk, bulk_path, output_path, chunk_size=None):
+    cellanneal_pipe(
+        bulk_path.parent / "signature.csv",
+        signature_df,
+        bulk_path,
+        bulk,
+        0.5,
+        0,
+        0.01,
+        3,
+        output_path,
+        seed=1,
+        chunk_size=chunk_size,
+        plots=False,
+        events=QuietSink(),
+    )
+    (result_path,) = output_path.glob("*/deconvolution_results/deconvolution_*.csv")
+    (info_path,) = output_path.glob("*/deconvolution_results/run_info_*.csv")
+    return read_csv(result_path, index_col=0), read_csv(info_path, index_col=0)
+
+
+@pytest.fixture(scope="module")
+def expected(signature_df, bulk_df, mixture_path, tmp_path_factory):
+    output_path = tmp_path_factory.mktemp("whole")
+    return run_pipe(signature_df, bulk_df, mixture_path, output_path)
+
+
+@pytest.mark.parametrize("source", ["frame", "store", "file"])
+@pytest.mark.parametrize("chunk_size", [2, 3])
+def test_streaming_matches_whole_run(
+    signature_df, bulk_df, mixture_path, expected, tmp_path, source, chunk_size
+):
+    if source == "frame":
+        bulk = bulk_df
+    elif source == "store":
+        bulk = BulkStore(write_bulk_store(mixture_path, tmp_path / "store").path)
+    else:
+        # read from the file in chunks
+        bulk = None
+    result_df, info_df = run_pipe(
+        signature_df, bulk, mixture_path, tmp_path / "out", chunk_size=chunk_size
+    )
+    assert result_df.equals(expected[0])
+    assert info_df.equals(expected[1])
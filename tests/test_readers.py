@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from pandas import concat
+
+from cellanneal import readers
+from cellanneal.readers import iter_sample_chunks, read_expression_data
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 11, 20])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_sample_chunks_match_full_read(mixture_file, chunk_size, dtype, monkeypatch):
+    # spool the file in many chunks of rows
+    monkeypatch.setattr(readers, "SPOOL_SIZE", 50)
+    expected = read_expression_data(mixture_file, dtype=dtype)
+    chunks = list(iter_sample_chunks(mixture_file, chunk_size, dtype=dtype))
+    assert [len(chunk.columns) for chunk in chunks[:-1]] == [chunk_size] * (
+        len(chunks) - 1
+    )
+    result = concat(chunks, axis=1)
+    assert list(result.columns) == sorted(expected.columns)
+    assert result.equals(expected[result.columns])
+    assert result.dtypes.eq(dtype).all()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from cellanneal import readers
+from cellanneal.general import deconvolve, make_gene_dictionary
+from cellanneal.readers import read_expression_data, write_bulk_store
+from cellanneal.store import BulkStore
+from cellanneal.telemetry import QuietSink
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 256])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_store_matches_read(mixture_file, tmp_path, chunk_size, dtype, monkeypatch):
+    # the file is read in many chunks of rows
+    monkeypatch.setattr(readers, "SPOOL_SIZE", 50)
+    expected = read_expression_data(mixture_file, dtype=dtype)
+    write_bulk_store(
+        mixture_file, tmp_path / "store", chunk_size=chunk_size, dtype=dtype
+    )
+    store = BulkStore(tmp_path / "store")
+    assert list(store.columns) == sorted(expected.columns)
+    assert store.index.equals(expected.index)
+    assert store.read().equals(expected[store.columns])
+    for sample in expected.columns:
+        assert np.array_equal(store[sample].values, expected[sample].values)
+
+
+def test_store_append(mixture_file, tmp_path):
+    expected = read_expression_data(mixture_file)
+    first, second = expected.columns[:5], expected.columns[5:]
+    store = BulkStore.create(tmp_path / "store", expected.index)
+    store.append(expected[first], chunk_size=2)
+    store.append_rows(
+        second, [(np.arange(len(expected.index)), expected[second].values)]
+    )
+    store = BulkStore(tmp_path / "store")
+    assert store.read().equals(expected[store.columns])
+    with pytest.raises(ValueError):
+        store.append(expected[first])
+
+
+def test_deconvolution_from_store(signature_df, bulk_df, mixture_path, tmp_path):
+    store = write_bulk_store(mixture_path, tmp_path / "store", chunk_size=2)
+    events = QuietSink()
+    results = []
+    for bulk in [bulk_df, store]:
+        gene_dict = make_gene_dictionary(signature_df, bulk, events=events)
+        results.append(
+            (
+                gene_dict.to_dict(),
+                deconvolve(signature_df, bulk, 3, gene_dict, seed=1, events=events),
+            )
+        )
+    assert results[0][0] == results[1][0]
+    assert results[0][1].equals(results[1][1])